@@ -1,29 +1,115 @@
-from django.contrib import admin
+from django.contrib import admin, messages
+from django.core.exceptions import PermissionDenied
+from django.http import FileResponse, Http404
+from django.shortcuts import redirect
+from django.template.response import TemplateResponse
+from django.urls import path
+from .forms import LedgerImportForm
+from .importer import import_csv
 from .models import Payment, Income, PaymentCategory, IncomeCategory, AssetCategory, Asset
+from .profiling import profiler_enabled, get_profiler_param, list_profiles, get_profile_path, \
+    get_profile_meta, top_functions
 from import_export import resources
 from import_export.admin import ImportExportModelAdmin
 
+# 管理画面に表示する行エラーの数
+MAX_IMPORT_ERROR_MESSAGES = 20
+
+# プロファイルの詳細で並べ替えに使える列
+PROFILE_SORT_KEYS = ('cumulative', 'tottime', 'calls')
+
+
+class LedgerImportMixin:
+    """
+    明細のCSVをチャンクごとにbulk_createで取り込む画面を追加するMixin
+    import-exportのインポートは1行ずつ処理するため、大きなファイルはこちらを使う
+    """
+    change_list_template = 'admin/kakeibo/change_list_ledger_import.html'
+
+    def get_urls(self):
+        info = self.model._meta.app_label, self.model._meta.model_name
+        urls = [
+            path('ledger_import/', self.admin_site.admin_view(self.ledger_import_view),
+                 name='%s_%s_ledger_import' % info),
+        ]
+        return urls + super().get_urls()
+
+    def ledger_import_view(self, request):
+        if not self.has_add_permission(request):
+            raise PermissionDenied
+
+        form = LedgerImportForm(request.POST or None, request.FILES or None, initial={'owner': request.user})
+        if request.method == 'POST' and form.is_valid():
+            try:
+                result = import_csv(self.model, form.cleaned_data['file'],
+                                    owner_id=form.cleaned_data['owner'].pk,
+                                    encoding=form.cleaned_data['encoding'],
+                                    dry_run=form.cleaned_data['dry_run'])
+            except ValueError as e:
+                self.message_user(request, f'Import failed: {e}', messages.ERROR)
+            else:
+                for line, message in result.errors[:MAX_IMPORT_ERROR_MESSAGES]:
+                    self.message_user(request, f'line {line}: {message}', messages.WARNING)
+                if result.error_count > MAX_IMPORT_ERROR_MESSAGES:
+                    self.message_user(request, f'... and {result.error_count - MAX_IMPORT_ERROR_MESSAGES} '
+                                               f'more errors', messages.WARNING)
+                self.message_user(request, f'Imported {result.created} of {result.rows} rows '
+                                           f'({result.error_count} errors).')
+                info = self.model._meta.app_label, self.model._meta.model_name
+                return redirect('admin:%s_%s_changelist' % info)
+
+        context = {
+            **self.admin_site.each_context(request),
+            'title': 'Bulk import',
+            'opts': self.model._meta,
+            'form': form,
+        }
+        return TemplateResponse(request, 'admin/kakeibo/ledger_import.html', context)
+
+
+class CategoryAdminMixin:
+    """
+    カテゴリの管理画面
+    明細と集計は保存したときのカテゴリの所有者を持つので、登録済みのカテゴリの所有者は変更できないようにする
+    """
+
+    def get_readonly_fields(self, request, obj=None):
+        readonly_fields = super().get_readonly_fields(request, obj)
+        if obj is not None:
+            readonly_fields = (*readonly_fields, 'owner')
+        return readonly_fields
+
+
+class CategoryResource(resources.ModelResource):
+    """カテゴリのインポート。管理画面と同じく、登録済みのカテゴリの所有者は変更しない"""
+
+    def import_field(self, field, obj, data, is_m2m=False, **kwargs):
+        if field.attribute == 'owner' and not obj._state.adding:
+            return
+        super().import_field(field, obj, data, is_m2m=is_m2m, **kwargs)
+
 
 class PaymentResource(resources.ModelResource):
     class Meta:
         model = Payment
 
 
-class PaymentAdmin(ImportExportModelAdmin):
+class PaymentAdmin(LedgerImportMixin, ImportExportModelAdmin):
     search_fields = ('description',)
-    list_display = ['date', 'category', 'amount', 'description']
+    list_display = ['date', 'category', 'amount', 'description', 'owner']
     list_filter = ('category',)
     ordering = ('-date',)
 
     resource_class = PaymentResource
 
 
-class PaymentCategoryResource(resources.ModelResource):
+class PaymentCategoryResource(CategoryResource):
     class Meta:
         model = PaymentCategory
 
 
-class PaymentCategoryAdmin(ImportExportModelAdmin):
+class PaymentCategoryAdmin(CategoryAdminMixin, ImportExportModelAdmin):
+    list_display = ['name', 'owner']
     resource_class = PaymentCategoryResource
 
 
@@ -32,43 +118,47 @@ class IncomeResource(resources.ModelResource):
         model = Income
 
 
-class IncomeAdmin(ImportExportModelAdmin):
+class IncomeAdmin(LedgerImportMixin, ImportExportModelAdmin):
     search_fields = ('description',)
-    list_display = ['date', 'category', 'amount', 'description']
+    list_display = ['date', 'category', 'amount', 'description', 'owner']
     list_filter = ('category',)
     ordering = ('-date',)
 
     resource_class = IncomeResource
 
 
-class IncomeCategoryResource(resources.ModelResource):
+class IncomeCategoryResource(CategoryResource):
     class Meta:
         model = IncomeCategory
 
 
-class IncomeCategoryAdmin(ImportExportModelAdmin):
+class IncomeCategoryAdmin(CategoryAdminMixin, ImportExportModelAdmin):
+    list_display = ['name', 'owner']
     resource_class = IncomeCategoryResource
 
 
 class AssetResource(resources.ModelResource):
     class Meta:
         model = Asset
+        # 同じカテゴリの同じ月の資産をAsset.validate_uniqueで行のエラーにする
+        clean_model_instances = True
 
 
-class AssetAdmin(ImportExportModelAdmin):
-    list_display = ['date', 'category', 'amount', 'description']
+class AssetAdmin(LedgerImportMixin, ImportExportModelAdmin):
+    list_display = ['date', 'category', 'amount', 'description', 'owner']
     list_filter = ('category',)
     ordering = ('-date',)
 
     resource_class = AssetResource
 
 
-class AssetCategoryResource(resources.ModelResource):
+class AssetCategoryResource(CategoryResource):
     class Meta:
         model = AssetCategory
 
 
-class AssetCategoryAdmin(ImportExportModelAdmin):
+class AssetCategoryAdmin(CategoryAdminMixin, ImportExportModelAdmin):
+    list_display = ['name', 'owner']
     resource_class = AssetCategoryResource
 
 
@@ -78,3 +168,52 @@ admin.site.register(Payment, PaymentAdmin)
 admin.site.register(Income, IncomeAdmin)
 admin.site.register(Asset, AssetAdmin)
 admin.site.register(AssetCategory, AssetCategoryAdmin)
+
+
+def get_profile_path_or_404(name):
+    path = get_profile_path(name)
+    if path is None:
+        raise Http404('No such profile.')
+    return path
+
+
+def profile_list_view(request):
+    """保存されたプロファイルの一覧"""
+    context = {
+        **admin.site.each_context(request),
+        'title': 'Profiles',
+        'profiles': list_profiles(),
+        'enabled': profiler_enabled(),
+        'param': get_profiler_param(),
+    }
+    return TemplateResponse(request, 'admin/kakeibo/profile_list.html', context)
+
+
+def profile_detail_view(request, name):
+    """プロファイルの上位の関数"""
+    path = get_profile_path_or_404(name)
+    sort = request.GET.get('sort')
+    sort = sort if sort in PROFILE_SORT_KEYS else PROFILE_SORT_KEYS[0]
+    context = {
+        **admin.site.each_context(request),
+        'title': f'Profile {name}',
+        'profile': get_profile_meta(name),
+        'functions': top_functions(path, sort=sort),
+        'sort': sort,
+        'sort_keys': PROFILE_SORT_KEYS,
+    }
+    return TemplateResponse(request, 'admin/kakeibo/profile_detail.html', context)
+
+
+def profile_download_view(request, name):
+    """snakevizなどで開けるようにpstatsファイルをそのまま返す"""
+    path = get_profile_path_or_404(name)
+    return FileResponse(open(path, 'rb'), as_attachment=True, filename=path.name)
+
+
+# project.urlsでadmin/kakeibo/profiles/に置く
+profile_urls = [
+    path('', admin.site.admin_view(profile_list_view), name='kakeibo_profile_list'),
+    path('<str:name>/', admin.site.admin_view(profile_detail_view), name='kakeibo_profile_detail'),
+    path('<str:name>/download/', admin.site.admin_view(profile_download_view), name='kakeibo_profile_download'),
+]
@@ -4,3 +4,8 @@ from django.apps import AppConfig
 class KakeiboConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'kakeibo'
+
+    def ready(self):
+        from . import checks  # noqa: F401
+        from .signals import connect_signals
+        connect_signals(self)
@@ -0,0 +1,145 @@
+"""
+ベンチマークの計測ヘルパー
+壁時計時間、クエリ数、ピークメモリを測り、バージョン間で比較できるJSONにまとめる
+"""
+
+import datetime
+import json
+import platform
+import statistics
+import time
+import tracemalloc
+import django
+from django.db import connection
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+
+
+def measure(func, repeat=5, warmup=1):
+    """
+    funcを繰り返し実行して計測結果を返す
+    時間はtracemallocなしで測り、クエリ数とピークメモリは別の1回で測る
+    """
+    for _ in range(warmup):
+        func()
+
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append((time.perf_counter() - start) * 1000)
+
+    tracemalloc.start()
+    try:
+        with CaptureQueriesContext(connection) as context:
+            func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'wall_ms': {
+            'min': round(min(timings), 3),
+            'median': round(statistics.median(timings), 3),
+            'max': round(max(timings), 3),
+        },
+        'queries': len(context.captured_queries),
+        'peak_kib': round(peak / 1024, 1),
+    }
+
+
+def make_request(path, params=None, user=None):
+    """ビューを直接呼ぶためのGETリクエストを作る"""
+    request = RequestFactory().get(path, params or {})
+    if user is not None:
+        request.user = user
+    return request
+
+
+def render_view(view_class, request, **kwargs):
+    """クラスベースビューを呼び出して、テンプレートの描画まで行う"""
+    response = view_class.as_view()(request, **kwargs)
+    if hasattr(response, 'render'):
+        response.render()
+    elif response.streaming:
+        # ストリーミングは最後まで読み捨てる
+        for _ in response.streaming_content:
+            pass
+    return response
+
+
+def latency_summary(timings, elapsed):
+    """
+    リクエストごとのレイテンシ(ms)から中央値、99パーセンタイル、最大値と
+    elapsed秒あたりのリクエスト数を返す
+    """
+    timings = sorted(timings)
+    p99 = statistics.quantiles(timings, n=100, method='inclusive')[98] if len(timings) > 1 else timings[0]
+    return {
+        'p50_ms': round(statistics.median(timings), 3),
+        'p99_ms': round(p99, 3),
+        'max_ms': round(timings[-1], 3),
+        'rps': round(len(timings) / elapsed, 1) if elapsed else None,
+    }
+
+
+class DashboardURLConf:
+    """
+    ダッシュボードを同期、非同期どちらかのビューにしたURLconf
+    override_settings(ROOT_URLCONF=DashboardURLConf(True))のように使い、設定を変えずに比べる
+    """
+
+    def __init__(self, async_views):
+        from django.contrib import admin
+        from django.urls import include, path
+        from kakeibo import urls
+
+        dashboard = urls.dashboard_patterns(async_views)
+        names = {pattern.name for pattern in dashboard}
+        patterns = [pattern for pattern in urls.urlpatterns if pattern.name not in names] + dashboard
+        self.urlpatterns = [
+            path('admin/', admin.site.urls),
+            path('accounts/', include('django.contrib.auth.urls')),
+            path('', include((patterns, urls.app_name))),
+        ]
+
+
+def build_report(results, **meta):
+    """計測結果にメタ情報をつけてレポートにする"""
+    return {
+        'meta': {
+            'created_at': datetime.datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'database': connection.vendor,
+            **meta,
+        },
+        'results': results,
+    }
+
+
+def write_report(report, path):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+def load_report(path):
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def compare_reports(previous, current):
+    """
+    2つのレポートの中央値を比べて
+    [(名前, 前回ms, 今回ms, 比率, 前回クエリ数, 今回クエリ数),...]を返す
+    """
+    rows = []
+    for name, result in current['results'].items():
+        before = previous['results'].get(name)
+        if not before:
+            continue
+        before_ms = before['wall_ms']['median']
+        after_ms = result['wall_ms']['median']
+        ratio = after_ms / before_ms if before_ms else None
+        rows.append((name, before_ms, after_ms, ratio, before['queries'], result['queries']))
+    return rows
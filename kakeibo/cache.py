@@ -0,0 +1,258 @@
+"""
+ダッシュボードのcontextデータと、一覧やダッシュボードのテーブルの描画結果のキャッシュ
+所有者、テーブルごとのバージョン番号をキーに含めるので、明細やカテゴリが更新されるとキャッシュは使われなくなる
+バージョン番号は所有者ごとなので、ほかの所有者の更新ではキャッシュは無効にならない
+"""
+
+import hashlib
+import time
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from .concurrency import run_aggregate
+
+VERSION_KEY = 'kakeibo:version:{}:{}'
+MODIFIED_KEY = 'kakeibo:modified:{}:{}'
+CONTEXT_KEY = 'kakeibo:context:{}'
+FRAGMENT_KEY = 'kakeibo:fragment:{}:{}'
+STATS_KEY = 'kakeibo:stats:{}:{}'
+
+# プロセスの中だけにあるキャッシュ。ワーカーの間でバージョン番号を共有できない
+PROCESS_LOCAL_CACHES = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+
+
+def get_cache():
+    return caches[getattr(settings, 'KAKEIBO_CACHE_ALIAS', 'default')]
+
+
+def shares_ledger_versions():
+    """バージョン番号を置くキャッシュが、すべてのワーカープロセスで共有されるならTrue"""
+    config = settings.CACHES.get(getattr(settings, 'KAKEIBO_CACHE_ALIAS', 'default'))
+    return config is not None and config['BACKEND'] not in PROCESS_LOCAL_CACHES
+
+
+def get_cache_timeout():
+    return getattr(settings, 'KAKEIBO_CACHE_TIMEOUT', 60 * 60 * 24)
+
+
+def initial_version():
+    """
+    バージョン番号の初期値
+    キャッシュから消えた後に同じ番号を使い回さないように時刻から作る
+    """
+    return int(time.time() * 1000)
+
+
+def get_ledger_versions(*models, owner_id):
+    """owner_idの所有者のmodelごとのバージョン番号を{ラベル:番号}で返す"""
+    cache = get_cache()
+    keys = {model._meta.label_lower: VERSION_KEY.format(model._meta.label_lower, owner_id) for model in models}
+    found = cache.get_many(keys.values())
+
+    versions = {}
+    for label, key in keys.items():
+        if key not in found:
+            cache.add(key, initial_version(), None)
+            found[key] = cache.get(key)
+        versions[label] = found[key]
+    return versions
+
+
+def get_ledger_modified(*models, owner_id):
+    """
+    owner_idの所有者のmodelのいずれかが最後に更新された時刻(UNIX時間の秒)を返す
+    記録がなければ今の時刻を記録して返す
+    """
+    cache = get_cache()
+    keys = [MODIFIED_KEY.format(model._meta.label_lower, owner_id) for model in models]
+    found = cache.get_many(keys)
+    for key in keys:
+        if key not in found:
+            cache.add(key, int(time.time()), None)
+            found[key] = cache.get(key)
+    return max(found.values(), default=None)
+
+
+def _incr_version(label, owner_id):
+    cache = get_cache()
+    key = VERSION_KEY.format(label, owner_id)
+    try:
+        cache.incr(key)
+    except ValueError:
+        # キャッシュから消えていた場合
+        cache.add(key, initial_version(), None)
+    cache.set(MODIFIED_KEY.format(label, owner_id), int(time.time()), None)
+
+
+def bump_ledger_version(*models, owner_id):
+    """
+    owner_idの所有者のmodelのバージョン番号を上げて、関係するキャッシュを無効にする
+    トランザクション中は、コミット前に読まれてキャッシュされた値を捨てるため、コミット後にもう一度上げる
+    bulk_createなどシグナルが飛ばない書き込みの後は明示的に呼ぶこと
+    """
+    for model in models:
+        label = model._meta.label_lower
+        _incr_version(label, owner_id)
+        transaction.on_commit(lambda label=label: _incr_version(label, owner_id))
+
+
+def make_context_digest(name, versions, kwargs, params):
+    """ビュー名、バージョン番号、URL引数、GETパラメータからハッシュ値を作る。ETagにも使う"""
+    parts = [name]
+    parts += [f'{label}={version}' for label, version in sorted(versions.items())]
+    parts += [f'{key}={value}' for key, value in sorted(kwargs.items())]
+    parts += [f'{key}={value}' for key in sorted(params) for value in params.getlist(key)]
+    return hashlib.md5('|'.join(parts).encode()).hexdigest()
+
+
+def make_context_key(name, versions, kwargs, params):
+    """ビュー名、バージョン番号、URL引数、GETパラメータからキャッシュキーを作る"""
+    return CONTEXT_KEY.format(make_context_digest(name, versions, kwargs, params))
+
+
+def use_ledger_cache():
+    return getattr(settings, 'KAKEIBO_CACHE_ENABLED', True)
+
+
+def get_cached_fragment(name, digest, render):
+    """
+    テンプレートの一部の描画結果をキャッシュから返す。なければrender()で描画してキャッシュする
+    digestはビューのキャッシュキーのハッシュ値で、nameはテンプレートの中の部分の名前
+    """
+    cache = get_cache()
+    key = FRAGMENT_KEY.format(name, digest)
+    content = cache.get(key)
+    record_stat(f'fragment:{name}', 'misses' if content is None else 'hits')
+    if content is None:
+        content = render()
+        cache.set(key, content, get_cache_timeout())
+    return content
+
+
+def record_stat(name, result):
+    """ヒット、ミスの回数を数える"""
+    cache = get_cache()
+    for key in (STATS_KEY.format(name, result), STATS_KEY.format('all', result)):
+        if not cache.add(key, 1, None):
+            try:
+                cache.incr(key)
+            except ValueError:
+                cache.add(key, 1, None)
+
+
+def get_cache_stats(*names):
+    """{ビュー名:{'hits':回数, 'misses':回数}}を返す。'all'は全体の合計"""
+    cache = get_cache()
+    names = ('all',) + names
+    keys = [STATS_KEY.format(name, result) for name in names for result in ('hits', 'misses')]
+    found = cache.get_many(keys)
+    return {name: {result: found.get(STATS_KEY.format(name, result), 0) for result in ('hits', 'misses')}
+            for name in names}
+
+
+class LedgerCacheMixin:
+    """
+    ダッシュボードのcontextデータをキャッシュするMixin
+    ログインユーザーの明細ごとにキャッシュし、cache_modelsのいずれかが更新されるとキャッシュは使われなくなる
+    cache_nameを同じにしたビューどうしは、URL引数とGETパラメータが同じならキャッシュを共有する
+    get_owner_id()を持つビュー(plugins.OwnerMixin)と組み合わせること
+    """
+    cache_models = ()
+    cache_name = None
+
+    def use_ledger_cache(self):
+        return use_ledger_cache()
+
+    def get_cache_name(self):
+        return self.cache_name or type(self).__name__
+
+    def get_context_digest(self):
+        """キャッシュキーのハッシュ値。1リクエストの中では一度だけ計算する"""
+        if getattr(self, '_context_digest', None) is None:
+            owner_id = self.get_owner_id()
+            versions = get_ledger_versions(*self.cache_models, owner_id=owner_id)
+            kwargs = dict(self.kwargs)
+            # バージョン番号の初期値は時刻なので、所有者が違っても同じになることがある
+            kwargs['_owner'] = owner_id
+            kwargs['_backend'] = getattr(self, 'aggregation_backend', None) or getattr(
+                settings, 'KAKEIBO_AGGREGATION_BACKEND', 'database')
+            self._context_digest = make_context_digest(self.get_cache_name(), versions, kwargs,
+                                                       self.request.GET)
+        return self._context_digest
+
+    def get_fragment_digest(self):
+        """テーブルの描画結果のキャッシュキーに使うハッシュ値。キャッシュしない場合はNone"""
+        return self.get_context_digest() if self.use_ledger_cache() else None
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['fragment_digest'] = self.get_fragment_digest()
+        return context
+
+    def get_context_cache_key(self):
+        return CONTEXT_KEY.format(self.get_context_digest())
+
+    def read_cached_data(self):
+        """キャッシュされたデータを返す。なければNone"""
+        name = self.get_cache_name()
+        data = get_cache().get(self.get_context_cache_key())
+        record_stat(name, 'misses' if data is None else 'hits')
+        return data
+
+    def write_cached_data(self, data):
+        get_cache().set(self.get_context_cache_key(), data, get_cache_timeout())
+
+    def get_cached_data(self, func, *args):
+        """funcの結果をキャッシュから返す。なければ作ってキャッシュする"""
+        if not self.use_ledger_cache():
+            return func(*args)
+
+        data = self.read_cached_data()
+        if data is None:
+            data = func(*args)
+            self.write_cached_data(data)
+        return data
+
+    async def aget_cached_data(self, func, *args):
+        """
+        get_cached_dataの非同期版。funcはコルーチン関数
+        キャッシュバックエンドはデータベースのこともあるので、読み書きは集計用のスレッドで行う
+        """
+        if not self.use_ledger_cache():
+            return await func(*args)
+
+        data = await run_aggregate(self.read_cached_data)
+        if data is None:
+            data = await func(*args)
+            await run_aggregate(self.write_cached_data, data)
+        return data
+
+
+class LedgerFragmentMixin:
+    """
+    一覧ページのテーブルの描画結果をキャッシュするMixin
+    テンプレートの{% ledger_fragment %}で囲んだ部分を、ログインユーザー、fragment_models(明細とカテゴリ)の
+    バージョン番号、GETパラメータ(検索条件とページ)ごとにキャッシュする
+    キャッシュが使われると、その部分で使う明細のクエリも実行されない
+    get_owner_id()を持つビュー(plugins.OwnerMixin)と組み合わせること
+    """
+    fragment_models = ()
+
+    def get_fragment_digest(self):
+        """テーブルの描画結果のキャッシュキーに使うハッシュ値。キャッシュしない場合はNone"""
+        if not use_ledger_cache():
+            return None
+        owner_id = self.get_owner_id()
+        versions = get_ledger_versions(*self.fragment_models, owner_id=owner_id)
+        kwargs = dict(self.kwargs)
+        kwargs['_owner'] = owner_id
+        kwargs['_keyset'] = getattr(self, 'use_keyset_pagination', lambda: False)()
+        return make_context_digest(type(self).__name__, versions, kwargs, self.request.GET)
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['fragment_digest'] = self.get_fragment_digest()
+        return context
@@ -0,0 +1,78 @@
+"""
+ダッシュボードのグラフデータのJSON API
+ページは集計を待たずに表示して、グラフのデータはfetchで後から取得する
+ETagとLast-Modifiedは明細のバージョン番号から作るので、何も更新されていなければ集計せずに304を返す
+"""
+
+import math
+from numbers import Integral
+from django.http import JsonResponse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag
+from .cache import get_ledger_modified
+from .concurrency import AsyncDashboardMixin, run_aggregate
+
+
+def to_json_value(value):
+    """pandasの数値もJSONにできるようにする。無限大と欠損はnullにする"""
+    if value is None:
+        return None
+    if isinstance(value, Integral):
+        return int(value)
+    value = float(value)
+    return value if math.isfinite(value) else None
+
+
+def to_json_list(values):
+    if values is None:
+        return None
+    return [to_json_value(value) for value in values]
+
+
+class ChartDataMixin:
+    """
+    LedgerCacheMixinを持つダッシュボードのビューと組み合わせて、グラフのデータをJSONで返すMixin
+    ペイロードは{'labels':[...], 系列名:[...]}という並列の配列にする
+    ブラウザにはキャッシュさせるが、毎回ETagで再検証させる
+    ログインしていない場合はログインページへのリダイレクトではなく403を返す
+    """
+    raise_exception = True
+
+    def get_chart_data(self):
+        raise NotImplementedError
+
+    def get_etag(self):
+        return quote_etag(self.get_context_digest())
+
+    def set_validators(self, response):
+        response['ETag'] = self.etag
+        response['Last-Modified'] = http_date(self.last_modified)
+        patch_cache_control(response, private=True, no_cache=True)
+        return response
+
+    def get_not_modified(self, request):
+        """ETagかLast-Modifiedが一致すれば304のレスポンスを返す。そうでなければNone"""
+        self.etag = self.get_etag()
+        self.last_modified = get_ledger_modified(*self.cache_models, owner_id=self.get_owner_id())
+        response = get_conditional_response(request, etag=self.etag, last_modified=self.last_modified)
+        if response is not None:
+            self.set_validators(response)
+        return response
+
+    def render_chart(self):
+        response = JsonResponse(self.get_chart_data(), json_dumps_params={'ensure_ascii': False})
+        return self.set_validators(response)
+
+    def get(self, request, *args, **kwargs):
+        return self.get_not_modified(request) or self.render_chart()
+
+
+class AsyncChartDataMixin(AsyncDashboardMixin, ChartDataMixin):
+    """ChartDataMixinの非同期版。集計はaget_page_data()で行う"""
+
+    async def get(self, request, *args, **kwargs):
+        response = await run_aggregate(self.get_not_modified, request)
+        if response is not None:
+            return response
+        self.page_data = await self.aget_page_data()
+        return self.render_chart()
@@ -0,0 +1,135 @@
+"""
+推移グラフの系列の範囲の絞り込み、四半期、年へのまとめと点数の間引き
+系列は'YYYY-MM'のソート済みのラベルと、それに対応する値のリスト(表示しない系列はNone)で扱う
+明細が何年分あっても、グラフのデータの点数はKAKEIBO_CHART_MAX_POINTSまでにする
+間引きはLTTB(Largest-Triangle-Three-Buckets)で、山や谷が残るように点を選ぶ
+"""
+
+from bisect import bisect_left, bisect_right
+from collections import namedtuple
+from django.conf import settings
+
+PERIODS = ('month', 'quarter', 'year')
+
+# start, endは'YYYY-MM'、lastは直近の月数、periodはPERIODSのいずれか、max_pointsは点数の上限(Noneは間引かない)
+ChartRange = namedtuple('ChartRange', ['start', 'end', 'last', 'period', 'max_points'],
+                        defaults=(None, None, None, 'month', None))
+
+
+def get_max_points(points=None):
+    """点数の上限を返す。pointsで少なくはできるが、settings.KAKEIBO_CHART_MAX_POINTSは超えない"""
+    limit = getattr(settings, 'KAKEIBO_CHART_MAX_POINTS', 120)
+    if points is None:
+        return limit
+    return min(points, limit) if limit else points
+
+
+def shift_month(label, months):
+    """'YYYY-MM'のmonthsか月後(負なら前)の'YYYY-MM'を返す"""
+    index = int(label[:4]) * 12 + int(label[5:7]) - 1 + months
+    return f'{index // 12}-{index % 12 + 1:02d}'
+
+
+def period_label(label, period):
+    """'YYYY-MM'をperiodのラベル('YYYY-MM', 'YYYY-Qn', 'YYYY')にする"""
+    if period == 'quarter':
+        return f'{label[:4]}-Q{(int(label[5:7]) - 1) // 3 + 1}'
+    if period == 'year':
+        return label[:4]
+    return label
+
+
+def select_range(labels, series, start=None, end=None, last=None):
+    """
+    ラベルと系列をstart〜endの月に絞り込む
+    lastを指定すると、end(なければ最後の月)までの直近lastか月になり、startは使わない
+    """
+    if last and labels:
+        end = end or labels[-1]
+        start = shift_month(end, -(last - 1))
+    low = bisect_left(labels, start) if start else 0
+    high = bisect_right(labels, end) if end else len(labels)
+    return labels[low:high], [values[low:high] if values is not None else None for values in series]
+
+
+def group_by_period(labels, series, period, how='sum'):
+    """
+    月ごとの値をperiodごとにまとめる
+    howが'sum'なら合計(支出、収入のような期間の量)、'last'なら最後の月の値(資産のような期末の残高)にする
+    """
+    if period == 'month':
+        return labels, series
+    grouped_labels = []
+    grouped = [[] if values is not None else None for values in series]
+    for i, label in enumerate(labels):
+        key = period_label(label, period)
+        new_period = not grouped_labels or grouped_labels[-1] != key
+        if new_period:
+            grouped_labels.append(key)
+        for values, group in zip(series, grouped):
+            if values is None:
+                continue
+            if new_period:
+                group.append(values[i])
+            elif how == 'sum':
+                group[-1] += values[i]
+            else:
+                group[-1] = values[i]
+    return grouped_labels, grouped
+
+
+def lttb_indices(series, threshold):
+    """
+    LTTBで残す点の位置をthreshold個返す。最初と最後の点は必ず残す
+    点を等分したバケットごとに、前に選んだ点と次のバケットの平均とで作る三角形が最大になる点を選ぶ
+    複数の系列は同じ位置を残すように、系列ごとの値の幅で割った面積の合計で選ぶ
+    """
+    n = len(series[0])
+    threshold = max(threshold, 3)
+    if n <= threshold:
+        return list(range(n))
+
+    scales = []
+    for values in series:
+        span = max(values) - min(values)
+        scales.append(1 / span if span else 0)
+
+    every = (n - 2) / (threshold - 2)
+    selected = [0]
+    a = 0
+    for bucket in range(threshold - 2):
+        start = int(bucket * every) + 1
+        stop = int((bucket + 1) * every) + 1
+        next_start = stop
+        next_stop = min(int((bucket + 2) * every) + 1, n)
+        avg_x = (next_start + next_stop - 1) / 2
+        avg_ys = [sum(values[next_start:next_stop]) / (next_stop - next_start) for values in series]
+
+        best, best_area = start, -1
+        for j in range(start, stop):
+            area = 0
+            for values, avg_y, scale in zip(series, avg_ys, scales):
+                area += abs((a - avg_x) * (values[j] - values[a]) - (a - j) * (avg_y - values[a])) * scale
+            if area > best_area:
+                best, best_area = j, area
+        selected.append(best)
+        a = best
+    selected.append(n - 1)
+    return selected
+
+
+def downsample(labels, series, max_points):
+    """ラベルと系列をLTTBでmax_points個に間引く。表示しない系列(None)は選ぶときに使わない"""
+    if not max_points or len(labels) <= max_points:
+        return labels, series
+    indices = lttb_indices([values for values in series if values is not None] or [[0] * len(labels)],
+                           max_points)
+    return [labels[i] for i in indices], [[values[i] for i in indices] if values is not None else None
+                                          for values in series]
+
+
+def reduce_series(labels, series, chart_range, how='sum'):
+    """範囲の絞り込み、periodごとのまとめ、点数の間引きを順に行って、ラベルと系列を返す"""
+    labels, series = select_range(labels, series, chart_range.start, chart_range.end, chart_range.last)
+    labels, series = group_by_period(labels, series, chart_range.period, how)
+    return downsample(labels, series, chart_range.max_points)
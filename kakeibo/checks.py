@@ -0,0 +1,30 @@
+"""
+家計簿の設定のチェック
+"""
+
+from django.conf import settings
+from django.core import checks
+from .cache import PROCESS_LOCAL_CACHES
+
+
+@checks.register(checks.Tags.caches)
+def check_ledger_cache(app_configs, **kwargs):
+    """
+    家計簿のキャッシュが有効なら、プロセス間で共有できるバックエンドであること
+    プロセス内のキャッシュでは、ほかのワーカーでの登録でバージョン番号が上がらず、
+    古いダッシュボード、テーブル、ETagがKAKEIBO_CACHE_TIMEOUTの間使われてしまう
+    """
+    if not getattr(settings, 'KAKEIBO_CACHE_ENABLED', True):
+        return []
+    alias = getattr(settings, 'KAKEIBO_CACHE_ALIAS', 'default')
+    config = settings.CACHES.get(alias)
+    if config is None:
+        return [checks.Error(f'KAKEIBO_CACHE_ALIAS refers to an unknown cache: {alias!r}.',
+                             id='kakeibo.E001')]
+    if config['BACKEND'] in PROCESS_LOCAL_CACHES:
+        return [checks.Error(
+            f'The ledger cache {alias!r} uses a process-local backend ({config["BACKEND"]}).',
+            hint='Point KAKEIBO_CACHE_ALIAS at a cache shared by all worker processes '
+                 '(file, database, memcached, redis), or set KAKEIBO_CACHE_ENABLED = False.',
+            id='kakeibo.E002')]
+    return []
@@ -0,0 +1,100 @@
+"""
+ダッシュボードの非同期ビューの土台
+ASGIでは同期ビューはすべて1つのスレッドで順番に実行されるので、集計はスレッド数を制限したプールで行い、
+1リクエストの中で独立した集計は並行して実行する
+Django 3.2にはasyncのORMがないので、sync_to_asyncでプールに渡す
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections
+
+try:
+    # 同期の関数やビューをasyncio.iscoroutinefunction()でコルーチン関数と判定させる
+    from asgiref.sync import markcoroutinefunction
+except ImportError:
+    # asgiref 3.6より前。Python 3.11以前のasyncio.iscoroutinefunction()が見る目印をつける
+    def markcoroutinefunction(func):
+        func._is_coroutine = asyncio.coroutines._is_coroutine
+        return func
+
+_executor = None
+
+
+def get_aggregate_workers():
+    return getattr(settings, 'KAKEIBO_AGGREGATE_WORKERS', 4)
+
+
+def get_executor():
+    """集計用のスレッドプール。データベースへの同時接続数はこのスレッド数までになる"""
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=get_aggregate_workers(),
+                                       thread_name_prefix='kakeibo-aggregate')
+    return _executor
+
+
+def _call(func, args, kwargs):
+    try:
+        return func(*args, **kwargs)
+    finally:
+        # リクエストの終了シグナルが届かないスレッドなので、ここでCONN_MAX_AGEに従って接続を閉じる
+        close_old_connections()
+
+
+async def run_aggregate(func, *args, **kwargs):
+    """同期のfuncを集計用のスレッドプールで実行する"""
+    return await sync_to_async(_call, thread_sensitive=False, executor=get_executor())(func, args, kwargs)
+
+
+async def gather_aggregates(*calls):
+    """
+    (func, *args)のタプルを並行して実行し、結果を同じ順のリストで返す
+    互いに依存しない集計クエリだけを渡すこと
+    """
+    return await asyncio.gather(*(run_aggregate(func, *args) for func, *args in calls))
+
+
+class AsyncDashboardMixin:
+    """
+    ダッシュボードのビューを非同期にするMixin
+    aget_page_data()で集計してから、contextの組み立てはプールのスレッドで行う
+    ビューのget_context_data()はget_page_data()から集計結果を受け取ること
+    """
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        view = super().as_view(**initkwargs)
+        # Django 3.2のView.as_viewは非同期のハンドラを想定していないので、コルーチン関数として扱わせる
+        return markcoroutinefunction(view)
+
+    def dispatch(self, request, *args, **kwargs):
+        return self.adispatch(request, *args, **kwargs)
+
+    async def adispatch(self, request, *args, **kwargs):
+        # request.userはセッションとユーザーをデータベースから読むので、
+        # ログインの確認(LoginRequiredMixin)より先にプールのスレッドで読み込んでおく
+        await run_aggregate(lambda: request.user.is_authenticated)
+        response = super().dispatch(request, *args, **kwargs)
+        if asyncio.iscoroutine(response):
+            response = await response
+        return response
+
+    async def aget_page_data(self):
+        raise NotImplementedError
+
+    def get_page_data(self):
+        return self.page_data
+
+    async def get(self, request, *args, **kwargs):
+        self.page_data = await self.aget_page_data()
+        context = await run_aggregate(self.get_context_data, **kwargs)
+        return self.render_to_response(context)
+
+    async def http_method_not_allowed(self, request, *args, **kwargs):
+        return super().http_method_not_allowed(request, *args, **kwargs)
+
+    async def options(self, request, *args, **kwargs):
+        return super().options(request, *args, **kwargs)
@@ -1,18 +1,16 @@
 from django import forms
+from django.contrib.auth import get_user_model
 from .models import PaymentCategory, Payment, Income, IncomeCategory, AssetCategory, Asset
-from datetime import datetime
-from django.conf import settings
 from django.core.exceptions import ValidationError
+from django.core.validators import RegexValidator
+from django.forms.fields import CallableChoiceIterator
+from .chart_range import ChartRange, get_max_points
+from .registry import get_registry, get_year_registry
 
 
-def year_choices():
-    """年の選択肢を作成して返す"""
-    start_year = settings.KAKEIBO_START_YEAR  # 家計簿の登録を始めた年
-    end_year = datetime.now().year
-    years = [(year, year) for year in reversed(range(start_year, end_year + 1))]
-    years.insert(0, (0, ''))
-
-    return tuple(years)
+def year_choices(owner_id):
+    """owner_idの所有者の明細のある年から選択肢を作成して返す"""
+    return ((0, ''),) + tuple((year, year) for year in get_year_registry(owner_id).years())
 
 
 def month_choices():
@@ -22,10 +20,74 @@ def month_choices():
     return tuple(months)
 
 
-year_choice_field = forms.ChoiceField(
+class OwnerFormMixin:
+    """
+    所有者のカテゴリと年だけを選択肢にするフォームのMixin
+    owner_idにはログインユーザーのpkを渡し、set_owner()を持つフィールドに伝える
+    """
+
+    def __init__(self, *args, owner_id, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.owner_id = owner_id
+        for field in self.fields.values():
+            if hasattr(field, 'set_owner'):
+                field.set_owner(owner_id)
+
+
+class YearChoiceField(forms.ChoiceField):
+    """検索フォーム用の年の選択。選択肢は所有者の明細のある年になる"""
+
+    def set_owner(self, owner_id):
+        # 明細の追加で年が増えても再起動せずに反映されるように、表示のたびに作る
+        # 年の範囲はレジストリに持っているので、明細が更新されていなければクエリは発生しない
+        self.choices = lambda: year_choices(owner_id)
+
+
+class CategoryChoiceField(forms.TypedChoiceField):
+    """
+    検索フォーム用のカテゴリ選択
+    選択肢は所有者のカテゴリのレジストリから作るので、表示、入力チェックともにクエリが発生しない
+    cleaned_dataにはカテゴリのpkが入る
+    """
+
+    def __init__(self, category_model, **kwargs):
+        self.category_model = category_model
+        kwargs.setdefault('choices', [('', '---------')])
+        super().__init__(coerce=int, empty_value=None, **kwargs)
+
+    def set_owner(self, owner_id):
+        registry = get_registry(self.category_model, owner_id)
+        self.choices = lambda: [('', '---------')] + registry.choices()
+
+
+class RegistryModelChoiceField(forms.ModelChoiceField):
+    """
+    登録フォーム用のカテゴリ選択
+    選択肢の表示は所有者のカテゴリのレジストリから行い、入力チェックはModelChoiceFieldと同じくDBで行う
+    """
+    owner_id = None
+
+    def set_owner(self, owner_id):
+        self.owner_id = owner_id
+        self.queryset = self.queryset.filter(owner_id=owner_id)
+
+    def _get_choices(self):
+        registry = get_registry(self.queryset.model, self.owner_id)
+
+        def choices():
+            if self.empty_label is not None:
+                yield '', self.empty_label
+            yield from registry.choices_by_pk()
+
+        return CallableChoiceIterator(choices)
+
+    choices = property(_get_choices, forms.ChoiceField._set_choices)
+
+
+year_choice_field = YearChoiceField(
     label='年での絞り込み',
     required=False,
-    choices=year_choices(),
+    choices=((0, ''),),
     widget=forms.Select(attrs={'class': 'form-select form-select-sm', 'value': ''})
 )
 
@@ -51,7 +113,7 @@ create_form_widgets = {
 }
 
 
-class PaymentSearchForm(forms.Form):
+class PaymentSearchForm(OwnerFormMixin, forms.Form):
     """支出検索フォーム"""
 
     year = year_choice_field
@@ -83,61 +145,168 @@ class PaymentSearchForm(forms.Form):
                                       })
     )
 
-    search_category = forms.ModelChoiceField(
+    search_category = CategoryChoiceField(
+        PaymentCategory,
         label='カテゴリでの絞り込み',
         required=False,
-        queryset=PaymentCategory.objects.order_by('name'),
         widget=forms.Select(attrs={'class': 'form-select form-select-sm'})
     )
 
 
-class IncomeSearchForm(forms.Form):
+class IncomeSearchForm(OwnerFormMixin, forms.Form):
     """収入検索フォーム"""
     year = year_choice_field
     month = month_choice_field
 
 
-class AssetSearchForm(forms.Form):
+class AssetSearchForm(OwnerFormMixin, forms.Form):
     """資産検索フォーム"""
     year = year_choice_field
     month = month_choice_field
 
-    search_category = forms.ModelChoiceField(
+    search_category = CategoryChoiceField(
+        AssetCategory,
         label='カテゴリでの絞り込み',
         required=False,
-        queryset=AssetCategory.objects.order_by('name'),
         widget=forms.Select(attrs={'class': 'form-select form-select-sm'})
     )
 
 
-class PaymentCreateForm(forms.ModelForm):
+class PaymentCreateForm(OwnerFormMixin, forms.ModelForm):
     """支出登録フォーム"""
 
     class Meta:
         model = Payment
         fields = '__all__'
         widgets = create_form_widgets
+        field_classes = {'category': RegistryModelChoiceField}
 
 
-class IncomeCreateForm(forms.ModelForm):
+class IncomeCreateForm(OwnerFormMixin, forms.ModelForm):
     """収入登録フォーム"""
 
     class Meta:
         model = Income
         fields = '__all__'
         widgets = create_form_widgets
+        field_classes = {'category': RegistryModelChoiceField}
 
 
-class AssetCreateForm(forms.ModelForm):
+class AssetCreateForm(OwnerFormMixin, forms.ModelForm):
     """資産登録フォーム"""
 
     class Meta:
         model = Asset
         fields = '__all__'
         widgets = create_form_widgets
+        field_classes = {'category': RegistryModelChoiceField}
+
+
+class AssetSnapshotForm(forms.Form):
+    """
+    資産の月次スナップショットフォーム
+    所有者の資産カテゴリごとの金額欄を作り、1回の送信でその月の資産をまとめて登録する
+    空欄のカテゴリは登録、更新しない
+    """
+    date = forms.DateField(label='日付', widget=create_form_widgets['date'])
+
+    def __init__(self, *args, month, owner_id, amounts=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.month = month
+        self.owner_id = owner_id
+        amounts = amounts or {}
+        for pk, name in get_registry(AssetCategory, owner_id).choices_by_pk():
+            self.fields[f'category_{pk}'] = forms.IntegerField(
+                label=name,
+                required=False,
+                initial=amounts.get(pk),
+                widget=forms.TextInput(attrs={'autocomplete': 'off',
+                                              'placeholder': 'amount',
+                                              'class': 'form-control'}),
+            )
+
+    def category_fields(self):
+        return [self[name] for name in self.fields if name.startswith('category_')]
+
+    def clean_date(self):
+        date = self.cleaned_data['date']
+        if (date.year, date.month) != (self.month.year, self.month.month):
+            raise ValidationError(f'{self.month:%Y-%m}の日付を入力してください')
+        return date
+
+    def clean(self):
+        cleaned_data = super().clean()
+        if not self.get_amounts():
+            raise ValidationError('金額を1つ以上入力してください')
+        return cleaned_data
+
+    def get_amounts(self):
+        """入力された金額を{category_pk:amount}で返す"""
+        return {int(name[len('category_'):]): amount for name, amount in self.cleaned_data.items()
+                if name.startswith('category_') and amount is not None}
+
+
+month_validator = RegexValidator(r'^[0-9]{4}-(0[1-9]|1[0-2])$', 'YYYY-MMの形式で入力してください')
+
+month_input_widget = forms.TextInput(attrs={'type': 'month',
+                                            'placeholder': 'YYYY-MM',
+                                            'class': 'form-control form-control-sm'})
+
+
+class ChartRangeForm(forms.Form):
+    """
+    推移グラフの表示範囲のフォーム
+    開始月、終了月か直近の月数で範囲を選び、四半期、年ごとにまとめられる
+    pointsはAPIで点数の上限を下げたい場合に使う
+    """
+
+    PERIOD_CHOICES = (
+        ('month', 'Month'),
+        ('quarter', 'Quarter'),
+        ('year', 'Year'),
+    )
 
-
-class TransitionGraphSearchForm(forms.Form):
+    start = forms.CharField(label='開始月',
+                            required=False,
+                            validators=[month_validator],
+                            widget=month_input_widget)
+
+    end = forms.CharField(label='終了月',
+                          required=False,
+                          validators=[month_validator],
+                          widget=month_input_widget)
+
+    last = forms.IntegerField(label='直近の月数',
+                              required=False,
+                              min_value=1,
+                              widget=forms.NumberInput(attrs={'class': 'form-control form-control-sm'}))
+
+    period = forms.ChoiceField(label='集計単位',
+                               required=False,
+                               choices=PERIOD_CHOICES,
+                               widget=forms.Select(attrs={'class': 'form-select form-select-sm'}))
+
+    points = forms.IntegerField(label='点数の上限', required=False, min_value=3)
+
+    def clean(self):
+        cleaned_data = super().clean()
+        start = cleaned_data.get('start')
+        end = cleaned_data.get('end')
+        if start and end and start > end:
+            raise ValidationError('開始月は終了月以前にしてください')
+        return cleaned_data
+
+    def get_chart_range(self):
+        """入力からChartRangeを返す。入力が正しくない場合は全期間を月ごとに表示する"""
+        data = self.cleaned_data if self.is_valid() else {}
+        return ChartRange(start=data.get('start') or None,
+                          end=data.get('end') or None,
+                          last=data.get('last'),
+                          period=data.get('period') or 'month',
+                          max_points=get_max_points(data.get('points')))
+
+
+class TransitionGraphSearchForm(OwnerFormMixin, ChartRangeForm):
     """推移グラフの絞り込みフォーム"""
 
     SHOW_CHOICES = (
@@ -146,17 +315,17 @@ class TransitionGraphSearchForm(forms.Form):
         ('Income', 'Income'),
     )
 
-    payment_category = forms.ModelChoiceField(
+    payment_category = CategoryChoiceField(
+        PaymentCategory,
         label='支出カテゴリでの絞り込み',
         required=False,
-        queryset=PaymentCategory.objects.order_by('name'),
         widget=forms.Select(attrs={'class': 'form-select form-select-sm'}),
     )
 
-    income_category = forms.ModelChoiceField(
+    income_category = CategoryChoiceField(
+        IncomeCategory,
         label='収入カテゴリでの絞り込み',
         required=False,
-        queryset=IncomeCategory.objects.order_by('name'),
         widget=forms.Select(attrs={'class': 'form-select form-select-sm'}),
     )
 
@@ -165,3 +334,19 @@ class TransitionGraphSearchForm(forms.Form):
                                       choices=SHOW_CHOICES,
                                       widget=forms.Select(attrs={'class': 'form-select form-select-sm'}),
                                       )
+
+
+class LedgerImportForm(forms.Form):
+    """管理画面でのCSV一括取り込みフォーム"""
+
+    ENCODING_CHOICES = (
+        ('utf-8-sig', 'UTF-8'),
+        ('cp932', 'Shift_JIS (cp932)'),
+    )
+
+    owner = forms.ModelChoiceField(label='所有者', queryset=get_user_model().objects.order_by('username'),
+                                   help_text='この所有者のカテゴリに取り込みます')
+    file = forms.FileField(label='CSVファイル',
+                           help_text='列はdate, amount, category(カテゴリ名またはpk), description')
+    encoding = forms.ChoiceField(label='文字コード', choices=ENCODING_CHOICES)
+    dry_run = forms.BooleanField(label='検証のみ', required=False)
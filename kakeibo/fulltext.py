@@ -0,0 +1,104 @@
+"""
+摘要(description)の全文検索
+SQLiteのFTS5(trigramトークナイザ)で索引を作るので、日本語も分かち書きなしで部分一致検索できる
+索引はトリガーで明細テーブルと同期される
+"""
+
+from django.conf import settings
+from django.db import connections, router
+from django.db.models.expressions import RawSQL
+
+# 索引を作る明細テーブル
+FULLTEXT_TABLES = ('kakeibo_payment', 'kakeibo_income', 'kakeibo_asset')
+
+# trigramトークナイザは3文字未満の語を検索できない
+MIN_TRIGRAM_LENGTH = 3
+
+
+def fts_table_name(table):
+    return f'{table}_fts'
+
+
+def fulltext_supported(connection):
+    """FTS5のtrigramトークナイザが使えるかどうか(SQLite 3.34以上)"""
+    if connection.vendor != 'sqlite':
+        return False
+    from sqlite3 import sqlite_version_info
+    return sqlite_version_info >= (3, 34, 0)
+
+
+def ensure_fulltext_index(connection):
+    """
+    全文検索用の仮想テーブルと同期用のトリガーを作る
+    テーブルの作り直しを伴うマイグレーションではトリガーが消えるため、migrateのたびに呼ばれる
+    トリガーがなかった場合は索引を作り直す
+    """
+    if not fulltext_supported(connection):
+        return
+
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT name FROM sqlite_master WHERE type IN ('table', 'trigger')")
+        existing = {row[0] for row in cursor.fetchall()}
+
+        for table in FULLTEXT_TABLES:
+            if table not in existing:
+                continue
+            fts = fts_table_name(table)
+            triggers = (f'{fts}_ai', f'{fts}_ad', f'{fts}_au')
+            if fts in existing and all(trigger in existing for trigger in triggers):
+                continue
+
+            cursor.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5("
+                           f"description, content='{table}', content_rowid='id', tokenize='trigram')")
+            cursor.execute(f"CREATE TRIGGER IF NOT EXISTS {fts}_ai AFTER INSERT ON {table} BEGIN "
+                           f"INSERT INTO {fts}(rowid, description) VALUES (new.id, new.description); "
+                           f"END")
+            cursor.execute(f"CREATE TRIGGER IF NOT EXISTS {fts}_ad AFTER DELETE ON {table} BEGIN "
+                           f"INSERT INTO {fts}({fts}, rowid, description) "
+                           f"VALUES ('delete', old.id, old.description); "
+                           f"END")
+            cursor.execute(f"CREATE TRIGGER IF NOT EXISTS {fts}_au AFTER UPDATE ON {table} BEGIN "
+                           f"INSERT INTO {fts}({fts}, rowid, description) "
+                           f"VALUES ('delete', old.id, old.description); "
+                           f"INSERT INTO {fts}(rowid, description) VALUES (new.id, new.description); "
+                           f"END")
+            cursor.execute(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')")
+
+
+def drop_fulltext_index(connection):
+    """全文検索用の仮想テーブルとトリガーを削除する"""
+    if not fulltext_supported(connection):
+        return
+    with connection.cursor() as cursor:
+        for table in FULLTEXT_TABLES:
+            fts = fts_table_name(table)
+            for trigger in (f'{fts}_ai', f'{fts}_ad', f'{fts}_au'):
+                cursor.execute(f'DROP TRIGGER IF EXISTS {trigger}')
+            cursor.execute(f'DROP TABLE IF EXISTS {fts}')
+
+
+def use_fulltext(model):
+    """modelのキーワード検索に全文検索の索引を使うかどうか"""
+    if not getattr(settings, 'KAKEIBO_FULLTEXT_SEARCH', True):
+        return False
+    if model._meta.db_table not in FULLTEXT_TABLES:
+        return False
+    return fulltext_supported(connections[router.db_for_read(model)])
+
+
+def filter_by_keywords(queryset, key_word):
+    """
+    空白で区切られたキーワードをすべて含む明細に絞り込む(and検索)
+    3文字以上の語は全文検索の索引を使い、それより短い語はicontainsで絞り込む
+    """
+    fulltext = use_fulltext(queryset.model)
+    fts = fts_table_name(queryset.model._meta.db_table)
+    for word in key_word.split():
+        if fulltext and len(word) >= MIN_TRIGRAM_LENGTH:
+            # フレーズとして渡して、記号がFTS5の演算子として解釈されないようにする
+            phrase = '"{}"'.format(word.replace('"', '""'))
+            queryset = queryset.filter(pk__in=RawSQL(
+                f'SELECT rowid FROM {fts} WHERE {fts} MATCH %s', (phrase,)))
+        else:
+            queryset = queryset.filter(description__icontains=word)
+    return queryset
@@ -0,0 +1,166 @@
+"""
+明細CSVの一括取り込み
+CSVをチャンクごとに読み込んで検証し、bulk_createでまとめて登録する
+ファイル全体をメモリに載せず、行ごとのクエリも発生しないので、数十万行のCSVでも取り込める
+"""
+
+import datetime
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from django.conf import settings
+from django.db import connection, transaction
+from .cache import bump_ledger_version
+from .models import Asset
+from .summary import LEDGER_KINDS, apply_delta
+
+# カテゴリごとに月1件だけ登録できるモデル
+MONTHLY_MODELS = (Asset,)
+
+
+class ImportResult:
+    """取り込み結果"""
+
+    def __init__(self):
+        self.rows = 0
+        self.created = 0
+        self.errors = []
+
+    @property
+    def error_count(self):
+        return len(self.errors)
+
+
+def get_import_workers():
+    return getattr(settings, 'KAKEIBO_IMPORT_WORKERS', 0)
+
+
+def get_import_chunk_size():
+    return getattr(settings, 'KAKEIBO_IMPORT_CHUNK_SIZE', 5000)
+
+
+def category_lookup(category_model, owner_id):
+    """
+    owner_idの所有者のカテゴリの({カテゴリ名:pk}, {'pk':pk})を1回のクエリで作る
+    ほかの所有者のカテゴリのpkはエラーになる。同名のカテゴリがある場合は、pkが小さい方に割り当てる
+    """
+    name_map = {}
+    pk_map = {}
+    for pk, name in category_model.objects.filter(owner_id=owner_id).order_by('pk').values_list('pk', 'name'):
+        name_map.setdefault(name, pk)
+        pk_map[str(pk)] = pk
+    return name_map, pk_map
+
+
+def amount_range(model):
+    """金額のフィールドに入る値の範囲"""
+    internal_type = model._meta.get_field('amount').get_internal_type()
+    low, high = connection.ops.integer_field_range(internal_type)
+    return low or -2 ** 63, high or 2 ** 63 - 1
+
+
+def parse_chunks(chunks, args, workers):
+    """
+    チャンクを順に検証して結果を返すジェネレーター
+    workersが2以上の場合はプロセスプールで並列に検証する
+    先読みはworkersの2倍までにして、ファイル全体を読み込まないようにする
+    """
+    # pandasは読み込みに時間がかかるので、取り込むときに初めて読み込む
+    from .ledger_csv import parse_chunk
+
+    if workers < 2:
+        for df, first_line in chunks:
+            yield len(df), parse_chunk(df, first_line, *args)
+        return
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque()
+        for df, first_line in chunks:
+            pending.append((len(df), executor.submit(parse_chunk, df, first_line, *args)))
+            if len(pending) >= workers * 2:
+                size, future = pending.popleft()
+                yield size, future.result()
+        while pending:
+            size, future = pending.popleft()
+            yield size, future.result()
+
+
+def monthly_totals(rows):
+    """月次集計に足し込む値を{(year, month, category_pk):(合計, 件数)}で返す"""
+    totals = {}
+    for _, date, amount, category_pk, _ in rows:
+        key = (date.year, date.month, category_pk)
+        total, count = totals.get(key, (0, 0))
+        totals[key] = (total + amount, count + 1)
+    return totals
+
+
+def drop_registered_months(model, rows, owner_id):
+    """登録済みの月と、チャンク内で重複する月の行を除いて(rows, errors)を返す"""
+    months = {date.replace(day=1) for _, date, _, _, _ in rows}
+    registered = set(model.objects.filter(owner_id=owner_id, month__in=months).values_list('category_id', 'month'))
+    kept = []
+    errors = []
+    for row in rows:
+        line, date, _, category_pk, _ = row
+        key = (category_pk, date.replace(day=1))
+        if key in registered:
+            errors.append((line, 'already registered in this month'))
+        else:
+            registered.add(key)
+            kept.append(row)
+    return kept, errors
+
+
+def insert_rows(model, rows, batch_size, owner_id):
+    """1チャンク分の明細を登録し、月次集計に足し込む"""
+    kind = LEDGER_KINDS[model]
+    objs = []
+    for _, date, amount, category_pk, description in rows:
+        # カテゴリはcategory_lookupで所有者のものに限っているので、ownerはそのまま入れる
+        obj = model(date=date, amount=amount, category_id=category_pk, description=description,
+                    owner_id=owner_id)
+        if model in MONTHLY_MODELS:
+            obj.set_month()
+        objs.append(obj)
+
+    with transaction.atomic():
+        model.objects.bulk_create(objs, batch_size=batch_size)
+        for (year, month, category_pk), (total, count) in monthly_totals(rows).items():
+            apply_delta(owner_id, kind, datetime.date(year, month, 1), category_pk, total, count)
+        # bulk_createではシグナルが飛ばないので、キャッシュは明示的に無効にする
+        bump_ledger_version(model, owner_id=owner_id)
+
+
+def import_csv(model, source, owner_id, encoding='utf-8-sig', chunk_size=None, batch_size=1000,
+               workers=None, dry_run=False, progress=None):
+    """
+    CSVをowner_idの所有者のmodelの明細として取り込む
+    列はdate, amount, category(所有者のカテゴリ名またはpk), description
+    エラーのある行は飛ばして、行番号とともにImportResult.errorsに記録する
+    チャンクごとにトランザクションを分けるので、途中で失敗してもそれまでのチャンクは登録される
+    progressを渡すと、チャンクごとにImportResultを引数に呼ばれる
+    """
+    from .ledger_csv import read_chunks
+
+    chunk_size = chunk_size or get_import_chunk_size()
+    workers = get_import_workers() if workers is None else workers
+    category_model = model._meta.get_field('category').related_model
+    name_map, pk_map = category_lookup(category_model, owner_id)
+    args = (name_map, pk_map, amount_range(model))
+
+    result = ImportResult()
+    chunks = read_chunks(source, chunk_size, encoding)
+    for size, (rows, errors) in parse_chunks(chunks, args, workers):
+        result.rows += size
+        if rows and model in MONTHLY_MODELS:
+            # 登録済みの月はデータベースの制約でも弾かれるが、チャンクごと失敗しないように先に除く
+            rows, month_errors = drop_registered_months(model, rows, owner_id)
+            errors = sorted(errors + month_errors)
+        result.errors += errors
+        if rows and not dry_run:
+            insert_rows(model, rows, batch_size, owner_id)
+            result.created += len(rows)
+        if progress:
+            progress(result)
+
+    return result
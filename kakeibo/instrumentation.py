@@ -0,0 +1,211 @@
+"""
+リクエストごとの処理時間の計測
+SQL、pandas、テーブルの組み立て、テンプレートの描画にかかった時間をServer-Timingヘッダーで返し、
+ビューごとのレイテンシのヒストグラムをプロセス内に集計してPrometheusのテキスト形式で出力する
+計測はcontextvarsでリクエストに紐づけるので、集計用のスレッドプールで実行された処理も数えられる
+"""
+
+import asyncio
+import functools
+import threading
+import time
+from contextvars import ContextVar
+from django.conf import settings
+from .concurrency import markcoroutinefunction
+
+_current = ContextVar('kakeibo_request_timings', default=None)
+
+# レイテンシのヒストグラムの区切り(秒)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def get_buckets():
+    return tuple(getattr(settings, 'KAKEIBO_METRICS_BUCKETS', DEFAULT_BUCKETS))
+
+
+class RequestTimings:
+    """1リクエストの区間ごとの時間(ms)とSQLの回数"""
+
+    def __init__(self):
+        self.phases = {}
+        self.sql_count = 0
+        self.sql_ms = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, name, ms):
+        with self._lock:
+            self.phases[name] = self.phases.get(name, 0.0) + ms
+
+    def add_query(self, ms):
+        with self._lock:
+            self.sql_count += 1
+            self.sql_ms += ms
+
+    def server_timing(self, total_ms):
+        """Server-Timingヘッダーの値を返す"""
+        entries = [f'sql;dur={self.sql_ms:.1f};desc="{self.sql_count} queries"']
+        entries += [f'{name};dur={ms:.1f}' for name, ms in self.phases.items()]
+        entries.append(f'total;dur={total_ms:.1f}')
+        return ', '.join(entries)
+
+
+def timed(name):
+    """メソッドの実行時間をnameの区間として計測するデコレーター。計測中のリクエストがなければそのまま呼ぶ"""
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            timings = _current.get()
+            if timings is None:
+                return func(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                timings.add(name, (time.perf_counter() - start) * 1000)
+        return wrapper
+
+    return decorator
+
+
+def sql_timer(execute, sql, params, many, context):
+    """SQLの回数と時間を数えるexecute_wrapper"""
+    timings = _current.get()
+    if timings is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        timings.add_query((time.perf_counter() - start) * 1000)
+
+
+def install_sql_timer(sender, connection, **kwargs):
+    """connection_createdで呼ばれ、すべての接続にsql_timerを入れる"""
+    if sql_timer not in connection.execute_wrappers:
+        connection.execute_wrappers.append(sql_timer)
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class RequestMetrics:
+    """ビューごとのレイテンシのヒストグラムと、SQL、区間ごとの時間の合計"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.buckets = get_buckets()
+            self.views = {}
+
+    def observe(self, view, seconds, timings):
+        with self._lock:
+            stats = self.views.get(view)
+            if stats is None:
+                stats = self.views[view] = {'buckets': [0] * len(self.buckets), 'sum': 0.0, 'count': 0,
+                                            'sql_count': 0, 'phases': {}}
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    stats['buckets'][i] += 1
+            stats['sum'] += seconds
+            stats['count'] += 1
+            stats['sql_count'] += timings.sql_count
+            phases = {'sql': timings.sql_ms, **timings.phases}
+            for name, ms in phases.items():
+                stats['phases'][name] = stats['phases'].get(name, 0.0) + ms / 1000
+
+    def render(self):
+        """Prometheusのテキスト形式で返す"""
+        with self._lock:
+            views = {view: {**stats, 'buckets': list(stats['buckets']), 'phases': dict(stats['phases'])}
+                     for view, stats in sorted(self.views.items())}
+            buckets = self.buckets
+
+        lines = ['# HELP kakeibo_request_duration_seconds Request latency by view.',
+                 '# TYPE kakeibo_request_duration_seconds histogram']
+        for view, stats in views.items():
+            label = f'view="{escape_label(view)}"'
+            for bound, count in zip(buckets, stats['buckets']):
+                lines.append(f'kakeibo_request_duration_seconds_bucket{{{label},le="{bound}"}} {count}')
+            lines.append(f'kakeibo_request_duration_seconds_bucket{{{label},le="+Inf"}} {stats["count"]}')
+            lines.append(f'kakeibo_request_duration_seconds_sum{{{label}}} {stats["sum"]:.6f}')
+            lines.append(f'kakeibo_request_duration_seconds_count{{{label}}} {stats["count"]}')
+
+        lines += ['# HELP kakeibo_request_sql_queries_total SQL queries run by view.',
+                  '# TYPE kakeibo_request_sql_queries_total counter']
+        for view, stats in views.items():
+            lines.append(f'kakeibo_request_sql_queries_total{{view="{escape_label(view)}"}} {stats["sql_count"]}')
+
+        lines += ['# HELP kakeibo_request_phase_seconds_total Time spent in SQL, pandas, tables and rendering.',
+                  '# TYPE kakeibo_request_phase_seconds_total counter']
+        for view, stats in views.items():
+            for phase, seconds in sorted(stats['phases'].items()):
+                lines.append(f'kakeibo_request_phase_seconds_total'
+                             f'{{view="{escape_label(view)}",phase="{escape_label(phase)}"}} {seconds:.6f}')
+        return '\n'.join(lines) + '\n'
+
+
+request_metrics = RequestMetrics()
+
+
+def get_view_name(request):
+    """ヒストグラムのラベルにするビュー名。URLにないパスはまとめて数える"""
+    match = getattr(request, 'resolver_match', None)
+    return match.view_name if match else 'unresolved'
+
+
+class ServerTimingMiddleware:
+    """
+    リクエストの処理時間を計測して、Server-Timingヘッダーをつけ、ビューごとのヒストグラムに加えるミドルウェア
+    テンプレートの描画時間はrenderの区間として数える
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if asyncio.iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if asyncio.iscoroutinefunction(self.get_response):
+            return self.__acall__(request)
+        timings, token, start = self.start(request)
+        try:
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.finish(request, response, timings, start)
+
+    async def __acall__(self, request):
+        timings, token, start = self.start(request)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.finish(request, response, timings, start)
+
+    @staticmethod
+    def start(request):
+        timings = RequestTimings()
+        return timings, _current.set(timings), time.perf_counter()
+
+    @staticmethod
+    def finish(request, response, timings, start):
+        seconds = time.perf_counter() - start
+        if getattr(settings, 'KAKEIBO_SERVER_TIMING', True):
+            response['Server-Timing'] = timings.server_timing(seconds * 1000)
+        request_metrics.observe(get_view_name(request), seconds, timings)
+        return response
+
+    def process_template_response(self, request, response):
+        timings = _current.get()
+        if timings is not None:
+            started = time.perf_counter()
+            response.add_post_render_callback(
+                lambda rendered: timings.add('render', (time.perf_counter() - started) * 1000))
+        return response
@@ -0,0 +1,77 @@
+"""
+明細CSVの読み込みと検証
+Djangoに依存しないので、別プロセスでも実行できる
+"""
+
+import pandas as pd
+
+# 必須の列。descriptionは省略できる
+REQUIRED_COLUMNS = ('date', 'amount', 'category')
+
+
+def read_chunks(source, chunk_size, encoding='utf-8-sig'):
+    """
+    CSVをchunk_size行ずつ読み込み、(DataFrame, 先頭行の行番号)を返すジェネレーター
+    値はすべて文字列のまま読み込み、列名は小文字にそろえる
+    """
+    reader = pd.read_csv(source, chunksize=chunk_size, dtype=str, keep_default_na=False,
+                         encoding=encoding, skipinitialspace=True)
+    # ヘッダーが1行目なので、データは2行目から
+    line = 2
+    for df in reader:
+        df.columns = [str(column).strip().lower() for column in df.columns]
+        missing = [column for column in REQUIRED_COLUMNS if column not in df.columns]
+        if missing:
+            raise ValueError(f"CSV is missing columns: {', '.join(missing)}")
+        yield df, line
+        line += len(df)
+
+
+def parse_chunk(df, first_line, name_map, pk_map, amount_range):
+    """
+    1チャンク分の行をまとめて検証する
+    name_mapは{カテゴリ名:pk}、pk_mapは{'pk':pk}で、カテゴリ名で見つからなければpkとして解決する
+    (rows, errors)を返す
+        rows: [(行番号, date, amount, category_pk, description),...]
+        errors: [(行番号, メッセージ),...]
+    """
+    lines = pd.Series(range(first_line, first_line + len(df)), index=df.index)
+    messages = pd.Series('', index=df.index)
+
+    # 日付は2021-05-01と2021/05/01の両方を受け付ける
+    dates = pd.to_datetime(df['date'].str.strip().str.replace('/', '-', regex=False),
+                           format='%Y-%m-%d', errors='coerce')
+    messages = messages.mask(dates.isna(), messages + 'invalid date; ')
+
+    # 桁区切りや通貨記号は取り除く
+    amount_text = df['amount'].str.replace(r'[,\s¥￥円]', '', regex=True)
+    amounts = pd.to_numeric(amount_text, errors='coerce')
+    low, high = amount_range
+    bad_amount = amounts.isna() | (amounts % 1 != 0) | (amounts < low) | (amounts > high)
+    messages = messages.mask(bad_amount, messages + 'invalid amount; ')
+
+    category_text = df['category'].str.strip()
+    categories = category_text.map(name_map)
+    categories = categories.fillna(category_text.map(pk_map))
+    messages = messages.mask(categories.isna(), messages + 'unknown category; ')
+
+    valid = messages == ''
+    errors = [(line, message.rstrip('; '))
+              for line, message in zip(lines[~valid], messages[~valid])]
+
+    if 'description' in df.columns:
+        descriptions = df['description'].str.strip()
+    else:
+        descriptions = pd.Series('', index=df.index)
+
+    frame = pd.DataFrame({
+        'line': lines[valid],
+        'date': dates[valid],
+        'amount': amounts[valid].astype('int64'),
+        'category': categories[valid].astype('int64'),
+        'description': descriptions[valid],
+    })
+    rows = list(zip(frame['line'].tolist(), frame['date'].dt.date, frame['amount'].tolist(),
+                    frame['category'].tolist(), frame['description'].tolist()))
+
+    return rows, errors
@@ -0,0 +1,135 @@
+import asyncio
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from django.core.management.base import BaseCommand, CommandError
+from django.test import AsyncClient, Client
+from django.test.utils import override_settings
+from django.urls import reverse
+from kakeibo.benchmark import DashboardURLConf, latency_summary, build_report, write_report
+from kakeibo.models import Payment, Income, Asset, PaymentCategory, IncomeCategory, AssetCategory
+from kakeibo.plugins import get_owner
+from kakeibo.registry import get_registry, get_year_registry
+
+# (モード名, 非同期のビューを使うか, ASGIで処理するか)
+MODES = (
+    ('wsgi', False, False),
+    ('asgi', False, True),
+    ('asgi:async', True, True),
+)
+
+
+class Command(BaseCommand):
+    """
+    ダッシュボードのページとグラフデータを同時にリクエストして、WSGIとASGIのレイテンシを比べる
+    WSGIはスレッドごとにClient、ASGIはAsyncClientでリクエストする
+    どちらも--ownerのユーザーでログインしたクライアントを使う
+    """
+    help = 'Compare dashboard latency (p50/p99) under WSGI and ASGI with concurrent requests.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=200, help='Requests per mode.')
+        parser.add_argument('--concurrency', type=int, default=8, help='Requests in flight.')
+        parser.add_argument('--owner', default=None,
+                            help='Username whose ledger is requested. Defaults to the first superuser.')
+        parser.add_argument('--year', type=int, default=None)
+        parser.add_argument('--month', type=int, default=None)
+        parser.add_argument('--only', default=None, help='Run only modes whose name contains this.')
+        parser.add_argument('--output', default=None, help='Write the JSON report to this path.')
+
+    def handle(self, *args, **options):
+        owner = get_owner(options['owner'])
+        if owner is None:
+            raise CommandError('No ledger owner. Run generate_ledger first.')
+        latest = Payment.objects.filter(owner=owner).order_by('-date').values_list('date', flat=True).first()
+        if latest is None:
+            raise CommandError(f'No payments for {owner.username}. Run generate_ledger first.')
+        year = options['year'] or latest.year
+        month = options['month'] or latest.month
+
+        for model in (PaymentCategory, IncomeCategory, AssetCategory):
+            get_registry(model, owner.pk).choices()
+        get_year_registry(owner.pk).years()
+
+        results = {}
+        for name, async_views, asgi in MODES:
+            if options['only'] and options['only'] not in name:
+                continue
+            # 集計そのものを比べるので、キャッシュは使わない
+            with override_settings(ROOT_URLCONF=DashboardURLConf(async_views), ALLOWED_HOSTS=['testserver'],
+                                   KAKEIBO_CACHE_ENABLED=False):
+                urls = self.get_urls(year, month)
+                requests = [urls[i % len(urls)] for i in range(options['requests'])]
+                run = self.run_asgi if asgi else self.run_wsgi
+                # テンプレートの読み込みなど初回だけの処理は計測から除く
+                run(owner, urls, 1)
+                start = time.perf_counter()
+                timings, errors = run(owner, requests, options['concurrency'])
+                elapsed = time.perf_counter() - start
+
+            results[name] = result = latency_summary(timings, elapsed)
+            result['errors'] = errors
+            self.stdout.write(f"{name:<12} p50={result['p50_ms']:>8.2f}ms p99={result['p99_ms']:>8.2f}ms "
+                              f"max={result['max_ms']:>8.2f}ms {result['rps']:>7.1f}req/s errors={errors}")
+
+        if options['output']:
+            report = build_report(
+                results,
+                owner=owner.username, year=year, month=month,
+                requests=options['requests'], concurrency=options['concurrency'],
+                rows={model.__name__: model.objects.filter(owner=owner).count()
+                      for model in (Payment, Income, Asset)},
+            )
+            write_report(report, options['output'])
+            self.stdout.write(self.style.SUCCESS(f"Report written to {options['output']}"))
+
+    @staticmethod
+    def get_urls(year, month):
+        """ダッシュボードを1回ずつ開いたときのリクエスト"""
+        return [
+            reverse('kakeibo:monthly_balance', args=[year, month]),
+            reverse('kakeibo:monthly_balance_chart', args=[year, month]),
+            reverse('kakeibo:balance_transition'),
+            reverse('kakeibo:balance_transition_chart'),
+            reverse('kakeibo:asset_dashboard', args=[year, month]),
+            reverse('kakeibo:asset_allocation_chart', args=[year, month]),
+            reverse('kakeibo:asset_transition_chart'),
+        ]
+
+    @staticmethod
+    def run_wsgi(owner, requests, concurrency):
+        """スレッドごとにClientを作って、concurrency本並行してリクエストする"""
+        local = threading.local()
+
+        def fetch(url):
+            if not hasattr(local, 'client'):
+                local.client = Client()
+                local.client.force_login(owner)
+            start = time.perf_counter()
+            response = local.client.get(url)
+            return (time.perf_counter() - start) * 1000, response.status_code
+
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            results = list(executor.map(fetch, requests))
+        return [ms for ms, _ in results], sum(status != 200 for _, status in results)
+
+    @staticmethod
+    def run_asgi(owner, requests, concurrency):
+        """AsyncClientで、concurrency本並行してリクエストする"""
+        # force_login()は同期のORMを使うので、イベントループの外でログインしておく
+        client = AsyncClient()
+        client.force_login(owner)
+
+        async def run():
+            semaphore = asyncio.Semaphore(concurrency)
+
+            async def fetch(url):
+                async with semaphore:
+                    start = time.perf_counter()
+                    response = await client.get(url)
+                    return (time.perf_counter() - start) * 1000, response.status_code
+
+            return await asyncio.gather(*(fetch(url) for url in requests))
+
+        results = asyncio.run(run())
+        return [ms for ms, _ in results], sum(status != 200 for _, status in results)
@@ -0,0 +1,128 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import override_settings
+from kakeibo import views
+from kakeibo.benchmark import measure, make_request, render_view, build_report, write_report, \
+    load_report, compare_reports
+from kakeibo.forms import TransitionGraphSearchForm
+from kakeibo.models import Payment, Income, Asset, PaymentCategory, IncomeCategory, AssetCategory
+from kakeibo.plugins import get_owner
+from kakeibo.registry import get_registry, get_year_registry
+
+
+class Command(BaseCommand):
+    """ダッシュボードの集計と一覧ページの処理時間、クエリ数、ピークメモリを計測する"""
+    help = 'Benchmark the dashboard mixins and list views and write a JSON report.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=5, help='Timed runs per case.')
+        parser.add_argument('--backend', choices=('database', 'pandas'), default=None,
+                            help='Aggregation backend for the dashboards.')
+        parser.add_argument('--owner', default=None,
+                            help='Username whose ledger is measured. Defaults to the first superuser.')
+        parser.add_argument('--year', type=int, default=None)
+        parser.add_argument('--month', type=int, default=None)
+        parser.add_argument('--keyword', default='スーパー', help='Keyword for the search case.')
+        parser.add_argument('--only', default=None, help='Run only cases whose name contains this.')
+        parser.add_argument('--output', default=None, help='Write the JSON report to this path.')
+        parser.add_argument('--compare', default=None, help='Compare with a previous JSON report.')
+
+    def handle(self, *args, **options):
+        owner = get_owner(options['owner'])
+        if owner is None:
+            raise CommandError('No ledger owner. Run generate_ledger first.')
+        latest = Payment.objects.filter(owner=owner).order_by('-date').values_list('date', flat=True).first()
+        if latest is None:
+            raise CommandError(f'No payments for {owner.username}. Run generate_ledger first.')
+        year = options['year'] or latest.year
+        month = options['month'] or latest.month
+
+        overrides = {'KAKEIBO_CACHE_ENABLED': False}
+        if options['backend']:
+            overrides['KAKEIBO_AGGREGATION_BACKEND'] = options['backend']
+
+        # カテゴリのレジストリは常駐プロセスでは温まっているので、先に読み込んでおく
+        for model in (PaymentCategory, IncomeCategory, AssetCategory):
+            get_registry(model, owner.pk).choices()
+        get_year_registry(owner.pk).years()
+
+        results = {}
+        with override_settings(**overrides):
+            for name, func in self.get_cases(owner, year, month, options['keyword']):
+                if options['only'] and options['only'] not in name:
+                    continue
+                results[name] = result = measure(func, repeat=options['repeat'])
+                self.stdout.write(f"{name:<32} median={result['wall_ms']['median']:>9.2f}ms "
+                                  f"queries={result['queries']:>3} peak={result['peak_kib']:>9.1f}KiB")
+
+        report = build_report(
+            results,
+            owner=owner.username, year=year, month=month, repeat=options['repeat'],
+            backend=overrides.get('KAKEIBO_AGGREGATION_BACKEND', 'settings'),
+            rows={model.__name__: model.objects.filter(owner=owner).count() for model in (Payment, Income, Asset)},
+        )
+        if options['output']:
+            write_report(report, options['output'])
+            self.stdout.write(self.style.SUCCESS(f"Report written to {options['output']}"))
+
+        if options['compare']:
+            self.stdout.write('')
+            self.stdout.write(f"{'case':<32} {'before':>10} {'after':>10} {'ratio':>7} queries")
+            for name, before, after, ratio, before_q, after_q in compare_reports(
+                    load_report(options['compare']), report):
+                ratio = f'{ratio:.2f}x' if ratio is not None else '-'
+                self.stdout.write(f'{name:<32} {before:>8.2f}ms {after:>8.2f}ms {ratio:>7} '
+                                  f'{before_q}->{after_q}')
+
+    @staticmethod
+    def get_cases(owner, year, month, keyword):
+        """[(ケース名, 計測する関数),...]を返す"""
+
+        def mixin_case(view_class, method, params=None, **kwargs):
+            def run():
+                view = view_class()
+                view.setup(make_request('/', params, user=owner), **kwargs)
+                if method == 'get_balance_transition_data':
+                    return view.get_balance_transition_data(
+                        TransitionGraphSearchForm(params or None, owner_id=owner.pk))
+                if method == 'get_table_items':
+                    return view.get_table_items(view.get_month_pager_data())
+                return getattr(view, method)()
+            return run
+
+        def view_case(view_class, params=None, keyset=False):
+            def run():
+                with override_settings(KAKEIBO_KEYSET_PAGINATION=keyset):
+                    return render_view(view_class, make_request('/', params, user=owner))
+            return run
+
+        payment_category = PaymentCategory.objects.filter(owner=owner).order_by('pk') \
+            .values_list('pk', flat=True).first()
+        asset_category = AssetCategory.objects.filter(owner=owner).order_by('pk') \
+            .values_list('pk', flat=True).first()
+        by_month = {'year': year, 'month': month}
+
+        return [
+            ('monthly_balance', mixin_case(views.MonthlyBalance, 'get_monthly_balance_data',
+                                           year=year, month=month)),
+            ('balance_transition', mixin_case(views.TransitionView, 'get_balance_transition_data')),
+            ('balance_transition:category', mixin_case(views.TransitionView, 'get_balance_transition_data',
+                                                       {'payment_category': payment_category})),
+            ('asset_dashboard', mixin_case(views.AssetDashboard, 'get_asset_dash_data',
+                                           year=year, month=month)),
+            ('asset_dashboard:table', mixin_case(views.AssetDashboard, 'get_table_items',
+                                                 year=year, month=month)),
+            ('payment_list', view_case(views.PaymentList)),
+            ('payment_list:month', view_case(views.PaymentList, by_month)),
+            ('payment_list:category', view_case(views.PaymentList, {'search_category': payment_category})),
+            ('payment_list:amount', view_case(views.PaymentList, {'greater_than': 1000, 'less_than': 5000})),
+            ('payment_list:keyword', view_case(views.PaymentList, {'key_word': keyword})),
+            ('payment_list:keyset', view_case(views.PaymentList, keyset=True)),
+            ('payment_export:csv', view_case(views.PaymentExport)),
+            ('payment_export:json', view_case(views.PaymentExport, {'format': 'json'})),
+            ('payment_export:month', view_case(views.PaymentExport, by_month)),
+            ('income_list', view_case(views.IncomeList)),
+            ('income_list:month', view_case(views.IncomeList, by_month)),
+            ('asset_list', view_case(views.AssetList)),
+            ('asset_list:month', view_case(views.AssetList, by_month)),
+            ('asset_list:category', view_case(views.AssetList, {'search_category': asset_category})),
+        ]
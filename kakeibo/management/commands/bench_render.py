@@ -0,0 +1,96 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.template import engines
+from django.template.loader import get_template
+from django.template.loaders.cached import Loader as CachedLoader
+from django.test.utils import override_settings
+from kakeibo import views
+from kakeibo.benchmark import measure, make_request, build_report, write_report
+from kakeibo.plugins import get_owner
+
+# (テンプレートの部分の名前, 一覧のビュー, テーブルで使うcontextの名前)
+TABLES = (
+    ('payment_table', views.PaymentList, 'payment_list'),
+    ('income_table', views.IncomeList, 'income_list'),
+    ('asset_table', views.AssetList, 'asset_list'),
+)
+
+# {% ledger_fragment %}で囲んだテーブル。一覧のテンプレートと同じ形にする
+FRAGMENT_TEMPLATE = '{% load kakeibo %}{% ledger_fragment name %}{% include template_name %}{% endledger_fragment %}'
+
+# 描画結果のキャッシュは、本来のキャッシュと統計を汚さないようにプロセス内の別のキャッシュに入れる
+BENCH_CACHE_ALIAS = 'bench_render'
+
+
+class Command(BaseCommand):
+    """
+    一覧のテーブルの描画時間を、明細を読み込むクエリと分けて計測する
+    テーブルごと、行数ごとに、クエリ(query)、読み込み済みの明細での描画(render)、
+    描画結果のキャッシュからの取得(fragment)の時間を測る。テンプレートの読み込み(load)は行数によらない
+    """
+    help = 'Benchmark rendering of the list tables separately from the queries that feed them.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--owner', default=None,
+                            help='Username whose ledger is rendered. Defaults to the first superuser.')
+        parser.add_argument('--repeat', type=int, default=20, help='Timed runs per case.')
+        parser.add_argument('--rows', type=int, nargs='+', default=[10, 500], help='Rows per table.')
+        parser.add_argument('--only', default=None, help='Run only cases whose name contains this.')
+        parser.add_argument('--output', default=None, help='Write the JSON report to this path.')
+
+    def handle(self, *args, **options):
+        owner = get_owner(options['owner'])
+        if owner is None:
+            raise CommandError('No ledger owner. Run generate_ledger first.')
+
+        caches = {**settings.CACHES, BENCH_CACHE_ALIAS: {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': BENCH_CACHE_ALIAS}}
+        results = {}
+        with override_settings(CACHES=caches, KAKEIBO_CACHE_ALIAS=BENCH_CACHE_ALIAS, KAKEIBO_CACHE_ENABLED=True):
+            for name, func in self.get_cases(owner, options['rows']):
+                if options['only'] and options['only'] not in name:
+                    continue
+                results[name] = result = measure(func, repeat=options['repeat'])
+                self.stdout.write(f"{name:<32} median={result['wall_ms']['median']:>9.3f}ms "
+                                  f"queries={result['queries']:>3} peak={result['peak_kib']:>9.1f}KiB")
+
+        if options['output']:
+            engine = engines['django'].engine
+            report = build_report(
+                results, owner=owner.username, repeat=options['repeat'], rows=options['rows'],
+                cached_loader=any(isinstance(loader, CachedLoader) for loader in engine.template_loaders),
+            )
+            write_report(report, options['output'])
+            self.stdout.write(self.style.SUCCESS(f"Report written to {options['output']}"))
+
+    @staticmethod
+    def get_cases(owner, sizes):
+        """[(ケース名, 計測する関数),...]を返す"""
+        wrapper = engines['django'].from_string(FRAGMENT_TEMPLATE)
+
+        def query_case(queryset, size):
+            return lambda: list(queryset[:size])
+
+        def render_case(template, context):
+            return lambda: template.render(context)
+
+        cases = []
+        for fragment, view_class, context_name in TABLES:
+            template_name = f'kakeibo/components/{fragment}.html'
+            view = view_class()
+            view.setup(make_request('/', user=owner))
+            queryset = view.get_queryset()
+            template = get_template(template_name)
+
+            cases.append((f'{fragment}:load', lambda template_name=template_name: get_template(template_name)))
+            for size in sizes:
+                rows = list(queryset[:size])
+                cases += [
+                    (f'{fragment}:{size}:query', query_case(queryset, size)),
+                    (f'{fragment}:{size}:render', render_case(template, {context_name: rows})),
+                    # 1回目(ウォームアップ)でキャッシュされ、計測するのはヒットした場合
+                    (f'{fragment}:{size}:fragment', render_case(wrapper, {
+                        context_name: rows, 'name': fragment, 'template_name': template_name,
+                        'fragment_digest': f'bench-{owner.pk}-{size}'})),
+                ]
+        return cases
@@ -0,0 +1,135 @@
+import threading
+import time
+from contextlib import contextmanager
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, close_old_connections, connections
+from django.test.utils import override_settings
+from kakeibo import views
+from kakeibo.benchmark import make_request, render_view, latency_summary, build_report, write_report
+from kakeibo.models import Payment, PaymentCategory
+from kakeibo.plugins import get_owner
+from kakeibo.sqlite_profile import DEFAULT_PRAGMAS, get_connection_pragmas
+
+# (プロファイル名, PRAGMA, CONN_MAX_AGE)
+# defaultはDjangoの既定の接続(ロールバックジャーナル、リクエストごとの接続)
+PROFILES = (
+    ('default', {'journal_mode': 'delete'}, 0),
+    ('tuned', DEFAULT_PRAGMAS, 60),
+)
+
+# ベンチマークで登録する明細の摘要。終わったらこの摘要の明細を削除する
+BENCH_DESCRIPTION = 'bench_sqlite'
+
+
+class Command(BaseCommand):
+    """
+    ダッシュボードの読み込みと明細の登録を同時に行って、SQLiteの接続設定ごとに
+    スループット、レイテンシとロックエラーの数を比べる
+    リクエストの終わりと同じように、1回ごとにclose_old_connections()を呼ぶ
+    """
+    help = 'Compare read/write throughput and "database is locked" errors per SQLite connection profile.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--owner', default=None,
+                            help='Username whose ledger is used. Defaults to the first superuser.')
+        parser.add_argument('--readers', type=int, default=4, help='Reader threads.')
+        parser.add_argument('--writers', type=int, default=2, help='Writer threads.')
+        parser.add_argument('--seconds', type=float, default=5, help='Duration per profile.')
+        parser.add_argument('--only', default=None, help='Run only profiles whose name contains this.')
+        parser.add_argument('--output', default=None, help='Write the JSON report to this path.')
+
+    def handle(self, *args, **options):
+        if connections['default'].vendor != 'sqlite':
+            raise CommandError('This benchmark is for SQLite.')
+        owner = get_owner(options['owner'])
+        if owner is None:
+            raise CommandError('No ledger owner. Run generate_ledger first.')
+        latest = Payment.objects.filter(owner=owner).order_by('-date').values_list('date', flat=True).first()
+        category = PaymentCategory.objects.filter(owner=owner).order_by('pk').first()
+        if latest is None or category is None:
+            raise CommandError(f'No payments for {owner.username}. Run generate_ledger first.')
+
+        results = {}
+        for name, pragmas, conn_max_age in PROFILES:
+            if options['only'] and options['only'] not in name:
+                continue
+            with self.profile(pragmas, conn_max_age):
+                result = self.run(owner, category, latest, options)
+                result['pragmas'] = get_connection_pragmas(connections['default'], DEFAULT_PRAGMAS.keys())
+            Payment.objects.filter(owner=owner, description=BENCH_DESCRIPTION).delete()
+
+            results[name] = result
+            self.stdout.write(
+                f"{name:<8} reads={result['reads']['rps']:>7.1f}/s p99={result['reads']['p99_ms']:>8.2f}ms "
+                f"writes={result['writes']['rps']:>7.1f}/s p99={result['writes']['p99_ms']:>8.2f}ms "
+                f"locked={result['lock_errors']}")
+
+        if options['output']:
+            report = build_report(results, owner=owner.username, readers=options['readers'],
+                                  writers=options['writers'], seconds=options['seconds'])
+            write_report(report, options['output'])
+            self.stdout.write(self.style.SUCCESS(f"Report written to {options['output']}"))
+
+    @staticmethod
+    @contextmanager
+    def profile(pragmas, conn_max_age):
+        """PRAGMAとCONN_MAX_AGEを変えて、新しい接続から使わせる"""
+        connections.close_all()
+        previous = connections.settings['default']['CONN_MAX_AGE']
+        connections.settings['default']['CONN_MAX_AGE'] = conn_max_age
+        try:
+            with override_settings(KAKEIBO_SQLITE_PRAGMAS=pragmas, KAKEIBO_CACHE_ENABLED=False):
+                yield
+        finally:
+            connections.close_all()
+            connections.settings['default']['CONN_MAX_AGE'] = previous
+
+    @staticmethod
+    def run(owner, category, latest, options):
+        """読み込みと書き込みのスレッドをoptions['seconds']秒動かして結果を返す"""
+        reads = views.MonthlyBalanceChart, views.TransitionChart, views.PaymentList
+        kwargs = ({'year': latest.year, 'month': latest.month}, {}, {})
+        deadline = time.perf_counter() + options['seconds']
+        lock = threading.Lock()
+        timings = {'reads': [], 'writes': []}
+        errors = []
+
+        def work(kind, i):
+            n = 0
+            while time.perf_counter() < deadline:
+                start = time.perf_counter()
+                try:
+                    if kind == 'reads':
+                        view = reads[(i + n) % len(reads)]
+                        render_view(view, make_request('/', user=owner), **kwargs[(i + n) % len(reads)])
+                    else:
+                        Payment.objects.create(date=latest, amount=1, category=category,
+                                               description=BENCH_DESCRIPTION)
+                    ms = (time.perf_counter() - start) * 1000
+                    with lock:
+                        timings[kind].append(ms)
+                except OperationalError as e:
+                    if 'locked' not in str(e):
+                        raise
+                    with lock:
+                        errors.append(kind)
+                finally:
+                    close_old_connections()
+                n += 1
+            connections.close_all()
+
+        threads = [threading.Thread(target=work, args=('reads', i)) for i in range(options['readers'])]
+        threads += [threading.Thread(target=work, args=('writes', i)) for i in range(options['writers'])]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        result = {kind: latency_summary(values or [0.0], elapsed) for kind, values in timings.items()}
+        for kind, values in timings.items():
+            result[kind]['count'] = len(values)
+            result[kind]['rps'] = round(len(values) / elapsed, 1)
+        result['lock_errors'] = len(errors)
+        return result
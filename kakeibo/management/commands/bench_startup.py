@@ -0,0 +1,104 @@
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.urls import reverse
+from kakeibo.benchmark import build_report, write_report, load_report, compare_reports
+from kakeibo.models import Payment
+from kakeibo.plugins import get_owner
+
+
+class Command(BaseCommand):
+    """
+    ワーカープロセスが起動してから最初のレスポンスを返すまでの時間をURLごとに計測する
+    URLごとに新しいプロセスを起動し、django.setup()と最初のリクエストの時間を分けて測る
+    """
+    help = 'Measure django.setup() and the first request to each URL in fresh processes.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--repeat', type=int, default=3, help='Fresh processes per URL.')
+        parser.add_argument('--owner', default=None,
+                            help='Username to log in as. Defaults to the first superuser.')
+        parser.add_argument('--only', default=None, help='Run only cases whose name contains this.')
+        parser.add_argument('--output', default=None, help='Write the JSON report to this path.')
+        parser.add_argument('--compare', default=None, help='Compare with a previous JSON report.')
+
+    def handle(self, *args, **options):
+        owner = get_owner(options['owner'])
+        if owner is None:
+            raise CommandError('No ledger owner. Run generate_ledger first.')
+        latest = Payment.objects.filter(owner=owner).order_by('-date').values_list('date', flat=True).first()
+        if latest is None:
+            raise CommandError(f'No payments for {owner.username}. Run generate_ledger first.')
+
+        results = {}
+        for name, url in self.get_cases(latest.year, latest.month):
+            if options['only'] and options['only'] not in name:
+                continue
+            runs = [self.probe(url, owner.username) for _ in range(options['repeat'])]
+            failed = [run for run in runs if run['status'] != 200]
+            if failed:
+                raise CommandError(f"{name}: status {failed[0]['status']}")
+
+            results[name] = result = {
+                key: {'median': round(statistics.median(run[key] for run in runs), 3),
+                      'max': round(max(run[key] for run in runs), 3)}
+                for key in ('process_ms', 'setup_ms', 'first_request_ms')
+            }
+            # compare_reportsで比べられるように、起動から最初のレスポンスまでをwall_msにする
+            result['wall_ms'] = result['process_ms']
+            result['queries'] = None
+            result['loaded_at_setup'] = runs[0]['loaded_at_setup']
+            result['loaded_after_request'] = runs[0]['loaded_after_request']
+            self.stdout.write(f"{name:<28} process={result['process_ms']['median']:>8.1f}ms "
+                              f"setup={result['setup_ms']['median']:>7.1f}ms "
+                              f"first={result['first_request_ms']['median']:>7.1f}ms "
+                              f"loaded={','.join(result['loaded_after_request']) or '-'}")
+
+        report = build_report(results, owner=owner.username, repeat=options['repeat'],
+                              python_executable=sys.executable)
+        if options['output']:
+            write_report(report, options['output'])
+            self.stdout.write(self.style.SUCCESS(f"Report written to {options['output']}"))
+
+        if options['compare']:
+            self.stdout.write('')
+            self.stdout.write(f"{'case':<28} {'before':>10} {'after':>10} {'ratio':>7}")
+            for name, before, after, ratio, _, _ in compare_reports(load_report(options['compare']), report):
+                ratio = f'{ratio:.2f}x' if ratio is not None else '-'
+                self.stdout.write(f'{name:<28} {before:>8.1f}ms {after:>8.1f}ms {ratio:>7}')
+
+    @staticmethod
+    def get_cases(year, month):
+        """[(ケース名, URL),...]を返す"""
+        return [
+            ('payment_list', reverse('kakeibo:payment_list')),
+            ('income_list', reverse('kakeibo:income_list')),
+            ('asset_list', reverse('kakeibo:asset_list')),
+            ('payment_export', reverse('kakeibo:payment_export') + f'?year={year}&month={month}'),
+            ('monthly_balance', reverse('kakeibo:monthly_balance', args=[year, month])),
+            ('monthly_balance_chart', reverse('kakeibo:monthly_balance_chart', args=[year, month])),
+            ('balance_transition', reverse('kakeibo:balance_transition')),
+            ('balance_transition_chart', reverse('kakeibo:balance_transition_chart')),
+            ('asset_dashboard', reverse('kakeibo:asset_dashboard', args=[year, month])),
+            ('asset_allocation_chart', reverse('kakeibo:asset_allocation_chart', args=[year, month])),
+            ('asset_transition_chart', reverse('kakeibo:asset_transition_chart')),
+        ]
+
+    @staticmethod
+    def probe(url, username):
+        """新しいプロセスでusernameとしてstartup_probeを実行して、結果に起動からの時間を加えて返す"""
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE=os.environ.get('DJANGO_SETTINGS_MODULE', 'project.settings'))
+        start = time.perf_counter()
+        completed = subprocess.run([sys.executable, '-m', 'kakeibo.startup_probe', url, username],
+                                   cwd=settings.BASE_DIR, env=env, capture_output=True, text=True, check=False)
+        process_ms = (time.perf_counter() - start) * 1000
+        if completed.returncode:
+            raise CommandError(completed.stderr.strip().splitlines()[-1] if completed.stderr else url)
+        result = json.loads(completed.stdout.strip().splitlines()[-1])
+        result['process_ms'] = round(process_ms, 3)
+        return result
@@ -0,0 +1,228 @@
+import calendar
+import datetime
+import math
+import random
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from kakeibo.cache import bump_ledger_version
+from kakeibo.models import Payment, PaymentCategory, Income, IncomeCategory, Asset, AssetCategory
+from kakeibo.plugins import get_owner
+from kakeibo.summary import rebuild_monthly_totals
+
+# カテゴリ名、月あたりの件数の重み、金額の中央値、ばらつき(対数正規分布のσ)
+PAYMENT_PROFILES = [
+    ('食費', 30, 1200, 0.8),
+    ('日用品', 8, 900, 0.7),
+    ('住宅', 1, 80000, 0.1),
+    ('水道光熱 / 通信', 4, 7000, 0.4),
+    ('交通', 6, 600, 0.9),
+    ('健康 / 医療', 2, 3000, 1.0),
+    ('趣味 / 娯楽', 5, 4000, 1.1),
+    ('交際費', 3, 5000, 0.8),
+    ('衣服 / 美容', 2, 6000, 0.9),
+    ('教育 / 教養', 2, 2500, 0.8),
+    ('旅行', 1, 40000, 0.9),
+    ('その他', 3, 2000, 1.2),
+]
+
+DESCRIPTION_WORDS = {
+    '食費': ['スーパー', 'コンビニ', 'ランチ', 'ディナー', 'カフェ', 'パン屋', '八百屋'],
+    '日用品': ['ドラッグストア', '洗剤', 'ティッシュ', '100円ショップ'],
+    '住宅': ['家賃', '管理費'],
+    '水道光熱 / 通信': ['電気代', 'ガス代', '水道代', '携帯電話', 'インターネット'],
+    '交通': ['電車', 'バス', 'タクシー', 'ガソリン', '駐車場'],
+    '健康 / 医療': ['病院', '薬局', '歯医者', 'ジム'],
+    '趣味 / 娯楽': ['書籍', '映画', 'ゲーム', 'コンサート', '音楽配信'],
+    '交際費': ['飲み会', 'プレゼント', 'ご祝儀'],
+    '衣服 / 美容': ['美容院', 'シャツ', '靴', 'クリーニング'],
+    '教育 / 教養': ['参考書', 'オンライン講座', 'セミナー'],
+    '旅行': ['ホテル', '新幹線', '航空券', 'お土産'],
+    'その他': ['手数料', '寄付', '雑費'],
+}
+
+INCOME_CATEGORIES = ['給与', '賞与', '副業', 'その他']
+ASSET_CATEGORIES = ['普通預金', '定期預金', '投資信託', '株式', '現金']
+
+
+class Command(BaseCommand):
+    """
+    ベンチマーク用の再現可能な家計簿データを作成する
+    --ownerを変えて繰り返すと、1つのデータベースに複数の世帯の家計簿を作れる
+    """
+    help = 'Generate a reproducible synthetic ledger with bulk_create.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--payments', type=int, default=10000,
+                            help='Number of payments to generate (10k to 10M).')
+        parser.add_argument('--years', type=int, default=5, help='Years of history.')
+        parser.add_argument('--end', default=None,
+                            help='Last month of the history as YYYY-MM. Defaults to the current month.')
+        parser.add_argument('--payment-categories', type=int, default=len(PAYMENT_PROFILES),
+                            help='Number of payment categories.')
+        parser.add_argument('--asset-categories', type=int, default=len(ASSET_CATEGORIES),
+                            help='Number of asset categories.')
+        parser.add_argument('--owner', default=None,
+                            help='Username of the ledger owner. Created if missing. '
+                                 'Defaults to the first superuser.')
+        parser.add_argument('--seed', type=int, default=0, help='Random seed.')
+        parser.add_argument('--batch-size', type=int, default=5000)
+        parser.add_argument('--clear', action='store_true',
+                            help="Delete the owner's existing payments, incomes and assets first.")
+
+    def handle(self, *args, **options):
+        rnd = random.Random(options['seed'])
+        end = self.parse_end(options['end'])
+        months = self.get_months(end, options['years'])
+        owner = self.get_or_create_owner(options['owner'])
+
+        if options['clear']:
+            # シグナルを飛ばさずに消して、最後に集計を作り直す
+            with transaction.atomic(), connection.cursor() as cursor:
+                for model in (Payment, Income, Asset):
+                    cursor.execute(f'DELETE FROM {connection.ops.quote_name(model._meta.db_table)} '
+                                   f'WHERE owner_id = %s', [owner.pk])
+
+        payment_categories = self.get_categories(
+            PaymentCategory, owner, [profile[0] for profile in PAYMENT_PROFILES], options['payment_categories'])
+        income_categories = self.get_categories(IncomeCategory, owner, INCOME_CATEGORIES, len(INCOME_CATEGORIES))
+        asset_categories = self.get_categories(AssetCategory, owner, ASSET_CATEGORIES, options['asset_categories'])
+
+        batch_size = options['batch_size']
+        created = self.bulk_insert(Payment, self.generate_payments(rnd, months, payment_categories,
+                                                                   options['payments']), batch_size)
+        self.stdout.write(f'Payments: {created}')
+        created = self.bulk_insert(Income, self.generate_incomes(rnd, months, income_categories), batch_size)
+        self.stdout.write(f'Incomes: {created}')
+        created = self.bulk_insert(Asset, self.generate_assets(rnd, months, asset_categories), batch_size)
+        self.stdout.write(f'Assets: {created}')
+
+        # bulk_createではシグナルが飛ばないので、集計とキャッシュをまとめて更新する
+        rebuild_monthly_totals(owner_id=owner.pk)
+        bump_ledger_version(Payment, Income, Asset, PaymentCategory, IncomeCategory, AssetCategory,
+                            owner_id=owner.pk)
+        self.stdout.write(self.style.SUCCESS(f'Generated {len(months)} months of ledger for {owner.username}.'))
+
+    @staticmethod
+    def get_or_create_owner(username):
+        """家計簿の所有者を返す。usernameのユーザーがいなければログインできないユーザーとして作る"""
+        owner = get_owner(username)
+        if owner is not None:
+            return owner
+        if not username:
+            raise CommandError('No superuser. Run createsuperuser or pass --owner.')
+        owner = get_user_model()(username=username)
+        owner.set_unusable_password()
+        owner.save()
+        return owner
+
+    @staticmethod
+    def parse_end(value):
+        if not value:
+            today = datetime.date.today()
+            return today.year, today.month
+        try:
+            year, month = map(int, value.split('-'))
+        except ValueError:
+            raise CommandError('--end must be YYYY-MM')
+        return year, month
+
+    @staticmethod
+    def get_months(end, years):
+        """古い順に(年, 月)のリストを返す"""
+        year, month = end
+        months = []
+        for _ in range(years * 12):
+            months.append((year, month))
+            year, month = (year - 1, 12) if month == 1 else (year, month - 1)
+        return months[::-1]
+
+    @staticmethod
+    def get_categories(model, owner, names, count):
+        """所有者のカテゴリを必要な数だけ用意して、作成順に返す"""
+        names = list(names)
+        while len(names) < count:
+            names.append(f'カテゴリ{len(names) + 1:02d}')
+        categories = []
+        for name in names[:count]:
+            category = model.objects.filter(owner=owner, name=name).order_by('pk').first()
+            categories.append(category or model.objects.create(owner=owner, name=name))
+        return categories
+
+    @staticmethod
+    def bulk_insert(model, objs, batch_size):
+        created = 0
+        batch = []
+        for obj in objs:
+            batch.append(obj)
+            if len(batch) >= batch_size:
+                with transaction.atomic():
+                    model.objects.bulk_create(batch, batch_size=batch_size)
+                created += len(batch)
+                batch = []
+        if batch:
+            with transaction.atomic():
+                model.objects.bulk_create(batch, batch_size=batch_size)
+            created += len(batch)
+        return created
+
+    @staticmethod
+    def generate_payments(rnd, months, categories, count):
+        """カテゴリごとの頻度と金額の分布に従って支出を作る"""
+        profiles = []
+        for i, category in enumerate(categories):
+            name, weight, median, sigma = PAYMENT_PROFILES[i % len(PAYMENT_PROFILES)]
+            words = DESCRIPTION_WORDS.get(category.name) or DESCRIPTION_WORDS[name]
+            profiles.append((category, weight, median, sigma, words))
+        weights = [profile[1] for profile in profiles]
+
+        per_month, remainder = divmod(count, len(months))
+        for index, (year, month) in enumerate(months):
+            days = calendar.monthrange(year, month)[1]
+            n = per_month + (1 if index < remainder else 0)
+            for profile in rnd.choices(profiles, weights=weights, k=n):
+                category, _, median, sigma, words = profile
+                amount = max(1, int(round(rnd.lognormvariate(math.log(median), sigma), -1)))
+                description = rnd.choice(words)
+                if rnd.random() < 0.3:
+                    description += ' ' + rnd.choice(words)
+                yield Payment(date=datetime.date(year, month, rnd.randint(1, days)),
+                              amount=amount, category=category, owner_id=category.owner_id,
+                              description=description)
+
+    @staticmethod
+    def generate_incomes(rnd, months, categories):
+        """毎月の給与、年2回の賞与、たまの副業収入を作る"""
+        salary = 300000
+        for year, month in months:
+            if month == 4:
+                salary = int(salary * rnd.uniform(1.0, 1.04))
+            yield Income(date=datetime.date(year, month, 25), amount=salary,
+                         category=categories[0], owner_id=categories[0].owner_id, description='給与')
+            if month in (6, 12):
+                yield Income(date=datetime.date(year, month, 10), amount=salary * 2,
+                             category=categories[1], owner_id=categories[1].owner_id, description='賞与')
+            if rnd.random() < 0.3:
+                yield Income(date=datetime.date(year, month, rnd.randint(1, 28)),
+                             amount=int(rnd.lognormvariate(math.log(30000), 0.6)),
+                             category=categories[2], owner_id=categories[2].owner_id, description='副業')
+
+    @staticmethod
+    def generate_assets(rnd, months, categories):
+        """
+        資産カテゴリごとに月末の残高をランダムウォークで作る
+        資産はカテゴリごとに月1件なので、登録済みの月は飛ばす
+        """
+        registered = set(Asset.objects.filter(category__in=categories).values_list('category_id', 'month'))
+        balances = [rnd.randint(100000, 3000000) for _ in categories]
+        for year, month in months:
+            day = calendar.monthrange(year, month)[1]
+            for i, category in enumerate(categories):
+                balances[i] = max(0, int(balances[i] * rnd.uniform(0.97, 1.05)))
+                if (category.pk, datetime.date(year, month, 1)) in registered:
+                    continue
+                asset = Asset(date=datetime.date(year, month, day), amount=balances[i],
+                              category=category, description='月末残高')
+                asset.set_month()
+                asset.set_owner()
+                yield asset
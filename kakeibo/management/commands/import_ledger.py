@@ -0,0 +1,60 @@
+from django.core.management.base import BaseCommand, CommandError
+from kakeibo.importer import import_csv
+from kakeibo.models import Payment, Income, Asset
+from kakeibo.plugins import get_owner
+
+LEDGER_MODELS = {
+    'payment': Payment,
+    'income': Income,
+    'asset': Asset,
+}
+
+
+class Command(BaseCommand):
+    """CSVの明細をチャンクごとにbulk_createで取り込む"""
+    help = 'Stream a CSV (date, amount, category, description) into the ledger with bulk_create.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('kind', choices=LEDGER_MODELS.keys())
+        parser.add_argument('path', help='CSV file. Category may be a name or a pk.')
+        parser.add_argument('--owner', default=None,
+                            help='Username of the ledger owner. Defaults to the first superuser.')
+        parser.add_argument('--encoding', default='utf-8-sig', help='For example cp932 for bank exports.')
+        parser.add_argument('--chunk-size', type=int, default=None)
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--workers', type=int, default=None,
+                            help='Parse chunks in this many processes.')
+        parser.add_argument('--dry-run', action='store_true', help='Validate only.')
+        parser.add_argument('--max-errors', type=int, default=100,
+                            help='Number of row errors to print.')
+
+    def handle(self, *args, **options):
+        def progress(result):
+            self.stdout.write(f'{result.rows} rows read, {result.created} created, '
+                              f'{result.error_count} errors')
+
+        owner = get_owner(options['owner'])
+        if owner is None:
+            raise CommandError(f"No user named {options['owner']}." if options['owner']
+                               else 'No superuser. Run createsuperuser or pass --owner.')
+
+        try:
+            with open(options['path'], 'rb') as f:
+                result = import_csv(LEDGER_MODELS[options['kind']], f, owner.pk,
+                                    encoding=options['encoding'],
+                                    chunk_size=options['chunk_size'],
+                                    batch_size=options['batch_size'],
+                                    workers=options['workers'],
+                                    dry_run=options['dry_run'],
+                                    progress=progress if options['verbosity'] else None)
+        except (OSError, ValueError) as e:
+            raise CommandError(e)
+
+        for line, message in result.errors[:options['max_errors']]:
+            self.stderr.write(f'line {line}: {message}')
+        if result.error_count > options['max_errors']:
+            self.stderr.write(f'... and {result.error_count - options["max_errors"]} more errors')
+
+        style = self.style.WARNING if result.errors else self.style.SUCCESS
+        self.stdout.write(style(f'Imported {result.created} of {result.rows} rows '
+                                f'({result.error_count} errors).'))
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+from kakeibo.cache import get_cache_stats
+
+
+class Command(BaseCommand):
+    """ダッシュボードのキャッシュと、テーブルの描画結果のキャッシュのヒット、ミスの回数を表示する"""
+    help = 'Show hit/miss counters of the dashboard context cache and the table fragment cache.'
+
+    def handle(self, *args, **options):
+        fragments = ('payment_table', 'income_table', 'asset_table', 'monthly_balance_table', 'asset_dash_table')
+        stats = get_cache_stats('MonthlyBalance', 'TransitionView', 'AssetDashboard',
+                                *(f'fragment:{name}' for name in fragments))
+        for name, counts in stats.items():
+            total = counts['hits'] + counts['misses']
+            ratio = 100 * counts['hits'] / total if total else 0
+            self.stdout.write(f"{name}: hits={counts['hits']} misses={counts['misses']} ({ratio:.1f}% hit)")
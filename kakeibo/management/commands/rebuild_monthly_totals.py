@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand, CommandError
+from kakeibo.plugins import get_owner
+from kakeibo.summary import rebuild_monthly_totals, find_drift
+
+
+class Command(BaseCommand):
+    """月・カテゴリごとの集計テーブルを作り直す"""
+    help = 'Rebuild the monthly category totals table from the ledger, or check it for drift.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--check', action='store_true',
+                            help='Only report drift between the ledger and the totals table.')
+        parser.add_argument('--owner', default=None,
+                            help="Username. Only rebuild or check this user's totals.")
+
+    def handle(self, *args, **options):
+        owner_id = None
+        if options['owner']:
+            owner = get_owner(options['owner'])
+            if owner is None:
+                raise CommandError(f"No user named {options['owner']}.")
+            owner_id = owner.pk
+
+        if options['check']:
+            drift = find_drift(owner_id=owner_id)
+            for kind, (owner_pk, year, month, category_pk), expected, stored in drift:
+                category = f' category={category_pk}' if category_pk is not None else ''
+                self.stdout.write(f'{kind} owner={owner_pk} {year}-{month:02d}{category}: '
+                                  f'expected={expected} stored={stored}')
+            if drift:
+                raise CommandError(f'{len(drift)} monthly totals are out of sync. '
+                                   f'Run rebuild_monthly_totals to fix them.')
+            self.stdout.write(self.style.SUCCESS('Monthly totals are in sync.'))
+            return
+
+        created = rebuild_monthly_totals(owner_id=owner_id)
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt {created} monthly totals.'))
@@ -0,0 +1,52 @@
+# Generated by Django 3.2.8 on 2026-10-17 12:25
+
+from django.db import migrations, models
+from django.db.models import Count, Sum
+from django.db.models.functions import ExtractMonth, ExtractYear
+
+
+def build_monthly_totals(apps, schema_editor):
+    """既存の明細から集計テーブルを作成する"""
+    MonthlyTotal = apps.get_model('kakeibo', 'MonthlyTotal')
+    objs = []
+    for model_name, kind in (('Payment', 'payment'), ('Income', 'income'), ('Asset', 'asset')):
+        model = apps.get_model('kakeibo', model_name)
+        rows = model.objects.annotate(
+            year=ExtractYear('date'),
+            month=ExtractMonth('date'),
+        ).values('year', 'month', 'category_id').annotate(
+            total=Sum('amount'),
+            count=Count('id'),
+        ).order_by()
+        for row in rows:
+            objs.append(MonthlyTotal(year=row['year'], month=row['month'], kind=kind,
+                                     category_pk=row['category_id'],
+                                     total=row['total'], count=row['count']))
+    MonthlyTotal.objects.bulk_create(objs, batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kakeibo', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MonthlyTotal',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('year', models.IntegerField(verbose_name='年')),
+                ('month', models.IntegerField(verbose_name='月')),
+                ('kind', models.CharField(choices=[('payment', 'Payment'), ('income', 'Income'), ('asset', 'Asset')], max_length=8, verbose_name='種別')),
+                ('category_pk', models.BigIntegerField(verbose_name='カテゴリID')),
+                ('total', models.BigIntegerField(default=0, verbose_name='合計')),
+                ('count', models.IntegerField(default=0, verbose_name='件数')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='monthlytotal',
+            constraint=models.UniqueConstraint(fields=('year', 'month', 'kind', 'category_pk'), name='unique_monthly_total'),
+        ),
+        migrations.RunPython(build_monthly_totals, migrations.RunPython.noop),
+    ]
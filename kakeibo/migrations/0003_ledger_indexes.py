@@ -0,0 +1,49 @@
+# Generated by Django 3.2.8 on 2026-10-17 12:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kakeibo', '0002_monthlytotal'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='asset',
+            index=models.Index(fields=['date'], name='asset_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='asset',
+            index=models.Index(fields=['category', 'date'], name='asset_category_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='asset',
+            index=models.Index(fields=['date', 'amount'], name='asset_date_amount_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='income',
+            index=models.Index(fields=['date'], name='income_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='income',
+            index=models.Index(fields=['category', 'date'], name='income_category_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='income',
+            index=models.Index(fields=['date', 'amount'], name='income_date_amount_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(fields=['date'], name='payment_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(fields=['category', 'date'], name='payment_category_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(fields=['date', 'amount'], name='payment_date_amount_idx'),
+        ),
+    ]
@@ -0,0 +1,22 @@
+from django.db import migrations
+
+
+def create_fulltext_index(apps, schema_editor):
+    from kakeibo.fulltext import ensure_fulltext_index
+    ensure_fulltext_index(schema_editor.connection)
+
+
+def drop_fulltext_index(apps, schema_editor):
+    from kakeibo.fulltext import drop_fulltext_index
+    drop_fulltext_index(schema_editor.connection)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kakeibo', '0003_ledger_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_fulltext_index, drop_fulltext_index),
+    ]
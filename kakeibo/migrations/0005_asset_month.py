@@ -0,0 +1,40 @@
+from django.db import migrations, models
+from django.db.models.functions import TruncMonth
+
+
+def populate_month(apps, schema_editor):
+    """既存の資産にmonthを設定し、同じ月、同じカテゴリの重複がないか確認する"""
+    Asset = apps.get_model('kakeibo', 'Asset')
+    Asset.objects.update(month=TruncMonth('date'))
+
+    duplicates = list(Asset.objects.values('category_id', 'month').annotate(
+        count=models.Count('id')).filter(count__gt=1).values_list('category_id', 'month'))
+    if duplicates:
+        rows = ', '.join(f'category={category_pk} month={month:%Y-%m}' for category_pk, month in duplicates)
+        raise RuntimeError(f'Assets are registered more than once in the same month ({rows}). '
+                           f'Delete the duplicates in the admin before migrating.')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kakeibo', '0004_description_fulltext'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='asset',
+            name='month',
+            field=models.DateField(editable=False, null=True, verbose_name='月'),
+        ),
+        migrations.RunPython(populate_month, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='asset',
+            name='month',
+            field=models.DateField(editable=False, verbose_name='月'),
+        ),
+        migrations.AddConstraint(
+            model_name='asset',
+            constraint=models.UniqueConstraint(fields=('category', 'month'), name='unique_asset_month'),
+        ),
+    ]
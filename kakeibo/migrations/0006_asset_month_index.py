@@ -0,0 +1,17 @@
+# Generated by Django 3.2.8 on 2026-10-17 12:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kakeibo', '0005_asset_month'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='asset',
+            index=models.Index(fields=['month', 'category', 'amount'], name='asset_month_category_idx'),
+        ),
+    ]
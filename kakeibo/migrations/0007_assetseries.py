@@ -0,0 +1,46 @@
+# Generated by Django 3.2.8 on 2026-10-17 12:49
+
+import math
+from django.db import migrations, models
+from django.db.models import Count, Sum
+
+
+def build_asset_series(apps, schema_editor):
+    """既存の資産から月ごとの合計と前月比を作成する"""
+    Asset = apps.get_model('kakeibo', 'Asset')
+    AssetSeries = apps.get_model('kakeibo', 'AssetSeries')
+    rows = Asset.objects.values('month').annotate(total=Sum('amount'), count=Count('id')).order_by('month')
+
+    objs = []
+    prev_total = None
+    for row in rows:
+        if prev_total is None or (prev_total == 0 and row['total'] == 0):
+            change = 0.0
+        elif prev_total == 0:
+            change = math.copysign(math.inf, row['total'])
+        else:
+            change = row['total'] / prev_total - 1
+        objs.append(AssetSeries(month=row['month'], total=row['total'], count=row['count'], change=change))
+        prev_total = row['total']
+    AssetSeries.objects.bulk_create(objs, batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('kakeibo', '0006_asset_month_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AssetSeries',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.DateField(unique=True, verbose_name='月')),
+                ('total', models.BigIntegerField(default=0, verbose_name='合計')),
+                ('count', models.IntegerField(default=0, verbose_name='件数')),
+                ('change', models.FloatField(default=0, verbose_name='前月比')),
+            ],
+        ),
+        migrations.RunPython(build_asset_series, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,212 @@
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+# 所有者をつけるモデル
+OWNED_MODELS = ('PaymentCategory', 'IncomeCategory', 'AssetCategory', 'Payment', 'Income', 'Asset',
+                'MonthlyTotal', 'AssetSeries')
+
+
+def assign_owner(apps, schema_editor):
+    """既存のカテゴリ、明細、集計を最初のスーパーユーザー(いなければ最初のユーザー)のものにする"""
+    User = apps.get_model(*settings.AUTH_USER_MODEL.split('.'))
+    owner = User.objects.filter(is_superuser=True).order_by('pk').first() or User.objects.order_by('pk').first()
+
+    for name in OWNED_MODELS:
+        model = apps.get_model('kakeibo', name)
+        if not model.objects.exists():
+            continue
+        if owner is None:
+            raise RuntimeError('The ledger has rows but there is no user to own them. '
+                               'Run "migrate register" and "createsuperuser" before migrating kakeibo.')
+        model.objects.update(owner=owner)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('kakeibo', '0007_assetseries'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='paymentcategory',
+            name='owner',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL, verbose_name='所有者'),
+        ),
+        migrations.AddField(
+            model_name='incomecategory',
+            name='owner',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL, verbose_name='所有者'),
+        ),
+        migrations.AddField(
+            model_name='assetcategory',
+            name='owner',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL, verbose_name='所有者'),
+        ),
+        migrations.AddField(
+            model_name='payment',
+            name='owner',
+            field=models.ForeignKey(db_index=False, editable=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL, verbose_name='所有者'),
+        ),
+        migrations.AddField(
+            model_name='income',
+            name='owner',
+            field=models.ForeignKey(db_index=False, editable=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL, verbose_name='所有者'),
+        ),
+        migrations.AddField(
+            model_name='asset',
+            name='owner',
+            field=models.ForeignKey(db_index=False, editable=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL, verbose_name='所有者'),
+        ),
+        migrations.AddField(
+            model_name='monthlytotal',
+            name='owner',
+            field=models.ForeignKey(db_index=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL, verbose_name='所有者'),
+        ),
+        migrations.AddField(
+            model_name='assetseries',
+            name='owner',
+            field=models.ForeignKey(db_index=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL, verbose_name='所有者'),
+        ),
+        migrations.RunPython(assign_owner, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='paymentcategory',
+            name='owner',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL, verbose_name='所有者'),
+        ),
+        migrations.AlterField(
+            model_name='incomecategory',
+            name='owner',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL, verbose_name='所有者'),
+        ),
+        migrations.AlterField(
+            model_name='assetcategory',
+            name='owner',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL, verbose_name='所有者'),
+        ),
+        migrations.AlterField(
+            model_name='payment',
+            name='owner',
+            field=models.ForeignKey(db_index=False, editable=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL, verbose_name='所有者'),
+        ),
+        migrations.AlterField(
+            model_name='income',
+            name='owner',
+            field=models.ForeignKey(db_index=False, editable=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL, verbose_name='所有者'),
+        ),
+        migrations.AlterField(
+            model_name='asset',
+            name='owner',
+            field=models.ForeignKey(db_index=False, editable=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL, verbose_name='所有者'),
+        ),
+        migrations.AlterField(
+            model_name='monthlytotal',
+            name='owner',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL, verbose_name='所有者'),
+        ),
+        migrations.AlterField(
+            model_name='assetseries',
+            name='owner',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL, verbose_name='所有者'),
+        ),
+        migrations.RemoveIndex(
+            model_name='payment',
+            name='payment_date_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='payment',
+            name='payment_category_date_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='payment',
+            name='payment_date_amount_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='income',
+            name='income_date_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='income',
+            name='income_category_date_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='income',
+            name='income_date_amount_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='asset',
+            name='asset_date_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='asset',
+            name='asset_category_date_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='asset',
+            name='asset_date_amount_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='asset',
+            name='asset_month_category_idx',
+        ),
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(fields=['owner', 'date'], name='payment_owner_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(fields=['owner', 'category', 'date'], name='payment_owner_cat_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='payment',
+            index=models.Index(fields=['owner', 'date', 'amount'], name='payment_owner_date_amount_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='income',
+            index=models.Index(fields=['owner', 'date'], name='income_owner_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='income',
+            index=models.Index(fields=['owner', 'category', 'date'], name='income_owner_cat_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='income',
+            index=models.Index(fields=['owner', 'date', 'amount'], name='income_owner_date_amount_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='asset',
+            index=models.Index(fields=['owner', 'date'], name='asset_owner_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='asset',
+            index=models.Index(fields=['owner', 'category', 'date'], name='asset_owner_cat_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='asset',
+            index=models.Index(fields=['owner', 'date', 'amount'], name='asset_owner_date_amount_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='asset',
+            index=models.Index(fields=['owner', 'month', 'category', 'amount'], name='asset_owner_month_category_idx'),
+        ),
+        migrations.RemoveConstraint(
+            model_name='monthlytotal',
+            name='unique_monthly_total',
+        ),
+        migrations.AddConstraint(
+            model_name='monthlytotal',
+            constraint=models.UniqueConstraint(fields=('owner', 'year', 'month', 'kind', 'category_pk'),
+                                               name='unique_owner_monthly_total'),
+        ),
+        migrations.AlterField(
+            model_name='assetseries',
+            name='month',
+            field=models.DateField(verbose_name='月'),
+        ),
+        migrations.AddConstraint(
+            model_name='assetseries',
+            constraint=models.UniqueConstraint(fields=('owner', 'month'), name='unique_owner_asset_series'),
+        ),
+    ]
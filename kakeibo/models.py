@@ -1,49 +1,189 @@
+from django.conf import settings
+from django.core.exceptions import ValidationError
 from django.db import models
 
 
+class LedgerItem(models.Model):
+    """
+    明細の共通部分
+    ownerはカテゴリの所有者で、saveのたびにcategoryから作られる。一覧や集計はownerで絞り込むので、索引はownerから始める
+    """
+    owner = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, editable=False,
+                              db_index=False, related_name='+', verbose_name='所有者')
+
+    class Meta:
+        abstract = True
+
+    def set_owner(self):
+        """categoryからownerを設定する。bulk_createする場合は明示的に呼ぶこと"""
+        self.owner_id = self.category.owner_id
+
+    def save(self, *args, **kwargs):
+        self.set_owner()
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'category' in update_fields:
+            kwargs['update_fields'] = set(update_fields) | {'owner'}
+        super().save(*args, **kwargs)
+
+
 class PaymentCategory(models.Model):
     """支出カテゴリ"""
+    owner = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='+',
+                              verbose_name='所有者')
     name = models.CharField('カテゴリ名', max_length=32)
 
     def __str__(self):
         return self.name
 
 
-class Payment(models.Model):
+class Payment(LedgerItem):
     """支出"""
     date = models.DateField('日付')
     amount = models.IntegerField('金額')
     category = models.ForeignKey(PaymentCategory, on_delete=models.PROTECT, verbose_name='カテゴリ')
     description = models.TextField('摘要', null=True, blank=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['owner', 'date'], name='payment_owner_date_idx'),
+            models.Index(fields=['owner', 'category', 'date'], name='payment_owner_cat_date_idx'),
+            models.Index(fields=['owner', 'date', 'amount'], name='payment_owner_date_amount_idx'),
+        ]
+
 
 class IncomeCategory(models.Model):
     """収入カテゴリ"""
+    owner = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='+',
+                              verbose_name='所有者')
     name = models.CharField('カテゴリ名', max_length=32)
 
     def __str__(self):
         return self.name
 
 
-class Income(models.Model):
+class Income(LedgerItem):
     """収入"""
     date = models.DateField('日付')
     amount = models.IntegerField('金額')
     category = models.ForeignKey(IncomeCategory, on_delete=models.PROTECT, verbose_name='カテゴリ')
     description = models.TextField('摘要', null=True, blank=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['owner', 'date'], name='income_owner_date_idx'),
+            models.Index(fields=['owner', 'category', 'date'], name='income_owner_cat_date_idx'),
+            models.Index(fields=['owner', 'date', 'amount'], name='income_owner_date_amount_idx'),
+        ]
+
 
 class AssetCategory(models.Model):
     """資産カテゴリ"""
+    owner = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='+',
+                              verbose_name='所有者')
     name = models.CharField('カテゴリ名', max_length=32)
 
     def __str__(self):
         return self.name
 
 
-class Asset(models.Model):
-    """資産"""
+class Asset(LedgerItem):
+    """
+    資産
+    カテゴリごとに月1件だけ登録できる。monthは日付の月初で、saveのたびにdateから作られる
+    """
     date = models.DateField('日付')
+    month = models.DateField('月', editable=False)
     amount = models.BigIntegerField('資産額')
     category = models.ForeignKey(AssetCategory, on_delete=models.PROTECT, verbose_name='カテゴリ')
     description = models.TextField('摘要', null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['owner', 'date'], name='asset_owner_date_idx'),
+            models.Index(fields=['owner', 'category', 'date'], name='asset_owner_cat_date_idx'),
+            models.Index(fields=['owner', 'date', 'amount'], name='asset_owner_date_amount_idx'),
+            # ダッシュボードの月別比較はこの索引だけで集計できる
+            models.Index(fields=['owner', 'month', 'category', 'amount'], name='asset_owner_month_category_idx'),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['category', 'month'], name='unique_asset_month'),
+        ]
+
+    def set_month(self):
+        """dateからmonthを設定する。bulk_createする場合は明示的に呼ぶこと"""
+        date = self._meta.get_field('date').to_python(self.date)
+        self.month = date.replace(day=1)
+
+    def validate_unique(self, exclude=None):
+        """
+        unique_asset_monthはmonthが入力欄にないのでModelFormでは確かめられない
+        dateからmonthを作って、同じカテゴリの同じ月の資産がないか確かめる
+        """
+        super().validate_unique(exclude=exclude)
+        if exclude and ('date' in exclude or 'category' in exclude):
+            return
+        if self.date is None or self.category_id is None:
+            return
+        self.set_month()
+        duplicates = Asset.objects.filter(category_id=self.category_id, month=self.month)
+        if not self._state.adding:
+            duplicates = duplicates.exclude(pk=self.pk)
+        if duplicates.exists():
+            raise ValidationError({'date': ValidationError('このカテゴリは同じ月に登録済みです',
+                                                           code='duplicate_month')})
+
+    def save(self, *args, **kwargs):
+        self.set_month()
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and 'date' in update_fields:
+            kwargs['update_fields'] = set(update_fields) | {'month'}
+        super().save(*args, **kwargs)
+
+
+class MonthlyTotal(models.Model):
+    """
+    所有者・月・カテゴリごとの集計
+    Payment, Income, Assetの保存・削除のシグナルで差分更新される
+    """
+    KIND_PAYMENT = 'payment'
+    KIND_INCOME = 'income'
+    KIND_ASSET = 'asset'
+    KIND_CHOICES = (
+        (KIND_PAYMENT, 'Payment'),
+        (KIND_INCOME, 'Income'),
+        (KIND_ASSET, 'Asset'),
+    )
+
+    owner = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, db_index=False,
+                              related_name='+', verbose_name='所有者')
+    year = models.IntegerField('年')
+    month = models.IntegerField('月')
+    kind = models.CharField('種別', max_length=8, choices=KIND_CHOICES)
+    category_pk = models.BigIntegerField('カテゴリID')
+    total = models.BigIntegerField('合計', default=0)
+    count = models.IntegerField('件数', default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['owner', 'year', 'month', 'kind', 'category_pk'],
+                                    name='unique_owner_monthly_total'),
+        ]
+
+
+class AssetSeries(models.Model):
+    """
+    所有者・月ごとの資産合計と前月比(資産の推移グラフ用)
+    Assetの保存・削除で差分更新され、前月比は更新された月と、その次に登録のある月だけ計算し直す
+    前月比は登録のある直前の月との比で、最初の月は0になる
+    """
+    owner = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, db_index=False,
+                              related_name='+', verbose_name='所有者')
+    month = models.DateField('月')
+    total = models.BigIntegerField('合計', default=0)
+    count = models.IntegerField('件数', default=0)
+    change = models.FloatField('前月比', default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['owner', 'month'], name='unique_owner_asset_series'),
+        ]
@@ -0,0 +1,140 @@
+"""一覧ページのキーセット(シーク)ページング"""
+
+import base64
+import binascii
+from datetime import date
+from django.conf import settings
+from django.db.models import Q
+
+
+class KeysetPage:
+    """
+    キーセットページングの1ページ分
+    テンプレートからはDjangoのPageと同じようにpage_objとして使う
+    """
+    is_keyset = True
+
+    def __init__(self, object_list, number, next_cursor, prev_cursor, count, count_capped, page_size):
+        self.object_list = object_list
+        self.number = number
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+        self.count = count
+        self.count_capped = count_capped
+        self.page_size = page_size
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.prev_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+    @property
+    def num_pages(self):
+        """おおよそのページ数。件数が上限に達している場合は'+'をつける"""
+        pages = max(1, -(-self.count // self.page_size))
+        if self.count_capped:
+            return f'{pages}+'
+        return pages
+
+
+def encode_cursor(direction, obj, number):
+    """ページの先頭または末尾の明細からカーソル文字列を作る"""
+    raw = f'{direction}|{obj.date.isoformat()}|{obj.pk}|{number}'
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """カーソル文字列を(方向, 日付, pk, ページ番号)にして返す。不正な値の場合はNone"""
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        direction, date_string, pk, number = raw.split('|')
+        if direction not in ('n', 'p'):
+            return None
+        return direction, date.fromisoformat(date_string), int(pk), int(number)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        return None
+
+
+class KeysetPaginationMixin:
+    """
+    ListViewに(-date, -id)順のキーセットページングを提供するMixin
+    OFFSETを使わないので、深いページも1ページ目と同じコストで取得できる
+    settings.KAKEIBO_KEYSET_PAGINATIONかkeyset_paginationをTrueにすると有効になる
+    """
+    keyset_pagination = None
+    cursor_kwarg = 'cursor'
+
+    def use_keyset_pagination(self):
+        if self.keyset_pagination is not None:
+            return self.keyset_pagination
+        return getattr(settings, 'KAKEIBO_KEYSET_PAGINATION', False)
+
+    def get_count_cap(self):
+        """件数を数える上限"""
+        return getattr(settings, 'KAKEIBO_KEYSET_COUNT_CAP', 1000)
+
+    def paginate_queryset(self, queryset, page_size):
+        if not self.use_keyset_pagination():
+            return super().paginate_queryset(queryset, page_size)
+
+        cursor = decode_cursor(self.request.GET.get(self.cursor_kwarg))
+        page = None
+        if cursor:
+            page = self.get_keyset_page(queryset, page_size, *cursor)
+        if not page:
+            # カーソルがない、または前のページが削除などで空になった場合は1ページ目
+            page = self.get_keyset_page(queryset, page_size)
+
+        return None, page, page.object_list, page.has_other_pages()
+
+    def get_keyset_page(self, queryset, page_size, direction='n', date=None, pk=None, number=0):
+        """カーソルの次、または前のページを返す。該当がない場合はNone"""
+        if direction == 'n':
+            qs = queryset.order_by('-date', '-id')
+            if date is not None:
+                qs = qs.filter(Q(date__lt=date) | Q(date=date, id__lt=pk))
+        else:
+            qs = queryset.order_by('date', 'id').filter(Q(date__gt=date) | Q(date=date, id__gt=pk))
+
+        # 1件多く取って次があるかを判定する
+        object_list = list(qs[:page_size + 1])
+        has_more = len(object_list) > page_size
+        object_list = object_list[:page_size]
+        if not object_list and date is not None:
+            return None
+
+        number = max(1, number + 1 if direction == 'n' else number - 1)
+        if direction == 'n':
+            has_next, has_previous = has_more, date is not None
+        else:
+            object_list.reverse()
+            has_next, has_previous = True, has_more
+
+        next_cursor = prev_cursor = None
+        if has_next and object_list:
+            next_cursor = encode_cursor('n', object_list[-1], number)
+        if has_previous and object_list:
+            prev_cursor = encode_cursor('p', object_list[0], number)
+
+        # 件数は上限までしか数えない
+        count_cap = self.get_count_cap()
+        count = queryset.order_by()[:count_cap + 1].count()
+
+        return KeysetPage(object_list, number,
+                          next_cursor=next_cursor,
+                          prev_cursor=prev_cursor,
+                          count=min(count, count_cap),
+                          count_capped=count > count_cap,
+                          page_size=page_size)
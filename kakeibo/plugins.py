@@ -1,14 +1,79 @@
 """views.pyのロジックを補助する関数群"""
 
-from .seaborn_colorpalette import sns_paired
 from typing import Literal
-from datetime import datetime
-import numpy as np
-import pandas as pd
-from django_pandas.io import read_frame
-from django.db.models import Sum
-from .models import Payment, Income, Asset, PaymentCategory, IncomeCategory, AssetCategory
+from datetime import date, datetime
+from django.contrib.auth import get_user_model
+from django.contrib.auth.mixins import LoginRequiredMixin
+from django.db import transaction
+from django.db.models import Count, Q, Sum
+from django.db.models.functions import TruncMonth
+from .models import Payment, Income, Asset, PaymentCategory, IncomeCategory, AssetCategory, MonthlyTotal, \
+    AssetSeries
 from django.conf import settings
+from .cache import bump_ledger_version
+from .chart_range import select_range, group_by_period, downsample, reduce_series
+from .concurrency import run_aggregate, gather_aggregates
+from .instrumentation import timed
+from .registry import get_registry
+from .forms import ChartRangeForm
+from .summary import apply_deltas, change_rate
+
+
+def month_range(year, month=None):
+    """
+    年月から[開始日, 終了日)の半開区間を返す
+    monthを省略した場合は1年分になる
+    """
+    year = int(year)
+    if not month:
+        return date(year, 1, 1), date(year + 1, 1, 1)
+    month = int(month)
+    if month == 12:
+        return date(year, 12, 1), date(year + 1, 1, 1)
+    return date(year, month, 1), date(year, month + 1, 1)
+
+
+def filter_by_month(queryset, year=None, month=None):
+    """
+    年月でquerysetを絞り込んで返す
+    date__year, date__monthはインデックスが効かないため、日付の範囲で絞り込む
+    検索フォームの未選択は0か'0'が入るため、絞り込みをしない
+    """
+    year = int(year or 0)
+    month = int(month or 0)
+    if year:
+        start, end = month_range(year, month)
+        return queryset.filter(date__gte=start, date__lt=end)
+    if month:
+        # 年をまたいだ月の指定は範囲にできない
+        return queryset.filter(date__month=month)
+    return queryset
+
+
+def get_owner(username=None):
+    """usernameのユーザーを返す。省略した場合は最初のスーパーユーザー。見つからなければNone"""
+    users = get_user_model().objects.order_by('pk')
+    if username:
+        return users.filter(username=username).first()
+    return users.filter(is_superuser=True).first()
+
+
+class OwnerMixin(LoginRequiredMixin):
+    """
+    ログインユーザーの明細だけを扱うビューのMixin
+    一覧や削除のビューではget_queryset()を、フォームの選択肢はカテゴリと年をログインユーザーのものに絞り込む
+    """
+
+    def get_owner_id(self):
+        return self.request.user.pk
+
+    def get_queryset(self):
+        return super().get_queryset().filter(owner_id=self.get_owner_id())
+
+    def get_form_kwargs(self):
+        kwargs = super().get_form_kwargs()
+        kwargs['owner_id'] = self.get_owner_id()
+        return kwargs
 
 
 class MonthPagerMixin:
@@ -47,12 +112,68 @@ class MonthPagerMixin:
 
 
 class BaseDashPageMixin:
-    """dashboard系のページの共通機能を提供する"""
+    """
+    dashboard系のページの共通機能を提供する
+    集計はすべてget_owner_id()の所有者の明細で行うので、OwnerMixinと組み合わせること
+    """
+
+    # 集計方法。Noneの場合はsettings.KAKEIBO_AGGREGATION_BACKENDに従う
+    # 'database'はSQLで集計し、'pandas'はread_frameしてpivot集計する
+    aggregation_backend = None
+
+    def use_pandas_backend(self):
+        """pandasで集計するかどうかを返す"""
+        backend = self.aggregation_backend or getattr(settings, 'KAKEIBO_AGGREGATION_BACKEND', 'database')
+        return backend == 'pandas'
+
+    def get_ledger_queryset(self, model):
+        """所有者の明細のquerysetを返す"""
+        return model.objects.filter(owner_id=self.get_owner_id())
+
+    def get_category_amounts(self, queryset):
+        """
+        querysetをカテゴリ名ごとに集計して、カテゴリ名とamountのリストを返す
+        カテゴリ名でソートされる
+        """
+        if self.use_pandas_backend():
+            df = self.read_frame(queryset, fieldnames=['category', 'amount'])
+            if df.empty:
+                return [], []
+            df_pivot = self.get_df_pivot(df, index='category', values='amount')
+            return self.get_index_list_from_pivot(df_pivot), self.get_value_list_from_pivot(df_pivot)
+
+        rows = queryset.values_list('category__name').annotate(Sum('amount')).order_by('category__name')
+        return [row[0] for row in rows], [row[1] for row in rows]
+
+    def get_month_amounts(self, queryset):
+        """querysetを月ごとに集計して、{'YYYY-MM':amount}という辞書を返す"""
+        if self.use_pandas_backend():
+            df = self.read_frame(queryset, fieldnames=['date', 'amount'])
+            df = self.add_month_col_to_df(df)
+            df_pivot = self.get_df_pivot(df, index='month', values='amount')
+            return df_pivot.to_dict()['amount']
+
+        # Assetはmonth列を持つので、別名で月初に丸める
+        rows = queryset.annotate(month_start=TruncMonth('date')).values_list('month_start').annotate(
+            Sum('amount')).order_by('month_start')
+        return {month.strftime('%Y-%m'): amount for month, amount in rows}
+
+    @staticmethod
+    @timed('pandas')
+    def read_frame(qs, fieldnames):
+        """
+        querysetをDataFrameにして返す
+        pandasは読み込みに時間がかかるので、pandasで集計するときに初めて読み込む
+        """
+        from django_pandas.io import read_frame
+        return read_frame(qs, fieldnames=fieldnames)
 
     @staticmethod
+    @timed('pandas')
     def get_df_pivot(df, index, values):
         """querysetからpivot集計したdfを返す"""
-        return pd.pivot_table(df, index=index, values=values, aggfunc=np.sum)
+        import pandas as pd
+        return pd.pivot_table(df, index=index, values=values, aggfunc='sum')
 
     @staticmethod
     def get_index_list_from_pivot(df_pivot):
@@ -70,25 +191,19 @@ class BaseDashPageMixin:
     @staticmethod
     def add_month_col_to_df(df):
         """dfにmonth列を与えて返す"""
+        import pandas as pd
         df['date'] = pd.to_datetime(df['date'])
         df['month'] = df['date'].dt.strftime('%Y-%m')
         return df
 
-    @staticmethod
-    def get_color_map(category_model, donut_graph_labels):
+    @timed('colors')
+    def get_color_map(self, category_model, donut_graph_labels):
         """
         ドーナッツグラフデータに渡すcolormapリストを作成して返す
         表示されるカテゴリは月によって変わる。
-        そのため先にカテゴリ全データから、{category名:rgb値}という辞書を作る
-        グラフラベルをkeyに辞書から値を取得することで、カテゴリによって色が変わらない
+        色はカテゴリのレジストリがpkから決めているので、月やカテゴリ名の変更によって色が変わらない
         """
-
-        color_palette = sns_paired()
-        color_dict = {}
-        for i, category in enumerate(category_model.objects.all()):
-            color_dict[category.name] = color_palette[i]
-
-        return [color_dict.get(category) for category in donut_graph_labels]
+        return get_registry(category_model, self.get_owner_id()).color_map(donut_graph_labels)
 
     @staticmethod
     def get_sum_amount(queryset):
@@ -119,6 +234,7 @@ class BaseDashPageMixin:
 class MonthlyBalanceMixin(MonthPagerMixin, BaseDashPageMixin):
     """月間収支ページのcontextを作成するMixin"""
 
+    @timed('table')
     def get_table_items(self, categories, values, total):
         """
         [{'category':カテゴリ名,
@@ -135,6 +251,22 @@ class MonthlyBalanceMixin(MonthPagerMixin, BaseDashPageMixin):
 
         return items
 
+    def get_category_totals(self, category_model, rows):
+        """
+        集計テーブルの行からカテゴリ名とamountのリストを返す
+        カテゴリ名でソートし、同名のカテゴリは合算する。所有者のカテゴリでなくなった行は除く
+        """
+        registry = get_registry(category_model, self.get_owner_id())
+        totals = {}
+        for row in rows:
+            name = registry.name(row.category_pk)
+            if name is None:
+                continue
+            totals[name] = totals.get(name, 0) + row.total
+
+        categories = sorted(totals)
+        return categories, [totals[category] for category in categories]
+
     def get_monthly_balance_data(self):
         """contextデータを作成して返す"""
 
@@ -142,21 +274,64 @@ class MonthlyBalanceMixin(MonthPagerMixin, BaseDashPageMixin):
         data = self.get_month_pager_data()
         current = data['current_month']
 
+        if self.use_pandas_backend():
+            return self.get_monthly_balance_data_by_pandas(data)
+
+        # 集計テーブルから当月分を取得する
+        rows = MonthlyTotal.objects.filter(owner_id=self.get_owner_id(),
+                                           year=current.year,
+                                           month=current.month,
+                                           kind__in=[MonthlyTotal.KIND_PAYMENT, MonthlyTotal.KIND_INCOME])
+        payment_rows = [row for row in rows if row.kind == MonthlyTotal.KIND_PAYMENT]
+        if not payment_rows:
+            return data
+
+        # ドーナッツチャートのラベルを作成
+        categories, amounts = self.get_category_totals(PaymentCategory, payment_rows)
+
+        # 収支情報の作成
+        total_payment = sum(amounts)
+        total_income = sum(row.total for row in rows if row.kind == MonthlyTotal.KIND_INCOME)
+        if total_income:
+            balance = total_income - total_payment
+        else:
+            balance = -total_payment
+
+        # テーブル部分の作成
+        table_items = self.get_table_items(categories, amounts, total_payment)
+
+        # カラーマップの作成
+        color_map = self.get_color_map(category_model=PaymentCategory,
+                                       donut_graph_labels=categories)
+        data.update({
+            'donut_chart_labels': categories,
+            'donut_chart_values': amounts,
+            'total_payment': total_payment,
+            'total_income': total_income,
+            'table_items': table_items,
+            'balance': balance,
+            'color_map': color_map
+        })
+        return data
+
+    async def aget_monthly_balance_data(self):
+        """get_monthly_balance_dataの非同期版。集計テーブルを1回読むだけなので、そのままプールで実行する"""
+        return await run_aggregate(self.get_monthly_balance_data)
+
+    def get_monthly_balance_data_by_pandas(self, data):
+        """明細からpandasで集計してcontextデータを作成して返す"""
+        current = data['current_month']
+
         # querysetを絞りこむ
-        qs_payment = Payment.objects.filter(date__year=current.year,
-                                            date__month=current.month)
+        qs_payment = filter_by_month(self.get_ledger_queryset(Payment), current.year, current.month)
         if not qs_payment:
             return data
 
         # ドーナッツチャートのラベルを作成
-        df = read_frame(qs_payment, fieldnames=['category', 'amount'])
-        df_pivot = self.get_df_pivot(df, index='category', values='amount')
-        categories = self.get_index_list_from_pivot(df_pivot)
-        amounts = self.get_value_list_from_pivot(df_pivot)
+        categories, amounts = self.get_category_amounts(qs_payment)
 
         # 収支情報の作成
-        qs_income = Income.objects.filter(date__year=current.year,
-                                          date__month=current.month)
+        qs_income = filter_by_month(self.get_ledger_queryset(Income), current.year, current.month)
         total_payment = self.get_sum_amount(qs_payment)
         total_income = self.get_sum_amount(qs_income)
         if total_income:
@@ -185,74 +360,161 @@ class MonthlyBalanceMixin(MonthPagerMixin, BaseDashPageMixin):
 class BalanceTransitionMixin(BaseDashPageMixin):
     """収支推移ページのcontextを作成するMixin"""
 
-    def get_labels_max(self):
+    @staticmethod
+    def fill_month_gaps(labels):
+        """'YYYY-MM'のソート済みラベルから、間の月も埋めたラベルを返す"""
+        if not labels:
+            return []
+        year, month = map(int, labels[0].split('-'))
+        last_year, last_month = map(int, labels[-1].split('-'))
+        filled = []
+        while (year, month) <= (last_year, last_month):
+            filled.append(f'{year}-{month:02d}')
+            year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+        return filled
+
+    @staticmethod
+    def get_month_series(model, owner_id, category=None):
         """
-        支出、収入モデルの年月データから最大長のラベルを返す
-        Todo:ここも改善の余地がある
+        owner_idの所有者の明細を一回のクエリで月ごとに集計し、
+        {'YYYY-MM':(amount, 件数)}という辞書を返す
+        月は所有者の明細全体から取り、amountと件数はcategoryで絞り込んだ値になる
         """
+        condition = Q(category=category) if category else None
+        rows = model.objects.filter(owner_id=owner_id).annotate(
+            month_start=TruncMonth('date')).values_list('month_start').annotate(
+            amount_sum=Sum('amount', filter=condition),
+            item_count=Count('id', filter=condition),
+        ).order_by('month_start')
+        return {month.strftime('%Y-%m'): (amount or 0, count) for month, amount, count in rows}
+
+    def get_labels_max(self):
+        """支出、収入モデルの年月データから最大長のラベルを返す"""
+        import pandas as pd
 
         # 支出の月データ
-        df_payment = read_frame(Payment.objects.all(), fieldnames=['date'])
+        df_payment = self.read_frame(self.get_ledger_queryset(Payment), fieldnames=['date'])
         df_payment = self.add_month_col_to_df(df_payment)
         df_payment = df_payment.drop_duplicates(subset='month')
 
         # 収入の月データ
-        df_income = read_frame(Income.objects.all(), fieldnames=['date'])
+        df_income = self.read_frame(self.get_ledger_queryset(Income), fieldnames=['date'])
         df_income = self.add_month_col_to_df(df_income)
         df_income = df_income.drop_duplicates(subset='month')
 
         # mergeして月でソート
         df_merge = pd.merge(df_income, df_payment, on='month', how='outer')
         df_merge = df_merge.sort_values('month')
-        return [val for val in df_merge['month'].values]
+        return self.fill_month_gaps([val for val in df_merge['month'].values])
 
     def get_amount(self, queryset, labels_max):
         """querysetを受け取り、年月に対応するamountをyieldして返す"""
-        df = read_frame(queryset,
-                        fieldnames=['date', 'amount'])
-        df = self.add_month_col_to_df(df)
-        df_pivot = self.get_df_pivot(df, index='month', values='amount')
-
         # {'month':amount}という辞書になる
-        dic = df_pivot.to_dict()['amount']
+        dic = self.get_month_amounts(queryset)
 
         # 最大長のラベルを繰り返し、辞書から値をセットしていく
         for label in labels_max:
             yield dic.get(label, 0)
 
-    def get_balance_transition_data(self, form):
-        """contextデータを作成して返す"""
-        labels_max = self.get_labels_max()
-        qs_payment = Payment.objects.all()
-        qs_income = Income.objects.all()
-
+    @staticmethod
+    def get_transition_options(form):
+        """検索フォームから(支出カテゴリ, 収入カテゴリ, 支出を表示するか, 収入を表示するか)を返す"""
+        payment_category = None
+        income_category = None
         graph_visible = None
         if form.is_valid():
             payment_category = form.cleaned_data.get('payment_category')
-            if payment_category:
-                qs_payment = qs_payment.filter(category=payment_category)
             income_category = form.cleaned_data.get('income_category')
-            if income_category:
-                qs_income = qs_income.filter(category=income_category)
-
             graph_visible = form.cleaned_data.get('graph_visible')
 
         # forms.pyで表示グラフ名を定義
+        # 未選択の場合は'All'と同じく両方表示する
+        show_payment = graph_visible != 'Income'
+        show_income = graph_visible != 'Payment'
+        return payment_category, income_category, show_payment, show_income
+
+    def get_balance_transition_data(self, form):
+        """contextデータを作成して返す"""
+        payment_category, income_category, show_payment, show_income = self.get_transition_options(form)
+        chart_range = form.get_chart_range()
+
+        if self.use_pandas_backend():
+            return self.reduce_balance_transition_data(self.get_balance_transition_data_by_pandas(
+                payment_category, income_category, show_payment, show_income), chart_range)
+
+        # 支出、収入それぞれ一回のクエリで月ごとの集計を取る
+        owner_id = self.get_owner_id()
+        payment_series = self.get_month_series(Payment, owner_id, payment_category)
+        income_series = self.get_month_series(Income, owner_id, income_category)
+        return self.reduce_balance_transition_data(
+            self.build_balance_transition_data(payment_series, income_series, show_payment, show_income), chart_range)
+
+    async def aget_balance_transition_data(self, form):
+        """get_balance_transition_dataの非同期版。支出と収入の集計を並行して行う"""
+        options = await run_aggregate(self.get_transition_options, form)
+        payment_category, income_category, show_payment, show_income = options
+        # フォームの検証は済んでいるので、ここではクエリは発生しない
+        chart_range = form.get_chart_range()
+
+        if self.use_pandas_backend():
+            data = await run_aggregate(self.get_balance_transition_data_by_pandas, *options)
+            return self.reduce_balance_transition_data(data, chart_range)
+
+        owner_id = self.get_owner_id()
+        payment_series, income_series = await gather_aggregates(
+            (self.get_month_series, Payment, owner_id, payment_category),
+            (self.get_month_series, Income, owner_id, income_category),
+        )
+        return self.reduce_balance_transition_data(
+            self.build_balance_transition_data(payment_series, income_series, show_payment, show_income), chart_range)
+
+    @staticmethod
+    def reduce_balance_transition_data(data, chart_range):
+        """contextデータの系列を表示範囲に絞り込み、期間ごとに合計して、点数の上限まで間引く"""
+        labels, (payments, incomes) = reduce_series(data['labels'], [data['payments'], data['incomes']],
+                                                    chart_range)
+        return {
+            'labels': labels,
+            'payments': payments,
+            'incomes': incomes
+        }
+
+    def build_balance_transition_data(self, payment_series, income_series, show_payment, show_income):
+        """get_month_seriesの結果からcontextデータを作成して返す"""
+        labels_max = self.fill_month_gaps(sorted(set(payment_series) | set(income_series)))
+
         payments = None
+        if show_payment and any(count for _, count in payment_series.values()):
+            payments = [payment_series.get(label, (0, 0))[0] for label in labels_max]
+
         incomes = None
-        if graph_visible == 'All':
-            if qs_payment:
-                payments = [amount for amount in self.get_amount(qs_payment, labels_max)]
-            if qs_income:
-                incomes = [amount for amount in self.get_amount(qs_income, labels_max)]
+        if show_income and any(count for _, count in income_series.values()):
+            incomes = [income_series.get(label, (0, 0))[0] for label in labels_max]
+
+        return {
+            'labels': labels_max,
+            'payments': payments,
+            'incomes': incomes
+        }
+
+    def get_balance_transition_data_by_pandas(self, payment_category, income_category,
+                                              show_payment, show_income):
+        """明細からpandasで集計してcontextデータを作成して返す"""
+        labels_max = self.get_labels_max()
+        qs_payment = self.get_ledger_queryset(Payment)
+        qs_income = self.get_ledger_queryset(Income)
+        if payment_category:
+            qs_payment = qs_payment.filter(category=payment_category)
+        if income_category:
+            qs_income = qs_income.filter(category=income_category)
 
-        if not graph_visible or graph_visible == 'Payment':
-            if qs_payment:
-                payments = [amount for amount in self.get_amount(qs_payment, labels_max)]
+        payments = None
+        if show_payment and qs_payment:
+            payments = [amount for amount in self.get_amount(qs_payment, labels_max)]
 
-        if not graph_visible or graph_visible == 'Income':
-            if qs_income:
-                incomes = [amount for amount in self.get_amount(qs_income, labels_max)]
+        incomes = None
+        if show_income and qs_income:
+            incomes = [amount for amount in self.get_amount(qs_income, labels_max)]
 
         return {
             'labels': labels_max,
@@ -264,50 +526,144 @@ class BalanceTransitionMixin(BaseDashPageMixin):
 class AssetDashMixin(MonthPagerMixin, BaseDashPageMixin):
     """資産ダッシュボードページのcontextを作成するMixin"""
 
+    def get_chart_range(self):
+        """GETパラメータから推移グラフの表示範囲を返す"""
+        return ChartRangeForm(self.request.GET or None).get_chart_range()
+
     def get_transition_graph_data(self):
-        """推移グラフのデータを作成して返す"""
-        df_all = read_frame(Asset.objects.all(),
-                            fieldnames=['date', 'category', 'amount'])
-        df_all = self.add_month_col_to_df(df_all)
-        df_all_pivot = self.get_df_pivot(df_all, index='month', values='amount')
-        df_all_pivot['diff'] = df_all_pivot['amount'].pct_change().fillna(0)
-        labels = self.get_index_list_from_pivot(df_all_pivot)
-        heights = self.get_value_list_from_pivot(df_all_pivot, col_name='amount')
-        spark_heights = self.get_value_list_from_pivot(df_all_pivot, col_name='diff')
+        """推移グラフのデータ(月、合計、前月比)を、GETパラメータの表示範囲に絞り込んで返す"""
+        labels, heights, spark_heights = self.get_asset_series()
+        return self.reduce_asset_transition(labels, heights, spark_heights, self.get_chart_range())
+
+    @staticmethod
+    def reduce_asset_transition(labels, heights, spark_heights, chart_range):
+        """
+        推移グラフのデータを表示範囲に絞り込み、期末の合計で期間ごとにまとめて、点数の上限まで間引く
+        まとめたり間引いたりした場合、前月比は残った点どうしの変化率にする
+        """
+        labels, (heights, spark_heights) = select_range(labels, [heights, spark_heights], chart_range.start,
+                                                        chart_range.end, chart_range.last)
+        reduced_labels, (reduced_heights,) = downsample(
+            *group_by_period(labels, [heights], chart_range.period, how='last'), chart_range.max_points)
+        if reduced_labels == labels:
+            return labels, heights, spark_heights
+        reduced_spark_heights = [change_rate(height, prev) for prev, height in
+                                 zip([None] + reduced_heights[:-1], reduced_heights)]
+        return reduced_labels, reduced_heights, reduced_spark_heights
+
+    def get_asset_series(self):
+        """月ごとの資産の合計と前月比を(月のラベル, 合計, 前月比)のリストで返す"""
+        if self.use_pandas_backend():
+            df_all = self.read_frame(self.get_ledger_queryset(Asset),
+                                     fieldnames=['date', 'category', 'amount'])
+            if df_all.empty:
+                return [], [], []
+            df_all = self.add_month_col_to_df(df_all)
+            df_all_pivot = self.get_df_pivot(df_all, index='month', values='amount')
+            df_all_pivot['diff'] = df_all_pivot['amount'].pct_change().fillna(0)
+            labels = self.get_index_list_from_pivot(df_all_pivot)
+            heights = self.get_value_list_from_pivot(df_all_pivot, col_name='amount')
+            spark_heights = self.get_value_list_from_pivot(df_all_pivot, col_name='diff')
+
+            return labels, heights, spark_heights
+
+        # 月ごとの合計と前月比は資産の登録、削除のたびに更新されているので、そのまま読む
+        rows = AssetSeries.objects.filter(owner_id=self.get_owner_id()).order_by('month').values_list(
+            'month', 'total', 'change')
+        labels = []
+        heights = []
+        spark_heights = []
+        for month, total, change in rows:
+            labels.append(month.strftime('%Y-%m'))
+            heights.append(total)
+            spark_heights.append(change)
 
         return labels, heights, spark_heights
 
-    def get_table_items(self, month_data):
+    async def aget_transition_graph_data(self):
+        """get_transition_graph_dataの非同期版"""
+        return await run_aggregate(self.get_transition_graph_data)
+
+    @staticmethod
+    def get_begin_term_month(current):
+        """
+        期初の年月を返す
+        期初の基準月をいつにするかはsettings.pyで定義
+        """
+        begin_term_month = settings.MONTH_OF_BEGIN_TERM
+        if current.month < begin_term_month:
+            begin_term_year = current.year - 1
+        else:
+            begin_term_year = current.year
+        return datetime(year=begin_term_year, month=begin_term_month, day=1)
+
+    @staticmethod
+    def to_month(value):
+        """datetimeで渡された月をAsset.monthと比べられるdateにする"""
+        return value.date() if isinstance(value, datetime) else value
+
+    def get_comparison_rows(self, month_data):
+        """
+        当月、前月、期初のカテゴリごとの資産額を一回のクエリで集計し、
+        [(カテゴリ名, 当月, 前月, 期初),...]というカテゴリ名順のリストを返す
+        登録がない月はNoneになる
+        """
+        current = self.to_month(month_data['current_month'])
+        prev_month = self.to_month(month_data['prev_month'])
+        begin_term = self.to_month(self.get_begin_term_month(month_data['current_month']))
+
+        rows = self.get_ledger_queryset(Asset).filter(month__in=[current, prev_month, begin_term]).values_list(
+            'category__name').annotate(
+            amount_current=Sum('amount', filter=Q(month=current)),
+            amount_prev_month=Sum('amount', filter=Q(month=prev_month)),
+            amount_begin_term=Sum('amount', filter=Q(month=begin_term)),
+        ).order_by('category__name')
+        return list(rows)
+
+    def get_table_rows(self, month_data, comparison_rows=None):
         """
-        テーブルデータを作って返す。
-        Todo:mergeして無理やり作っているが、もっといいやり方がありそう
+        テーブルの元になる
+        [(カテゴリ名, 当月, 前月, 期初),...]
+        というカテゴリ名順のリストと、当月、前月、期初それぞれの合計を返す
+        comparison_rowsはget_comparison_rowsの結果で、渡されなければ集計する
         """
+        if self.use_pandas_backend():
+            return self.get_table_rows_by_pandas(month_data)
+
+        if comparison_rows is None:
+            comparison_rows = self.get_comparison_rows(month_data)
+
+        # 合計も同じループで計算する
+        rows = []
+        totals = [0, 0, 0]
+        for category, *amounts in comparison_rows:
+            amounts = [amount or 0 for amount in amounts]
+            rows.append((category, *amounts))
+            totals = [total + amount for total, amount in zip(totals, amounts)]
+        return rows, totals
+
+    def get_table_rows_by_pandas(self, month_data):
+        """get_table_rowsと同じ値をpandasでmergeして作る"""
+        import pandas as pd
+
         current = month_data['current_month']
         prev_month = month_data['prev_month']
         fields = ['category', 'amount']
 
         # 前月のdfを作成
-        qs_prev_month = Asset.objects.filter(date__year=prev_month.year,
-                                             date__month=prev_month.month)
-        df_prev_month = read_frame(qs_prev_month, fieldnames=fields)
+        qs_prev_month = filter_by_month(self.get_ledger_queryset(Asset), prev_month.year, prev_month.month)
+        df_prev_month = self.read_frame(qs_prev_month, fieldnames=fields)
         df_prev_month = df_prev_month.rename(columns={'amount': 'amount_prev_month'})
 
         # 期初のdfを作成
-        # 期初の基準月をいつにするかはsettings.pyで定義
-        begin_term_month = settings.MONTH_OF_BEGIN_TERM
-        if current.month < begin_term_month:
-            begin_term_year = current.year - 1
-        else:
-            begin_term_year = current.year
-        qs_begin_term = Asset.objects.filter(date__year=begin_term_year,
-                                             date__month=begin_term_month)
-        df_begin_term = read_frame(qs=qs_begin_term, fieldnames=fields)
+        begin_term = self.get_begin_term_month(current)
+        qs_begin_term = filter_by_month(self.get_ledger_queryset(Asset), begin_term.year, begin_term.month)
+        df_begin_term = self.read_frame(qs=qs_begin_term, fieldnames=fields)
         df_begin_term = df_begin_term.rename(columns={'amount': 'amount_begin_term'})
 
         # 表示中の月のdfを作成
-        qs_current = Asset.objects.filter(date__year=current.year,
-                                          date__month=current.month)
-        df_current = read_frame(qs=qs_current, fieldnames=fields)
+        qs_current = filter_by_month(self.get_ledger_queryset(Asset), current.year, current.month)
+        df_current = self.read_frame(qs=qs_current, fieldnames=fields)
 
         # mergeする
         df_merge = pd.merge(df_current, df_prev_month, on='category', how='outer')
@@ -317,15 +673,20 @@ class AssetDashMixin(MonthPagerMixin, BaseDashPageMixin):
                                     'amount_begin_term': int})
         df_merge = df_merge.sort_values('category')
 
-        total_amount_current = self.get_sum_amount(qs_current)
+        rows = [tuple(val) for val in
+                df_merge[['category', 'amount', 'amount_prev_month', 'amount_begin_term']].values]
+        totals = [self.get_sum_amount(qs) for qs in (qs_current, qs_prev_month, qs_begin_term)]
+        return rows, totals
+
+    @timed('table')
+    def get_table_items(self, month_data, comparison_rows=None):
+        """テーブルデータを作って返す"""
+        rows, totals = self.get_table_rows(month_data, comparison_rows)
+        total_amount_current, total_amount_prev_month, total_amount_begin_term = totals
 
         # テーブルの繰り返し部分を作成
         items = []
-        for val in df_merge[['category', 'amount', 'amount_prev_month', 'amount_begin_term']].values:
-            category = val[0]
-            amount_current = val[1]
-            amount_prev_month = val[2]
-            amount_begin_term = val[3]
+        for category, amount_current, amount_prev_month, amount_begin_term in rows:
             items.append({
                 'category': category,
                 'current': amount_current,
@@ -339,9 +700,6 @@ class AssetDashMixin(MonthPagerMixin, BaseDashPageMixin):
             })
 
         # テーブルのトータル部分を作成
-        total_amount_prev_month = self.get_sum_amount(qs_prev_month)
-        total_amount_begin_term = self.get_sum_amount(qs_begin_term)
-
         total = {
             'current': total_amount_current,
             'prev_month': total_amount_prev_month,
@@ -354,17 +712,62 @@ class AssetDashMixin(MonthPagerMixin, BaseDashPageMixin):
 
         return items, total
 
+    def get_current_amounts(self, month_data):
+        """
+        表示中の月のカテゴリ名と資産額のリスト、テーブル用のget_comparison_rowsの結果を返す
+        データベースで集計する場合は、テーブルと同じ一回のクエリの結果から作る
+        """
+        if self.use_pandas_backend():
+            current = month_data['current_month']
+            qs_asset = filter_by_month(self.get_ledger_queryset(Asset), current.year, current.month)
+            categories, amounts = self.get_category_amounts(qs_asset)
+            return categories, amounts, None
+
+        comparison_rows = self.get_comparison_rows(month_data)
+        current_rows = [(category, amount) for category, amount, _, _ in comparison_rows
+                        if amount is not None]
+        categories = [category for category, _ in current_rows]
+        amounts = [amount for _, amount in current_rows]
+        return categories, amounts, comparison_rows
+
+    def get_asset_table_data(self):
+        """テーブル部分だけのcontextデータを返す。グラフのデータはAPIから取得する"""
+        data = self.get_month_pager_data()
+        categories, _, comparison_rows = self.get_current_amounts(data)
+        if categories:
+            table_items, table_total = self.get_table_items(month_data=data, comparison_rows=comparison_rows)
+            data.update({'table_items': table_items, 'total': table_total})
+        return data
+
+    async def aget_asset_table_data(self):
+        """get_asset_table_dataの非同期版。集計は1回のクエリなので、そのままプールで実行する"""
+        return await run_aggregate(self.get_asset_table_data)
+
+    def get_asset_allocation_data(self):
+        """アセットアロケーショングラフのデータを返す"""
+        data = self.get_month_pager_data()
+        categories, amounts, _ = self.get_current_amounts(data)
+        color_map = self.get_color_map(category_model=AssetCategory,
+                                       donut_graph_labels=categories) if categories else []
+        return {'donut_chart_labels': categories,
+                'donut_chart_values': amounts,
+                'color_map': color_map}
+
+    async def aget_asset_allocation_data(self):
+        """get_asset_allocation_dataの非同期版"""
+        return await run_aggregate(self.get_asset_allocation_data)
+
     def get_asset_dash_data(self):
         """contextデータを作成して返す"""
         data = self.get_month_pager_data()
 
-        # 何もない場合はこの時点で返す
-        if not Asset.objects.all().exists():
-            return data
-
         # 推移グラフデータ
         months, heights, spark_heights = self.get_transition_graph_data()
 
+        # 何もない場合はこの時点で返す
+        if not months:
+            return data
+
         # 一回アップデートする
         data.update(
             {'months': months,
@@ -372,26 +775,19 @@ class AssetDashMixin(MonthPagerMixin, BaseDashPageMixin):
              'spark_heights': spark_heights, }
         )
 
-        current = data['current_month']
-        qs_asset = Asset.objects.filter(date__year=current.year,
-                                        date__month=current.month)
+        # アセットアロケーショングラフ素材
+        categories, amounts, comparison_rows = self.get_current_amounts(data)
 
-        # 現在のqsがない場合は返す
-        if not qs_asset:
+        # 現在の月の登録がない場合は返す
+        if not categories:
             return data
 
-        # アセットアロケーショングラフ素材
-        df = read_frame(qs_asset, fieldnames=['category', 'amount'])
-        df_pivot = self.get_df_pivot(df, index='category', values='amount')
-        categories = self.get_index_list_from_pivot(df_pivot)
-        amounts = self.get_value_list_from_pivot(df_pivot)
-
         # カテゴリに対応したカラーマップをつくる
         color_map = self.get_color_map(category_model=AssetCategory,
                                        donut_graph_labels=categories)
 
         # テーブル部分の作成
-        table_items, table_total = self.get_table_items(month_data=data)
+        table_items, table_total = self.get_table_items(month_data=data, comparison_rows=comparison_rows)
 
         data.update({
             'donut_chart_labels': categories,
@@ -406,8 +802,12 @@ class AssetDashMixin(MonthPagerMixin, BaseDashPageMixin):
 
 def success_message_for_item(register_or_delete_string: Literal['Register', 'Delete'],
                              target_model_name: Literal['Payment', 'Income', 'Asset'],
-                             date, category, amount):
-    """サクセスメッセージを作って返す"""
+                             date, category_pk, amount, owner_id):
+    """サクセスメッセージを作って返す。カテゴリ名は所有者のレジストリから引く"""
+    category_model = {'Payment': PaymentCategory,
+                      'Income': IncomeCategory,
+                      'Asset': AssetCategory}[target_model_name]
+    category = get_registry(category_model, owner_id).name(category_pk)
 
     msg = f"""
     Successfully {register_or_delete_string} {target_model_name}\n
@@ -416,3 +816,42 @@ def success_message_for_item(register_or_delete_string: Literal['Register', 'Del
     Amount:{amount}
     """
     return msg
+
+
+def save_asset_snapshot(owner_id, snapshot_date, amounts):
+    """
+    owner_idの所有者のsnapshot_dateの月の資産を、カテゴリごとにまとめて登録、更新する
+    amountsは{category_pk:amount}という辞書で、その月に登録済みのカテゴリは日付と金額を更新する
+    カテゴリはowner_idの所有者のものであること
+    1つのトランザクションで行い、(登録件数, 更新件数)を返す
+    """
+    month = snapshot_date.replace(day=1)
+    with transaction.atomic():
+        registered = {asset.category_id: asset for asset in
+                      Asset.objects.select_for_update().filter(owner_id=owner_id, month=month,
+                                                               category__in=list(amounts))}
+        created = []
+        updated = []
+        deltas = {}
+        for category_pk, amount in amounts.items():
+            asset = registered.get(category_pk)
+            if asset is None:
+                asset = Asset(date=snapshot_date, amount=amount, category_id=category_pk, owner_id=owner_id)
+                asset.set_month()
+                created.append(asset)
+                deltas[category_pk] = (amount, 1)
+            else:
+                if amount != asset.amount:
+                    deltas[category_pk] = (amount - asset.amount, 0)
+                asset.date = snapshot_date
+                asset.amount = amount
+                updated.append(asset)
+
+        # bulk_create, bulk_updateではシグナルが飛ばないので、集計とキャッシュはここで更新する
+        # 集計もカテゴリごとではなくまとめて更新する
+        Asset.objects.bulk_create(created)
+        Asset.objects.bulk_update(updated, ['date', 'amount'])
+        apply_deltas(owner_id, MonthlyTotal.KIND_ASSET, snapshot_date, deltas)
+        bump_ledger_version(Asset, owner_id=owner_id)
+
+    return len(created), len(updated)
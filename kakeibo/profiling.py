@@ -0,0 +1,145 @@
+"""
+スタッフ向けのリクエストのプロファイラ
+KAKEIBO_PROFILER_ENABLEDがTrueのとき、スタッフユーザーが家計簿のURLに?_profile=1をつけると
+そのリクエストをcProfileで実行して、pstatsのファイルに保存する
+無効な場合はミドルウェアごと読み込まれないので、リクエストの処理には何も加わらない
+"""
+
+import cProfile
+import datetime
+import json
+import pstats
+import re
+import time
+from pathlib import Path
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.urls import Resolver404, resolve
+
+# 保存するファイル名(拡張子なし)。管理画面のURLにも使う
+PROFILE_NAME = re.compile(r'^[0-9]{8}-[0-9]{12}-[\w-]+$')
+
+
+def profiler_enabled():
+    return getattr(settings, 'KAKEIBO_PROFILER_ENABLED', False)
+
+
+def get_profiler_param():
+    return getattr(settings, 'KAKEIBO_PROFILER_PARAM', '_profile')
+
+
+def get_profile_dir():
+    return Path(getattr(settings, 'KAKEIBO_PROFILER_DIR', Path(settings.BASE_DIR) / 'profiles'))
+
+
+def get_profile_keep():
+    return getattr(settings, 'KAKEIBO_PROFILER_KEEP', 50)
+
+
+def save_profile(profiler, request, response, elapsed_ms):
+    """pstatsとリクエストの情報を保存して、古いものをKAKEIBO_PROFILER_KEEP件まで消す。保存した名前を返す"""
+    directory = get_profile_dir()
+    directory.mkdir(parents=True, exist_ok=True)
+    match = request.resolver_match
+    now = datetime.datetime.now()
+    name = f'{now:%Y%m%d-%H%M%S%f}-{match.url_name or "view"}'
+    profiler.dump_stats(directory / f'{name}.prof')
+    meta = {
+        'name': name,
+        'created_at': now.isoformat(timespec='seconds'),
+        'path': request.get_full_path(),
+        'view': match.view_name,
+        'user': request.user.get_username(),
+        'status': response.status_code,
+        'elapsed_ms': round(elapsed_ms, 1),
+    }
+    with open(directory / f'{name}.json', 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False)
+    prune_profiles(directory, get_profile_keep())
+    return name
+
+
+def prune_profiles(directory, keep):
+    """新しいものからkeep件を残して削除する。名前は日時から始まるので名前順が作成順になる"""
+    names = sorted(path.stem for path in directory.glob('*.prof'))
+    for name in names[:max(len(names) - keep, 0)]:
+        for suffix in ('.prof', '.json'):
+            (directory / f'{name}{suffix}').unlink(missing_ok=True)
+
+
+def list_profiles():
+    """保存されているプロファイルの情報を新しい順に返す"""
+    directory = get_profile_dir()
+    profiles = []
+    for path in sorted(directory.glob('*.json'), reverse=True):
+        with open(path, encoding='utf-8') as f:
+            profiles.append(json.load(f))
+    return profiles
+
+
+def get_profile_path(name):
+    """nameのpstatsファイルのパスを返す。不正な名前や存在しない場合はNone"""
+    if not PROFILE_NAME.match(name):
+        return None
+    path = get_profile_dir() / f'{name}.prof'
+    return path if path.exists() else None
+
+
+def get_profile_meta(name):
+    """nameのリクエストの情報を返す。get_profile_path()で確かめた名前を渡すこと"""
+    try:
+        with open(get_profile_dir() / f'{name}.json', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {'name': name}
+
+
+def top_functions(path, limit=30, sort='cumulative'):
+    """pstatsファイルからsortの順に上位の関数を返す"""
+    stats = pstats.Stats(str(path))
+    stats.sort_stats(sort)
+    rows = []
+    for func in stats.fcn_list[:limit]:
+        primitive_calls, calls, total_time, cumulative_time, _ = stats.stats[func]
+        rows.append({
+            'function': pstats.func_std_string(func),
+            'calls': calls if calls == primitive_calls else f'{calls}/{primitive_calls}',
+            'tottime_ms': round(total_time * 1000, 3),
+            'cumtime_ms': round(cumulative_time * 1000, 3),
+        })
+    return rows
+
+
+class ProfilerMiddleware:
+    """
+    スタッフユーザーの、家計簿のURLへのKAKEIBO_PROFILER_PARAMつきのリクエストをcProfileで実行するミドルウェア
+    AuthenticationMiddlewareより後に置くこと。保存したプロファイルの名前はX-Kakeibo-Profileヘッダーで返す
+    非同期のビューでスレッドプールに渡した集計はプロファイルに含まれない
+    """
+
+    def __init__(self, get_response):
+        if not profiler_enabled():
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if not self.should_profile(request):
+            return self.get_response(request)
+        profiler = cProfile.Profile()
+        start = time.perf_counter()
+        response = profiler.runcall(self.get_response, request)
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        if request.resolver_match is not None:
+            response['X-Kakeibo-Profile'] = save_profile(profiler, request, response, elapsed_ms)
+        return response
+
+    @staticmethod
+    def should_profile(request):
+        if get_profiler_param() not in request.GET:
+            return False
+        if not request.user.is_staff:
+            return False
+        try:
+            return resolve(request.path_info).app_name == 'kakeibo'
+        except Resolver404:
+            return False
@@ -0,0 +1,172 @@
+"""
+カテゴリと明細の年のレジストリ
+所有者、カテゴリモデルごとに{pk:カテゴリ名}、{カテゴリ名:色}、選択肢をプロセス内に持っておき、
+ダッシュボードのカラーマップ、検索フォーム、メッセージから使う
+カテゴリの保存、削除のシグナルで破棄され、他のプロセスでの更新はキャッシュのバージョン番号で検知する
+バージョン番号がプロセス内のキャッシュにしかない場合は他のプロセスでの更新を検知できないので、毎回DBから読む
+一覧にないpkを引かれた場合も、他のプロセスで追加されたカテゴリかもしれないのでDBから読み直す
+検索フォームの年の選択肢も、明細の日付の範囲を同じようにバージョン番号つきで持っておく
+レジストリは最近使った所有者の分だけ持ち、KAKEIBO_REGISTRY_SIZEを超えたら古いものから捨てる
+"""
+
+import datetime
+import threading
+from collections import OrderedDict
+from django.conf import settings
+from django.db.models import Max, Min
+from .cache import get_ledger_versions, shares_ledger_versions
+from .models import Payment, Income, Asset
+from .seaborn_colorpalette import sns_paired
+
+
+class CategorySnapshot:
+    """ある時点のカテゴリ一覧"""
+
+    def __init__(self, rows, version):
+        self.version = version
+        self.names = dict(rows)
+
+        # 色は所有者のカテゴリのpk順の位置から決めるので、名前の変更やカテゴリの追加では変わらない
+        # pkはすべての所有者で通し番号なので、pkそのものを使うとパレットより少なくても色が重なる
+        # パレットより多い場合は先頭から繰り返す
+        palette = sns_paired()
+        self.colors_by_pk = {pk: palette[i % len(palette)] for i, (pk, _) in enumerate(rows)}
+        self.colors = {}
+        for pk, name in rows:
+            self.colors.setdefault(name, self.colors_by_pk[pk])
+
+        self.choices_by_pk = list(rows)
+        self.choices = sorted(rows, key=lambda row: (row[1], row[0]))
+
+
+class CategoryRegistry:
+    """所有者1人のカテゴリモデル1つ分のレジストリ"""
+
+    def __init__(self, model, owner_id):
+        self.model = model
+        self.owner_id = owner_id
+        self.label = model._meta.label_lower
+        self._snapshot = None
+
+    def invalidate(self):
+        self._snapshot = None
+
+    def load(self, version):
+        rows = list(self.model.objects.filter(owner_id=self.owner_id).order_by('pk').values_list('pk', 'name'))
+        snapshot = CategorySnapshot(rows, version)
+        if shares_ledger_versions():
+            self._snapshot = snapshot
+        return snapshot
+
+    @property
+    def snapshot(self):
+        version = get_ledger_versions(self.model, owner_id=self.owner_id)[self.label]
+        snapshot = self._snapshot
+        if snapshot is None or snapshot.version != version:
+            snapshot = self.load(version)
+        return snapshot
+
+    def name(self, pk):
+        """pkからカテゴリ名を返す。所有者のカテゴリでなければNone"""
+        snapshot = self.snapshot
+        if pk not in snapshot.names:
+            snapshot = self.load(snapshot.version)
+        return snapshot.names.get(pk)
+
+    def color(self, name):
+        """カテゴリ名から色を返す"""
+        return self.snapshot.colors.get(name)
+
+    def color_map(self, names):
+        """カテゴリ名のリストに対応する色のリストを返す"""
+        colors = self.snapshot.colors
+        return [colors.get(name) for name in names]
+
+    def choices(self):
+        """カテゴリ名順の[(pk, カテゴリ名),...]"""
+        return self.snapshot.choices
+
+    def choices_by_pk(self):
+        """pk順の[(pk, カテゴリ名),...]"""
+        return self.snapshot.choices_by_pk
+
+
+class YearRegistry:
+    """
+    所有者1人の明細のある年の範囲
+    明細モデルごとに(バージョン番号, 最初の年, 最後の年)を持ち、更新されたモデルだけ日付の最小、最大を読み直す
+    """
+
+    models = (Payment, Income, Asset)
+
+    def __init__(self, owner_id):
+        self.owner_id = owner_id
+        self._ranges = {}
+
+    def invalidate(self):
+        self._ranges = {}
+
+    def get_range(self, model, version):
+        cached = self._ranges.get(model)
+        if cached is None or cached[0] != version:
+            dates = model.objects.filter(owner_id=self.owner_id).order_by().aggregate(
+                first=Min('date'), last=Max('date'))
+            years = (dates['first'].year, dates['last'].year) if dates['first'] else None
+            cached = (version, years)
+            if shares_ledger_versions():
+                self._ranges[model] = cached
+        return cached[1]
+
+    def years(self):
+        """明細のある最後の年から最初の年までの降順のリスト。明細がなければ今年だけ"""
+        versions = get_ledger_versions(*self.models, owner_id=self.owner_id)
+        ranges = [self.get_range(model, versions[model._meta.label_lower]) for model in self.models]
+        ranges = [years for years in ranges if years is not None]
+        if not ranges:
+            return [datetime.date.today().year]
+        first = min(first for first, _ in ranges)
+        last = max(last for _, last in ranges)
+        return list(range(last, first - 1, -1))
+
+
+def get_registry_size():
+    return getattr(settings, 'KAKEIBO_REGISTRY_SIZE', 1000)
+
+
+class RegistryPool:
+    """キーごとのレジストリを、最近使った順にget_registry_size()個まで持っておく"""
+
+    def __init__(self, factory):
+        self.factory = factory
+        self._registries = OrderedDict()
+        # 非同期のビューでは集計用のスレッドから同時に呼ばれる
+        self._lock = threading.Lock()
+
+    def get(self, *key):
+        with self._lock:
+            registry = self._registries.get(key)
+            if registry is None:
+                registry = self._registries[key] = self.factory(*key)
+                while len(self._registries) > get_registry_size():
+                    self._registries.popitem(last=False)
+            else:
+                self._registries.move_to_end(key)
+            return registry
+
+    def clear(self):
+        with self._lock:
+            self._registries.clear()
+
+
+category_registries = RegistryPool(CategoryRegistry)
+year_registries = RegistryPool(YearRegistry)
+
+
+def get_registry(model, owner_id):
+    """owner_idの所有者のカテゴリモデルのレジストリを返す"""
+    return category_registries.get(model, owner_id)
+
+
+def get_year_registry(owner_id):
+    """owner_idの所有者の明細の年のレジストリを返す"""
+    return year_registries.get(owner_id)
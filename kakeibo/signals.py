@@ -0,0 +1,87 @@
+"""
+明細の保存・削除に合わせて集計テーブルやキャッシュを更新するシグナル
+一覧画面からの登録削除だけでなく、管理画面やimport-exportからの操作も対象になる
+"""
+
+from django.db import connections
+from django.db.migrations.recorder import MigrationRecorder
+from django.db.backends.signals import connection_created
+from django.db.models.signals import pre_save, post_save, post_delete, post_migrate
+from .cache import bump_ledger_version
+from .fulltext import ensure_fulltext_index
+from .instrumentation import install_sql_timer
+from .models import PaymentCategory, IncomeCategory, AssetCategory
+from .registry import get_registry
+from .sqlite_profile import configure_connection
+from .summary import LEDGER_KINDS, add_item, move_item
+
+
+def remember_previous(sender, instance, **kwargs):
+    """編集の場合は保存前の値を控えておく"""
+    instance._kakeibo_previous = None
+    if instance._state.adding or instance.pk is None:
+        return
+    instance._kakeibo_previous = sender.objects.filter(pk=instance.pk).first()
+
+
+def update_monthly_total_on_save(sender, instance, created, raw=False, **kwargs):
+    """保存された明細を集計に反映する"""
+    if raw:
+        # loaddataの場合はrebuild_monthly_totalsで作り直す
+        return
+    previous = getattr(instance, '_kakeibo_previous', None)
+    if previous is not None:
+        move_item(previous, instance)
+        if previous.owner_id != instance.owner_id:
+            # 別の所有者のカテゴリに移された場合は、元の所有者のキャッシュも無効にする
+            bump_ledger_version(sender, owner_id=previous.owner_id)
+    else:
+        add_item(instance)
+    instance._kakeibo_previous = None
+
+
+def update_monthly_total_on_delete(sender, instance, **kwargs):
+    """削除された明細を集計から差し引く"""
+    add_item(instance, sign=-1)
+
+
+def bump_version_on_write(sender, instance, raw=False, **kwargs):
+    """明細、カテゴリの書き込みで所有者のキャッシュを無効にする"""
+    bump_ledger_version(sender, owner_id=instance.owner_id)
+
+
+def invalidate_category_registry(sender, instance, **kwargs):
+    """カテゴリの書き込みでプロセス内のレジストリを破棄する"""
+    get_registry(sender, instance.owner_id).invalidate()
+
+
+def ensure_fulltext_after_migrate(sender, using, **kwargs):
+    """テーブルの作り直しで消えた全文検索のトリガーを作り直す"""
+    connection = connections[using]
+    applied = MigrationRecorder(connection).applied_migrations()
+    if ('kakeibo', '0004_description_fulltext') in applied:
+        ensure_fulltext_index(connection)
+
+
+def connect_signals(app_config):
+    for model in LEDGER_KINDS:
+        pre_save.connect(remember_previous, sender=model,
+                         dispatch_uid=f'kakeibo_remember_previous_{model.__name__}')
+        post_save.connect(update_monthly_total_on_save, sender=model,
+                          dispatch_uid=f'kakeibo_monthly_total_save_{model.__name__}')
+        post_delete.connect(update_monthly_total_on_delete, sender=model,
+                            dispatch_uid=f'kakeibo_monthly_total_delete_{model.__name__}')
+    for model in (*LEDGER_KINDS, PaymentCategory, IncomeCategory, AssetCategory):
+        post_save.connect(bump_version_on_write, sender=model,
+                          dispatch_uid=f'kakeibo_bump_version_save_{model.__name__}')
+        post_delete.connect(bump_version_on_write, sender=model,
+                            dispatch_uid=f'kakeibo_bump_version_delete_{model.__name__}')
+    for model in (PaymentCategory, IncomeCategory, AssetCategory):
+        post_save.connect(invalidate_category_registry, sender=model,
+                          dispatch_uid=f'kakeibo_category_registry_save_{model.__name__}')
+        post_delete.connect(invalidate_category_registry, sender=model,
+                            dispatch_uid=f'kakeibo_category_registry_delete_{model.__name__}')
+    post_migrate.connect(ensure_fulltext_after_migrate, sender=app_config,
+                         dispatch_uid='kakeibo_ensure_fulltext')
+    connection_created.connect(configure_connection, dispatch_uid='kakeibo_sqlite_profile')
+    connection_created.connect(install_sql_timer, dispatch_uid='kakeibo_sql_timer')
@@ -0,0 +1,64 @@
+"""
+SQLiteの接続設定
+接続のたびにPRAGMAを実行して、ダッシュボードの読み込み中にも明細を登録できるようにする
+WALにすると読み込みと書き込みが互いを待たなくなり、busy_timeoutの間はロックの解放を待ってから
+「database is locked」にする
+"""
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+# settings.KAKEIBO_SQLITE_PRAGMASがない場合の値。上から順に実行する
+DEFAULT_PRAGMAS = {
+    'journal_mode': 'wal',
+    # WALではNORMALでもデータベースは壊れない。電源断で直前のコミットが失われることはある
+    'synchronous': 'normal',
+    'busy_timeout': 5000,
+    'mmap_size': 256 * 1024 * 1024,
+    # 負の値はKiB単位
+    'cache_size': -20000,
+    'temp_store': 'memory',
+}
+
+
+def get_sqlite_pragmas():
+    return getattr(settings, 'KAKEIBO_SQLITE_PRAGMAS', DEFAULT_PRAGMAS)
+
+
+def check_pragma_name(name):
+    if not name.isidentifier():
+        raise ImproperlyConfigured(f'Invalid SQLite pragma name: {name!r}')
+
+
+def pragma_statement(name, value):
+    """PRAGMA文を作る。設定の値をそのままSQLに入れるので、識別子と整数以外は受けつけない"""
+    check_pragma_name(name)
+    if not isinstance(value, int) and not str(value).isidentifier():
+        raise ImproperlyConfigured(f'Invalid value for SQLite pragma {name}: {value!r}')
+    return f'PRAGMA {name} = {value}'
+
+
+def configure_connection(sender, connection, **kwargs):
+    """connection_createdで呼ばれ、SQLiteの接続にPRAGMAを設定する"""
+    if connection.vendor != 'sqlite':
+        return
+    pragmas = get_sqlite_pragmas()
+    if not pragmas:
+        return
+    with connection.cursor() as cursor:
+        for name, value in pragmas.items():
+            if value is not None:
+                cursor.execute(pragma_statement(name, value))
+
+
+def get_connection_pragmas(connection, names=None):
+    """接続に設定されているPRAGMAの値を{名前:値}で返す"""
+    names = names or get_sqlite_pragmas().keys()
+    values = {}
+    with connection.cursor() as cursor:
+        for name in names:
+            check_pragma_name(name)
+            cursor.execute(f'PRAGMA {name}')
+            row = cursor.fetchone()
+            values[name] = row[0] if row else None
+    return values
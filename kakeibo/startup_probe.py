@@ -0,0 +1,68 @@
+"""
+起動時間の計測用スクリプト。bench_startupコマンドが新しいプロセスで実行する
+WSGIアプリケーションの作成(django.setup()とミドルウェアの読み込み)と、最初のリクエストの時間を測り、
+結果をJSONで標準出力に書く
+ユーザー名を渡すと、そのユーザーでログインしたセッションのCookieをつけてリクエストする
+
+    python -m kakeibo.startup_probe /monthly_balance/2021/5/ [username]
+"""
+
+import json
+import sys
+import time
+
+# 起動時に読み込まれていないことを確かめる重いモジュール
+HEAVY_MODULES = ('pandas', 'numpy', 'django_pandas', 'openpyxl')
+
+
+def login_cookie(username):
+    """usernameのユーザーでログインしたセッションを作って、Cookieヘッダーの値を返す"""
+    from django.conf import settings
+    from django.contrib.auth import BACKEND_SESSION_KEY, HASH_SESSION_KEY, SESSION_KEY, get_user_model
+    from django.contrib.sessions.backends.db import SessionStore
+    user = get_user_model().objects.get(username=username)
+    session = SessionStore()
+    session[SESSION_KEY] = user._meta.pk.value_to_string(user)
+    session[BACKEND_SESSION_KEY] = settings.AUTHENTICATION_BACKENDS[0]
+    session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+    session.save()
+    return f'{settings.SESSION_COOKIE_NAME}={session.session_key}'
+
+
+def main(path, username=None):
+    start = time.perf_counter()
+    from django.core.wsgi import get_wsgi_application
+    application = get_wsgi_application()
+    setup_ms = (time.perf_counter() - start) * 1000
+    loaded_at_setup = [name for name in HEAVY_MODULES if name in sys.modules]
+
+    from io import BytesIO
+    from wsgiref.util import setup_testing_defaults
+    from django.conf import settings
+    hosts = [host for host in settings.ALLOWED_HOSTS if host != '*']
+    host = hosts[0].lstrip('.') if hosts else 'localhost'
+    path, _, query = path.partition('?')
+    environ = {'PATH_INFO': path, 'QUERY_STRING': query, 'HTTP_HOST': host, 'SERVER_NAME': host,
+               'wsgi.input': BytesIO(), 'wsgi.errors': sys.stderr}
+    setup_testing_defaults(environ)
+    if username:
+        # セッションの作成はsetupにも最初のリクエストにも含めない
+        environ['HTTP_COOKIE'] = login_cookie(username)
+    statuses = []
+
+    start = time.perf_counter()
+    body = b''.join(application(environ, lambda status, headers: statuses.append(status)))
+    first_request_ms = (time.perf_counter() - start) * 1000
+
+    print(json.dumps({
+        'setup_ms': round(setup_ms, 3),
+        'first_request_ms': round(first_request_ms, 3),
+        'status': int(statuses[0].split()[0]),
+        'bytes': len(body),
+        'loaded_at_setup': loaded_at_setup,
+        'loaded_after_request': [name for name in HEAVY_MODULES if name in sys.modules],
+    }))
+
+
+if __name__ == '__main__':
+    main(*sys.argv[1:3])
@@ -17,4 +17,13 @@ document.addEventListener('DOMContentLoaded', e => {
       searchForm.submit();
     })
   }
+
+  // 表示範囲と集計単位
+  for (const name of ['start', 'end', 'last', 'period']) {
+    for (const input of document.getElementsByName(name)) {
+      input.addEventListener('change', () => {
+        searchForm.submit();
+      });
+    }
+  }
 });
@@ -0,0 +1,278 @@
+"""
+MonthlyTotal(所有者・月・カテゴリごとの集計)とAssetSeries(所有者・月ごとの資産合計)を維持する関数群
+どの集計も所有者ごとに分かれているので、ほかの所有者の明細の量に影響されない
+"""
+
+import math
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Sum
+from django.db.models.functions import ExtractMonth, ExtractYear
+from .models import Payment, Income, Asset, MonthlyTotal, AssetSeries
+
+# 集計対象のモデルと種別の対応
+LEDGER_KINDS = {
+    Payment: MonthlyTotal.KIND_PAYMENT,
+    Income: MonthlyTotal.KIND_INCOME,
+    Asset: MonthlyTotal.KIND_ASSET,
+}
+
+
+def to_date(model, value):
+    """文字列で渡された日付もdateに変換して返す"""
+    return model._meta.get_field('date').to_python(value)
+
+
+def apply_delta(owner_id, kind, date, category_pk, amount, count):
+    """集計テーブルの該当行にamountとcountを加算する"""
+    lookup = {'owner_id': owner_id,
+              'year': date.year,
+              'month': date.month,
+              'kind': kind,
+              'category_pk': category_pk}
+
+    # 呼び出し元のトランザクションの中ではセーブポイントを作らない
+    with transaction.atomic(savepoint=False):
+        updated = MonthlyTotal.objects.filter(**lookup).update(total=F('total') + amount,
+                                                                count=F('count') + count)
+        if not updated:
+            try:
+                with transaction.atomic():
+                    MonthlyTotal.objects.create(total=amount, count=count, **lookup)
+            except IntegrityError:
+                # 同時に作成された場合は加算し直す
+                MonthlyTotal.objects.filter(**lookup).update(total=F('total') + amount,
+                                                             count=F('count') + count)
+
+        # 件数が0になった行は消しておく
+        if count < 0:
+            MonthlyTotal.objects.filter(count__lte=0, **lookup).delete()
+
+        if kind == MonthlyTotal.KIND_ASSET:
+            apply_asset_delta(owner_id, date, amount, count)
+
+
+def apply_deltas(owner_id, kind, date, deltas):
+    """
+    同じ月の複数のカテゴリの集計にまとめて加算する。deltasは{category_pk:(amount, count)}
+    カテゴリの数によらず、集計テーブルの読み込み、更新、作成はそれぞれ1回のクエリで行う
+    """
+    if not deltas:
+        return
+    lookup = {'owner_id': owner_id, 'year': date.year, 'month': date.month, 'kind': kind}
+
+    with transaction.atomic(savepoint=False):
+        rows = list(MonthlyTotal.objects.select_for_update().filter(category_pk__in=list(deltas), **lookup))
+        for row in rows:
+            amount, count = deltas[row.category_pk]
+            row.total += amount
+            row.count += count
+        MonthlyTotal.objects.bulk_update(rows, ['total', 'count'])
+
+        existing = {row.category_pk for row in rows}
+        missing = {category_pk: delta for category_pk, delta in deltas.items() if category_pk not in existing}
+        if missing:
+            try:
+                with transaction.atomic():
+                    MonthlyTotal.objects.bulk_create([
+                        MonthlyTotal(total=amount, count=count, category_pk=category_pk, **lookup)
+                        for category_pk, (amount, count) in missing.items()])
+            except IntegrityError:
+                # 同時に作成された場合は1件ずつ加算し直す
+                for category_pk, (amount, count) in missing.items():
+                    apply_delta(owner_id, kind, date, category_pk, amount, count)
+                missing = {}
+
+        # 件数が0になった行は消しておく
+        if any(count < 0 for _, count in deltas.values()):
+            MonthlyTotal.objects.filter(count__lte=0, category_pk__in=list(deltas), **lookup).delete()
+
+        if kind == MonthlyTotal.KIND_ASSET:
+            # 1件ずつ加算し直した分はapply_deltaで反映済み
+            applied = [delta for category_pk, delta in deltas.items()
+                       if category_pk in existing or category_pk in missing]
+            if applied:
+                apply_asset_delta(owner_id, date, sum(amount for amount, _ in applied),
+                                  sum(count for _, count in applied))
+
+
+def change_rate(current, prev):
+    """前月からの変化率を返す。pandasのpct_change().fillna(0)と同じ値になる"""
+    if prev is None:
+        return 0.0
+    if prev == 0:
+        if current == 0:
+            return 0.0
+        return math.copysign(math.inf, current)
+    return current / prev - 1
+
+
+def apply_asset_delta(owner_id, date, amount, count):
+    """月ごとの資産合計にamountとcountを加算し、前月比を更新する"""
+    lookup = {'owner_id': owner_id, 'month': date.replace(day=1)}
+    with transaction.atomic(savepoint=False):
+        updated = AssetSeries.objects.filter(**lookup).update(total=F('total') + amount,
+                                                              count=F('count') + count)
+        if not updated:
+            try:
+                with transaction.atomic():
+                    AssetSeries.objects.create(total=amount, count=count, **lookup)
+            except IntegrityError:
+                AssetSeries.objects.filter(**lookup).update(total=F('total') + amount,
+                                                            count=F('count') + count)
+        if count < 0:
+            AssetSeries.objects.filter(count__lte=0, **lookup).delete()
+
+        update_asset_changes(owner_id, lookup['month'])
+
+
+def update_asset_changes(owner_id, month):
+    """
+    monthと、その次に登録のある月の前月比を計算し直す
+    それより後の月の前月比は変わらないので、履歴の長さによらずクエリ数は一定
+    """
+    series = AssetSeries.objects.filter(owner_id=owner_id)
+    prev_total = series.filter(month__lt=month).order_by('-month').values_list('total', flat=True).first()
+    changed = []
+    for row in series.filter(month__gte=month).order_by('month')[:2]:
+        change = change_rate(row.total, prev_total)
+        if row.change != change:
+            row.change = change
+            changed.append(row)
+        prev_total = row.total
+    AssetSeries.objects.bulk_update(changed, ['change'])
+
+
+def add_item(instance, sign=1):
+    """登録された明細を集計に反映する。sign=-1で取り消し"""
+    model = type(instance)
+    date = to_date(model, instance.date)
+    apply_delta(instance.owner_id, LEDGER_KINDS[model], date, instance.category_id,
+                sign * int(instance.amount), sign)
+
+
+def move_item(previous, instance):
+    """
+    編集された明細を集計に反映する
+    所有者、月、カテゴリが変わらない場合は、金額の差分だけを加算する
+    """
+    model = type(instance)
+    previous_date = to_date(model, previous.date)
+    date = to_date(model, instance.date)
+    if (previous.owner_id, previous_date.year, previous_date.month, previous.category_id) != \
+            (instance.owner_id, date.year, date.month, instance.category_id):
+        add_item(previous, sign=-1)
+        add_item(instance)
+        return
+
+    diff = int(instance.amount) - int(previous.amount)
+    if diff:
+        apply_delta(instance.owner_id, LEDGER_KINDS[model], date, instance.category_id, diff, 0)
+
+
+def owned(queryset, owner_id=None):
+    """owner_idが指定されていればその所有者の行に絞り込む"""
+    return queryset if owner_id is None else queryset.filter(owner_id=owner_id)
+
+
+def calc_monthly_totals(model, owner_id=None):
+    """
+    明細テーブルから集計し直した値を返す
+    {(owner_id, year, month, category_pk): (total, count)}という辞書になる
+    """
+    rows = owned(model.objects.all(), owner_id).annotate(
+        date_year=ExtractYear('date'),
+        date_month=ExtractMonth('date'),
+    ).values('owner_id', 'date_year', 'date_month', 'category_id').annotate(
+        total=Sum('amount'),
+        count=Count('id'),
+    ).order_by()
+
+    return {(row['owner_id'], row['date_year'], row['date_month'], row['category_id']):
+            (row['total'], row['count']) for row in rows}
+
+
+def stored_monthly_totals(kind, owner_id=None):
+    """集計テーブルの値をcalc_monthly_totalsと同じ形式で返す"""
+    rows = owned(MonthlyTotal.objects.filter(kind=kind), owner_id).values_list(
+        'owner_id', 'year', 'month', 'category_pk', 'total', 'count')
+    return {(owner, year, month, category_pk): (total, count)
+            for owner, year, month, category_pk, total, count in rows}
+
+
+def calc_asset_series(owner_id=None):
+    """
+    資産テーブルから所有者、月ごとの合計と前月比を計算し直した値を返す
+    {(owner_id, month): (total, count, change)}という辞書になる
+    """
+    rows = owned(Asset.objects.all(), owner_id).values_list('owner_id', 'month').annotate(
+        total=Sum('amount'), count=Count('id')).order_by('owner_id', 'month')
+    series = {}
+    prev_owner = prev_total = None
+    for owner, month, total, count in rows:
+        if owner != prev_owner:
+            prev_owner, prev_total = owner, None
+        series[(owner, month)] = (total, count, change_rate(total, prev_total))
+        prev_total = total
+    return series
+
+
+def stored_asset_series(owner_id=None):
+    """AssetSeriesの値をcalc_asset_seriesと同じ形式で返す"""
+    rows = owned(AssetSeries.objects.all(), owner_id).values_list('owner_id', 'month', 'total', 'count', 'change')
+    return {(owner, month): (total, count, change) for owner, month, total, count, change in rows}
+
+
+def rebuild_asset_series(owner_id=None):
+    """月ごとの資産合計を資産テーブルから作り直す。作成した行数を返す"""
+    with transaction.atomic():
+        owned(AssetSeries.objects.all(), owner_id).delete()
+        objs = [AssetSeries(owner_id=owner, month=month, total=total, count=count, change=change)
+                for (owner, month), (total, count, change) in calc_asset_series(owner_id).items()]
+        AssetSeries.objects.bulk_create(objs, batch_size=500)
+    return len(objs)
+
+
+def rebuild_monthly_totals(models=None, owner_id=None):
+    """集計テーブルを明細から作り直す。owner_idを指定するとその所有者の分だけ作り直す。作成した行数を返す"""
+    models = models or LEDGER_KINDS.keys()
+    created = 0
+    with transaction.atomic():
+        for model in models:
+            kind = LEDGER_KINDS[model]
+            owned(MonthlyTotal.objects.filter(kind=kind), owner_id).delete()
+            objs = [MonthlyTotal(owner_id=owner, year=year, month=month, kind=kind, category_pk=category_pk,
+                                 total=total, count=count)
+                    for (owner, year, month, category_pk), (total, count)
+                    in calc_monthly_totals(model, owner_id).items()]
+            MonthlyTotal.objects.bulk_create(objs, batch_size=500)
+            created += len(objs)
+        if Asset in models:
+            created += rebuild_asset_series(owner_id)
+    return created
+
+
+def find_drift(models=None, owner_id=None):
+    """
+    集計テーブルと明細のずれを返す
+    [(kind, (owner_id, year, month, category_pk), 期待値, 集計テーブルの値),...]
+    """
+    models = models or LEDGER_KINDS.keys()
+    drift = []
+    for model in models:
+        kind = LEDGER_KINDS[model]
+        expected = calc_monthly_totals(model, owner_id)
+        stored = stored_monthly_totals(kind, owner_id)
+        for key in sorted(set(expected) | set(stored)):
+            if expected.get(key) != stored.get(key):
+                drift.append((kind, key, expected.get(key), stored.get(key)))
+
+    if Asset in models:
+        # 月ごとの資産合計はカテゴリを持たないので、category_pkはNoneにする
+        expected = calc_asset_series(owner_id)
+        stored = stored_asset_series(owner_id)
+        for owner, month in sorted(set(expected) | set(stored)):
+            key = (owner, month)
+            if expected.get(key) != stored.get(key):
+                drift.append(('asset_series', (owner, month.year, month.month, None),
+                              expected.get(key), stored.get(key)))
+    return drift
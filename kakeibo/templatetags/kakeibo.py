@@ -1,4 +1,5 @@
 from django import template
+from ..cache import get_cached_fragment
 
 register = template.Library()
 
@@ -11,3 +12,31 @@ def url_replace(request, field, value):
     url_dict = request.GET.copy()
     url_dict[field] = str(value)
     return url_dict.urlencode()
+
+
+class LedgerFragmentNode(template.Node):
+
+    def __init__(self, nodelist, name):
+        self.nodelist = nodelist
+        self.name = name
+
+    def render(self, context):
+        digest = context.get('fragment_digest')
+        if not digest:
+            return self.nodelist.render(context)
+        return get_cached_fragment(self.name.resolve(context), digest, lambda: self.nodelist.render(context))
+
+
+@register.tag
+def ledger_fragment(parser, token):
+    """
+    {% ledger_fragment "名前" %}...{% endledger_fragment %}で囲んだ部分の描画結果をキャッシュする
+    キーはビューがcontextに入れるfragment_digest(所有者、明細のバージョン番号、GETパラメータ)と名前
+    fragment_digestがなければ毎回描画する
+    """
+    bits = token.split_contents()
+    if len(bits) != 2:
+        raise template.TemplateSyntaxError(f"'{bits[0]}' tag takes exactly one argument: the fragment name")
+    nodelist = parser.parse(('endledger_fragment',))
+    parser.delete_first_token()
+    return LedgerFragmentNode(nodelist, parser.compile_filter(bits[1]))
@@ -1,3 +1,1656 @@
-from django.test import TestCase
+import asyncio
+import datetime
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+from io import StringIO
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import IntegrityError, connection, connections, transaction
+from asgiref.sync import async_to_sync
+from django.test import AsyncClient, RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from .models import Payment, PaymentCategory, Income, IncomeCategory, Asset, AssetCategory, MonthlyTotal, \
+    AssetSeries
+from .benchmark import DashboardURLConf
+from .cache import get_cache, get_cache_stats, get_ledger_versions
+from .chart_range import ChartRange, group_by_period, lttb_indices, reduce_series, select_range
+from .concurrency import gather_aggregates
+from .profiling import get_profile_path, top_functions
+from .registry import get_registry, get_year_registry
+from .summary import find_drift, calc_asset_series, stored_asset_series
 
-# Create your tests here.
+
+class LedgerTestMixin:
+    """テスト用のユーザーとカテゴリを作成し、そのユーザーでログインする"""
+
+    # ログインしたリクエストでセッションとユーザーを読み込むクエリの数
+    auth_queries = 2
+
+    def setUp(self):
+        super().setUp()
+        get_cache().clear()
+        self.client.force_login(self.user)
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = get_user_model().objects.create_user('alice', password='password')
+        cls.food = PaymentCategory.objects.create(name='食費', owner=cls.user)
+        cls.house = PaymentCategory.objects.create(name='住宅', owner=cls.user)
+        cls.salary = IncomeCategory.objects.create(name='給与', owner=cls.user)
+        cls.bank = AssetCategory.objects.create(name='銀行', owner=cls.user)
+        cls.stock = AssetCategory.objects.create(name='株式', owner=cls.user)
+
+    def make_view(self, view_class, params=None, **kwargs):
+        """ログインユーザーのリクエストでビューを作る"""
+        request = RequestFactory().get('/', params or {})
+        request.user = self.user
+        view = view_class()
+        view.setup(request, **kwargs)
+        return view
+
+
+class MonthlyTotalTests(LedgerTestMixin, TestCase):
+    """集計テーブルの差分更新"""
+
+    def get_total(self, kind, category_pk, year=2021, month=5):
+        return MonthlyTotal.objects.filter(year=year, month=month, kind=kind,
+                                           category_pk=category_pk).values_list('total', 'count').first()
+
+    def test_create_update_delete(self):
+        payment = Payment.objects.create(date=datetime.date(2021, 5, 1), amount=1000, category=self.food)
+        Payment.objects.create(date='2021-05-20', amount=500, category=self.food)
+        self.assertEqual(self.get_total('payment', self.food.pk), (1500, 2))
+
+        # 金額、カテゴリ、月の変更
+        payment.amount = 3000
+        payment.category = self.house
+        payment.date = datetime.date(2021, 6, 1)
+        payment.save()
+        self.assertEqual(self.get_total('payment', self.food.pk), (500, 1))
+        self.assertEqual(self.get_total('payment', self.house.pk, month=6), (3000, 1))
+
+        payment.delete()
+        self.assertIsNone(self.get_total('payment', self.house.pk, month=6))
+        self.assertEqual(find_drift(), [])
+
+    def test_views_keep_totals(self):
+        self.client.post(reverse('kakeibo:payment_create'),
+                         {'date': '2021-05-03', 'amount': 800, 'category': self.food.pk})
+        self.assertEqual(self.get_total('payment', self.food.pk), (800, 1))
+
+        payment = Payment.objects.get()
+        self.client.post(reverse('kakeibo:payment_delete', args=[payment.pk]))
+        self.assertIsNone(self.get_total('payment', self.food.pk))
+
+    def test_rebuild_and_check(self):
+        Payment.objects.create(date=datetime.date(2021, 5, 1), amount=1000, category=self.food)
+        Income.objects.create(date=datetime.date(2021, 5, 25), amount=300000, category=self.salary)
+        Asset.objects.create(date=datetime.date(2021, 5, 31), amount=10 ** 7, category=self.bank)
+        MonthlyTotal.objects.filter(kind='income').update(total=1)
+
+        with self.assertRaises(CommandError):
+            call_command('rebuild_monthly_totals', '--check', stdout=StringIO())
+
+        call_command('rebuild_monthly_totals', stdout=StringIO())
+        self.assertEqual(find_drift(), [])
+        self.assertEqual(self.get_total('income', self.salary.pk), (300000, 1))
+
+
+class MonthlyBalanceTests(LedgerTestMixin, TestCase):
+    """月間収支ページ"""
+
+    def test_context(self):
+        Payment.objects.create(date=datetime.date(2021, 5, 1), amount=1000, category=self.food)
+        Payment.objects.create(date=datetime.date(2021, 5, 2), amount=2000, category=self.house)
+        Payment.objects.create(date=datetime.date(2021, 5, 3), amount=500, category=self.food)
+        Payment.objects.create(date=datetime.date(2021, 6, 1), amount=9999, category=self.food)
+        Income.objects.create(date=datetime.date(2021, 5, 25), amount=5000, category=self.salary)
+
+        response = self.client.get(reverse('kakeibo:monthly_balance', args=[2021, 5]))
+        context = response.context
+        self.assertEqual(context['donut_chart_labels'], ['住宅', '食費'])
+        self.assertEqual(context['donut_chart_values'], [2000, 1500])
+        self.assertEqual(context['total_payment'], 3500)
+        self.assertEqual(context['total_income'], 5000)
+        self.assertEqual(context['balance'], 1500)
+
+    def test_empty_month(self):
+        response = self.client.get(reverse('kakeibo:monthly_balance', args=[2021, 5]))
+        self.assertNotIn('donut_chart_labels', response.context)
+
+
+class AggregationBackendTests(LedgerTestMixin, TestCase):
+    """SQLでの集計とpandasでの集計が同じ結果になること"""
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        payments = [(datetime.date(2021, 3, 5), 1200, cls.food),
+                    (datetime.date(2021, 3, 20), 80000, cls.house),
+                    (datetime.date(2021, 5, 1), 1000, cls.food),
+                    (datetime.date(2021, 5, 2), 2000, cls.house),
+                    (datetime.date(2021, 5, 3), 500, cls.food)]
+        for date, amount, category in payments:
+            Payment.objects.create(date=date, amount=amount, category=category)
+        for date, amount in ((datetime.date(2021, 4, 25), 250000), (datetime.date(2021, 5, 25), 260000)):
+            Income.objects.create(date=date, amount=amount, category=cls.salary)
+        assets = [(datetime.date(2021, 3, 31), 1000000, cls.bank),
+                  (datetime.date(2021, 4, 30), 1100000, cls.bank),
+                  (datetime.date(2021, 4, 30), 300000, cls.stock),
+                  (datetime.date(2021, 5, 31), 1050000, cls.bank),
+                  (datetime.date(2021, 5, 31), 320000, cls.stock)]
+        for date, amount, category in assets:
+            Asset.objects.create(date=date, amount=amount, category=category)
+
+    def get_data(self, view_class, backend, method, *args, **kwargs):
+        view = self.make_view(view_class, **kwargs)
+        view.aggregation_backend = backend
+        return getattr(view, method)(*args)
+
+    def assert_same_output(self, view_class, method, *args, **kwargs):
+        database = self.get_data(view_class, 'database', method, *args, **kwargs)
+        pandas = self.get_data(view_class, 'pandas', method, *args, **kwargs)
+        self.assertEqual(database, pandas)
+        return database
+
+    def test_monthly_balance(self):
+        from .views import MonthlyBalance
+        for month in (3, 4, 5):
+            self.assert_same_output(MonthlyBalance, 'get_monthly_balance_data', year=2021, month=month)
+
+    def test_balance_transition(self):
+        from .forms import TransitionGraphSearchForm
+        from .views import TransitionView
+        for params in ({}, {'graph_visible': 'All'}, {'graph_visible': 'Income'},
+                       {'payment_category': self.food.pk, 'graph_visible': 'Payment'}):
+            form = TransitionGraphSearchForm(params or None, owner_id=self.user.pk)
+            data = self.assert_same_output(TransitionView, 'get_balance_transition_data', form)
+        self.assertEqual(data['payments'], [1200, 0, 1500])
+
+    def test_asset_dashboard(self):
+        from .views import AssetDashboard
+        for month in (4, 5, 6):
+            data = self.assert_same_output(AssetDashboard, 'get_asset_dash_data', year=2021, month=month)
+        self.assertEqual(data['heights'], [1000000, 1400000, 1370000])
+
+
+class BalanceTransitionTests(LedgerTestMixin, TestCase):
+    """収支推移ページ"""
+
+    def create_ledger(self, years, per_month):
+        """2016年から数年分の明細を作る。2017年はまるごと空けておく"""
+        payments = []
+        incomes = []
+        for year in range(2016, 2016 + years):
+            if year == 2017:
+                continue
+            for month in range(1, 13):
+                for day in range(1, per_month + 1):
+                    payments.append(Payment(date=datetime.date(year, month, day), amount=100, owner=self.user,
+                                            category=self.food if day % 2 else self.house))
+                incomes.append(Income(date=datetime.date(year, month, 25), amount=5000, owner=self.user,
+                                      category=self.salary))
+        Payment.objects.bulk_create(payments)
+        Income.objects.bulk_create(incomes)
+
+    def get_data(self, params=None):
+        from .forms import TransitionGraphSearchForm
+        from .views import TransitionView
+        return self.make_view(TransitionView).get_balance_transition_data(
+            TransitionGraphSearchForm(params, owner_id=self.user.pk))
+
+    def test_months_are_filled(self):
+        self.create_ledger(years=4, per_month=2)
+        data = self.get_data()
+        self.assertEqual(len(data['labels']), 48)
+        self.assertEqual(data['labels'][12:14], ['2017-01', '2017-02'])
+        self.assertEqual(data['payments'][:13], [200] * 12 + [0])
+        self.assertEqual(data['incomes'][12:24], [0] * 12)
+
+        data = self.get_data({'payment_category': self.house.pk, 'graph_visible': 'Payment'})
+        self.assertEqual(len(data['labels']), 48)
+        self.assertEqual(data['payments'][0], 100)
+        self.assertIsNone(data['incomes'])
+
+    def test_query_count_does_not_depend_on_rows(self):
+        self.create_ledger(years=6, per_month=20)
+        with self.assertNumQueries(2):
+            data = self.get_data({'graph_visible': 'All'})
+        self.assertEqual(len(data['labels']), 72)
+        self.assertEqual(data['payments'][-1], 2000)
+
+
+class QueryPlanTests(LedgerTestMixin, TestCase):
+    """年月の絞り込みでインデックスが使われること(SQLite)"""
+
+    ledger_tables = ('kakeibo_payment', 'kakeibo_income', 'kakeibo_asset', 'kakeibo_monthlytotal')
+
+    def get_query_plan(self, sql):
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql)
+            return [row[-1] for row in cursor.fetchall()]
+
+    def assert_no_full_scan(self, url):
+        """明細、集計テーブルをインデックスなしで全件走査するクエリがないことを確認する"""
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+
+        checked = 0
+        for query in context.captured_queries:
+            # SQLiteではパラメータが埋め込まれたsqlになる
+            sql = query['sql']
+            if not sql.startswith('SELECT'):
+                continue
+            for detail in self.get_query_plan(sql):
+                words = detail.split()
+                if len(words) < 2 or words[1] not in self.ledger_tables:
+                    continue
+                checked += 1
+                self.assertFalse(words[0] == 'SCAN' and 'INDEX' not in detail, f'{detail}\n{sql}')
+        self.assertTrue(checked)
+
+    def test_list_views(self):
+        self.assert_no_full_scan(reverse('kakeibo:payment_list') + '?year=2021&month=5')
+        self.assert_no_full_scan(reverse('kakeibo:income_list') + '?year=2021')
+        self.assert_no_full_scan(reverse('kakeibo:asset_list') + f'?year=2021&month=5&search_category={self.bank.pk}')
+
+    def test_monthly_balance(self):
+        Payment.objects.create(date=datetime.date(2021, 5, 1), amount=1000, category=self.food)
+        self.assert_no_full_scan(reverse('kakeibo:monthly_balance', args=[2021, 5]))
+
+    def test_asset_dashboard(self):
+        Asset.objects.create(date=datetime.date(2021, 5, 31), amount=1000, category=self.bank)
+        self.assert_no_full_scan(reverse('kakeibo:asset_dashboard', args=[2021, 5]))
+
+
+@override_settings(KAKEIBO_KEYSET_PAGINATION=True, KAKEIBO_KEYSET_COUNT_CAP=20)
+class KeysetPaginationTests(LedgerTestMixin, TestCase):
+    """一覧ページのキーセットページング"""
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        # 同じ日付の明細をまたいでページングできるように、1日に2件ずつ登録する
+        for i in range(25):
+            Payment.objects.create(date=datetime.date(2021, 5, 1 + i // 2), amount=100 + i,
+                                   category=cls.food if i % 3 else cls.house)
+
+    def get_page(self, params):
+        response = self.client.get(reverse('kakeibo:payment_list'), params)
+        return response.context['page_obj']
+
+    def test_pages_match_offset_order(self):
+        expected = list(Payment.objects.order_by('-date', '-id').values_list('pk', flat=True))
+
+        page = self.get_page({})
+        pages = [page]
+        while page.has_next():
+            page = self.get_page({'cursor': page.next_cursor})
+            pages.append(page)
+        self.assertEqual([obj.pk for page in pages for obj in page.object_list], expected)
+        self.assertEqual([page.number for page in pages], [1, 2, 3])
+        self.assertEqual(pages[0].num_pages, '2+')
+
+        # 前のページに戻る
+        page = self.get_page({'cursor': pages[2].prev_cursor})
+        self.assertEqual([obj.pk for obj in page.object_list], expected[10:20])
+        self.assertEqual(page.number, 2)
+        page = self.get_page({'cursor': page.prev_cursor})
+        self.assertEqual([obj.pk for obj in page.object_list], expected[:10])
+        self.assertFalse(page.has_previous())
+
+    def test_filters(self):
+        params = {'search_category': self.house.pk, 'greater_than': 105}
+        expected = list(Payment.objects.filter(category=self.house, amount__gte=105)
+                        .order_by('-date', '-id').values_list('pk', flat=True))
+        page = self.get_page(params)
+        page = self.get_page({**params, 'cursor': page.next_cursor}) if page.has_next() else page
+        self.assertLessEqual(len(expected), 10)
+        self.assertEqual([obj.pk for obj in page.object_list], expected)
+        self.assertEqual(page.count, len(expected))
+        self.assertFalse(page.count_capped)
+
+    def test_deep_page_costs_the_same(self):
+        page = self.get_page({})
+        second = self.get_page({'cursor': page.next_cursor})
+        with CaptureQueriesContext(connection) as first_queries:
+            self.get_page({})
+        with CaptureQueriesContext(connection) as deep_queries:
+            self.get_page({'cursor': second.next_cursor})
+        # 明細テーブルへのクエリ数とその内容がページによらないこと
+        first = [q['sql'] for q in first_queries.captured_queries if 'FROM "kakeibo_payment"' in q['sql']]
+        deep = [q['sql'] for q in deep_queries.captured_queries if 'FROM "kakeibo_payment"' in q['sql']]
+        self.assertEqual(len(first), len(deep))
+        self.assertFalse(any('OFFSET' in sql for sql in deep))
+
+    def test_invalid_cursor(self):
+        page = self.get_page({'cursor': 'broken'})
+        self.assertEqual(page.number, 1)
+
+
+class FulltextSearchTests(LedgerTestMixin, TestCase):
+    """摘要のキーワード検索"""
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        descriptions = ['スーパーで食料品の買い物', 'コンビニでコーヒー', 'カフェでコーヒー豆を購入',
+                        'Coffee beans "special"', '家賃', None, '']
+        Payment.objects.bulk_create([Payment(date=datetime.date(2021, 5, 1), amount=100, category=cls.food,
+                                             owner=cls.user, description=description)
+                                     for description in descriptions])
+
+    def search(self, key_word):
+        response = self.client.get(reverse('kakeibo:payment_list'), {'key_word': key_word})
+        return sorted(payment.description for payment in response.context['payment_list'])
+
+    def expected(self, key_word):
+        queryset = Payment.objects.all()
+        for word in key_word.split():
+            queryset = queryset.filter(description__icontains=word)
+        return sorted(queryset.values_list('description', flat=True))
+
+    def test_same_result_as_icontains(self):
+        for key_word in ('コーヒー', 'コーヒー 豆', 'で', 'coffee', 'COFFEE BEANS', '"special"', '家賃', '存在しない語'):
+            self.assertEqual(self.search(key_word), self.expected(key_word), key_word)
+
+    def test_uses_fulltext_index(self):
+        with CaptureQueriesContext(connection) as context:
+            self.search('コーヒー')
+        self.assertTrue(any('MATCH' in query['sql'] for query in context.captured_queries))
+
+    @override_settings(KAKEIBO_FULLTEXT_SEARCH=False)
+    def test_disabled(self):
+        with CaptureQueriesContext(connection) as context:
+            self.assertEqual(self.search('コーヒー'), self.expected('コーヒー'))
+        self.assertFalse(any('MATCH' in query['sql'] for query in context.captured_queries))
+
+    def test_index_follows_writes(self):
+        payment = Payment.objects.get(description='家賃')
+        payment.description = '家賃の振り込み手数料'
+        payment.save()
+        self.assertEqual(self.search('振り込み'), ['家賃の振り込み手数料'])
+
+        payment.delete()
+        self.assertEqual(self.search('振り込み'), [])
+
+
+class QueryBudgetTests(LedgerTestMixin, TestCase):
+    """
+    各ページのクエリ数の上限
+    明細1件ごとにクエリが増えるような変更をしたら失敗する
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        for i in range(40):
+            date = datetime.date(2021, 5, 1 + i % 28)
+            Payment.objects.create(date=date, amount=100 + i, category=cls.food if i % 2 else cls.house,
+                                   description=f'買い物{i}')
+            Income.objects.create(date=date, amount=1000 + i, category=cls.salary)
+        for month in range(1, 13):
+            for category in (cls.bank, cls.stock):
+                Asset.objects.create(date=datetime.date(2021, month, 10), amount=10000 * month, category=category)
+
+    def setUp(self):
+        super().setUp()
+        self.warm_registries()
+
+    def warm_registries(self):
+        # カテゴリと年のレジストリは温まっている状態で数える
+        for model in (PaymentCategory, IncomeCategory, AssetCategory):
+            get_registry(model, self.user.pk).choices()
+        get_year_registry(self.user.pk).years()
+
+    def assert_query_budget(self, budget, url, data=None, method='get'):
+        """ログインのセッションとユーザーの読み込みを除いたクエリ数がbudget以下であること"""
+        with CaptureQueriesContext(connection) as context:
+            response = getattr(self.client, method)(url, data)
+        self.assertIn(response.status_code, (200, 302))
+        queries = [query['sql'] for query in context.captured_queries
+                   if 'FROM "django_session"' not in query['sql'] and 'FROM "register_user"' not in query['sql']]
+        self.assertLessEqual(len(queries), budget, url + '\n' + '\n'.join(queries))
+
+    def test_list_views(self):
+        self.assert_query_budget(2, reverse('kakeibo:payment_list'))
+        self.assert_query_budget(2, reverse('kakeibo:payment_list'),
+                                 {'year': 2021, 'month': 5, 'key_word': '買い物', 'search_category': self.food.pk})
+        self.assert_query_budget(2, reverse('kakeibo:income_list'))
+        self.assert_query_budget(2, reverse('kakeibo:asset_list'), {'search_category': self.bank.pk})
+        with override_settings(KAKEIBO_KEYSET_PAGINATION=True):
+            self.assert_query_budget(2, reverse('kakeibo:payment_list'))
+
+    def count_export_queries(self, url, data=None):
+        """エクスポートを最後まで読み、ログインのセッションとユーザーの読み込みを除いたクエリ数を返す"""
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url, data)
+            b''.join(response.streaming_content)
+        self.assertEqual(response.status_code, 200)
+        return len([query for query in context.captured_queries if 'FROM "django_session"' not in query['sql']
+                    and 'FROM "register_user"' not in query['sql']])
+
+    def test_exports(self):
+        """エクスポートのクエリ数は行数によらない。行ごとにカテゴリを引くと失敗する"""
+        cases = [(reverse(f'kakeibo:{name}_export'), data) for name in ('payment', 'income', 'asset')
+                 for data in ({}, {'format': 'json'})]
+        before = [self.count_export_queries(url, data) for url, data in cases]
+        self.assertTrue(all(count <= 1 for count in before), before)
+
+        for i in range(40):
+            date = datetime.date(2022, 1 + i % 12, 1 + i % 28)
+            Payment.objects.create(date=date, amount=200 + i, category=self.food if i % 2 else self.house)
+            Income.objects.create(date=date, amount=2000 + i, category=self.salary)
+        for month in range(1, 13):
+            for category in (self.bank, self.stock):
+                Asset.objects.create(date=datetime.date(2022, month, 10), amount=5000 * month, category=category)
+        # 登録で上がったバージョン番号のぶん、レジストリを読み直しておく
+        self.warm_registries()
+
+        for (url, data), count in zip(cases, before):
+            with self.assertNumQueries(self.auth_queries + count):
+                response = self.client.get(url, data)
+                b''.join(response.streaming_content)
+
+    def test_asset_snapshot(self):
+        """スナップショットのクエリ数はカテゴリの数によらない"""
+        url = reverse('kakeibo:asset_snapshot', args=[2021, 5])
+        self.assert_query_budget(1, url)
+        # 登録済みのカテゴリの更新
+        self.assert_query_budget(15, url, {'date': '2021-05-31', f'category_{self.bank.pk}': 1,
+                                           f'category_{self.stock.pk}': 2}, 'post')
+
+        categories = [AssetCategory.objects.create(name=f'口座{i}', owner=self.user) for i in range(6)]
+        self.warm_registries()
+        url = reverse('kakeibo:asset_snapshot', args=[2021, 6])
+        self.assert_query_budget(1, url)
+        data = {'date': '2021-06-30', f'category_{self.bank.pk}': 1, f'category_{self.stock.pk}': 2}
+        data.update({f'category_{category.pk}': 100 + i for i, category in enumerate(categories)})
+        # 登録済みのカテゴリの更新と、新しいカテゴリの登録。カテゴリごとに書き込むと上限を超える
+        self.assert_query_budget(15, url, data, 'post')
+        self.assertEqual(Asset.objects.filter(month=datetime.date(2021, 6, 1)).count(), 8)
+        self.assertEqual(find_drift(), [])
+
+    def test_metrics(self):
+        # メトリクスはプロセス内の集計を返すだけで、ログイン以外のクエリはない
+        self.user.is_staff = True
+        self.user.save()
+        self.assert_query_budget(0, reverse('kakeibo:metrics'))
+
+    def test_dashboards(self):
+        self.assert_query_budget(1, reverse('kakeibo:monthly_balance', args=[2021, 5]))
+        # グラフのデータはAPIから取得するので、ページ自体は集計しない
+        self.assert_query_budget(0, reverse('kakeibo:balance_transition'))
+        self.assert_query_budget(1, reverse('kakeibo:asset_dashboard', args=[2021, 5]))
+
+    @override_settings(KAKEIBO_CACHE_ENABLED=False)
+    def test_chart_api(self):
+        self.assert_query_budget(1, reverse('kakeibo:monthly_balance_chart', args=[2021, 5]))
+        self.assert_query_budget(2, reverse('kakeibo:balance_transition_chart'))
+        self.assert_query_budget(2, reverse('kakeibo:balance_transition_chart'),
+                                 {'payment_category': self.food.pk, 'graph_visible': 'Payment'})
+        self.assert_query_budget(1, reverse('kakeibo:asset_allocation_chart', args=[2021, 5]))
+        self.assert_query_budget(1, reverse('kakeibo:asset_transition_chart'))
+
+    @override_settings(MONTH_OF_BEGIN_TERM=4)
+    def test_asset_table_single_query(self):
+        from .views import AssetDashboard
+        view = self.make_view(AssetDashboard, year=2021, month=5)
+        with self.assertNumQueries(1):
+            items, total = view.get_table_items(view.get_month_pager_data())
+
+        # 期初は4月、前月も4月
+        self.assertEqual([(item['category'], item['current'], item['prev_month'], item['begin_term'])
+                          for item in items], [('株式', 50000, 40000, 40000), ('銀行', 50000, 40000, 40000)])
+        self.assertEqual((total['current'], total['prev_month'], total['begin_term']), (100000, 80000, 80000))
+
+    def test_create_and_delete(self):
+        self.assert_query_budget(4, reverse('kakeibo:payment_create'),
+                                 {'date': '2021-05-02', 'amount': 100, 'category': self.food.pk}, 'post')
+        self.assert_query_budget(4, reverse('kakeibo:income_create'),
+                                 {'date': '2021-05-02', 'amount': 100, 'category': self.salary.pk}, 'post')
+        # 資産は同じ月の登録済みの確認(Asset.validate_unique)が1件増える
+        self.assert_query_budget(17, reverse('kakeibo:asset_create'),
+                                 {'date': '2022-05-02', 'amount': 100, 'category': self.bank.pk}, 'post')
+        self.assert_query_budget(4, reverse('kakeibo:payment_delete', args=[Payment.objects.first().pk]),
+                                 method='post')
+        self.assert_query_budget(4, reverse('kakeibo:income_delete', args=[Income.objects.first().pk]),
+                                 method='post')
+        self.assert_query_budget(9, reverse('kakeibo:asset_delete', args=[Asset.objects.first().pk]),
+                                 method='post')
+
+
+class LedgerCacheTests(LedgerTestMixin, TestCase):
+    """ダッシュボードのcontextデータのキャッシュ"""
+
+    def get_stats(self, name):
+        return get_cache_stats(name)[name]
+
+    def test_monthly_balance(self):
+        url = reverse('kakeibo:monthly_balance', args=[2021, 5])
+        Payment.objects.create(date=datetime.date(2021, 5, 1), amount=1000, category=self.food)
+        self.client.get(url)
+        with self.assertNumQueries(self.auth_queries):
+            response = self.client.get(url)
+        self.assertEqual(response.context['total_payment'], 1000)
+        self.assertEqual(self.get_stats('MonthlyBalance'), {'hits': 1, 'misses': 1})
+
+        # 別の月は別のキャッシュになる
+        self.client.get(reverse('kakeibo:monthly_balance', args=[2021, 6]))
+        self.assertEqual(self.get_stats('MonthlyBalance'), {'hits': 1, 'misses': 2})
+
+        # 明細の登録でキャッシュが無効になる
+        self.client.post(reverse('kakeibo:payment_create'),
+                         {'date': '2021-05-03', 'amount': 500, 'category': self.food.pk})
+        response = self.client.get(url)
+        self.assertEqual(response.context['total_payment'], 1500)
+
+        # カテゴリ名の変更でも無効になる
+        self.food.name = '食料品'
+        self.food.save()
+        response = self.client.get(url)
+        self.assertEqual(response.context['donut_chart_labels'], ['食料品'])
+
+    def test_get_params_are_part_of_the_key(self):
+        Payment.objects.create(date=datetime.date(2021, 5, 1), amount=1000, category=self.food)
+        Income.objects.create(date=datetime.date(2021, 5, 1), amount=3000, category=self.salary)
+        url = reverse('kakeibo:balance_transition_chart')
+        self.assertIsNotNone(self.client.get(url, {'graph_visible': 'All'}).json()['incomes'])
+        self.assertIsNone(self.client.get(url, {'graph_visible': 'Payment'}).json()['incomes'])
+        self.assertEqual(self.get_stats('TransitionChart'), {'hits': 0, 'misses': 2})
+
+    def test_only_related_tables_invalidate(self):
+        Asset.objects.create(date=datetime.date(2021, 5, 1), amount=1000, category=self.bank)
+        url = reverse('kakeibo:asset_dashboard', args=[2021, 5])
+        self.client.get(url)
+        versions = get_ledger_versions(Asset, AssetCategory, owner_id=self.user.pk)
+        Payment.objects.create(date=datetime.date(2021, 5, 1), amount=1000, category=self.food)
+        self.assertEqual(get_ledger_versions(Asset, AssetCategory, owner_id=self.user.pk), versions)
+        self.client.get(url)
+        self.assertEqual(self.get_stats('AssetDashboard'), {'hits': 1, 'misses': 1})
+
+    def test_shared_backend_is_required(self):
+        from .checks import check_ledger_cache
+        self.assertEqual(check_ledger_cache(None), [])
+        # プロセス内のキャッシュでは、ほかのワーカーの登録でキャッシュが無効にならない
+        with override_settings(KAKEIBO_CACHE_ALIAS='default'):
+            self.assertEqual([error.id for error in check_ledger_cache(None)], ['kakeibo.E002'])
+        with override_settings(KAKEIBO_CACHE_ALIAS='default', KAKEIBO_CACHE_ENABLED=False):
+            self.assertEqual(check_ledger_cache(None), [])
+        with override_settings(KAKEIBO_CACHE_ALIAS='missing'):
+            self.assertEqual([error.id for error in check_ledger_cache(None)], ['kakeibo.E001'])
+
+    @override_settings(KAKEIBO_CACHE_ENABLED=False)
+    def test_disabled(self):
+        url = reverse('kakeibo:asset_dashboard', args=[2021, 5])
+        self.client.get(url)
+        self.client.get(url)
+        self.assertEqual(self.get_stats('AssetDashboard'), {'hits': 0, 'misses': 0})
+
+
+class ChartRangeTests(LedgerTestMixin, TestCase):
+    """推移グラフの表示範囲、期間ごとのまとめと間引き"""
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        # 2019-01〜2021-12の36か月。2020-07だけ支出が突出している
+        for year in (2019, 2020, 2021):
+            for month in range(1, 13):
+                amount = 50000 if (year, month) == (2020, 7) else 1000 + month
+                Payment.objects.create(date=datetime.date(year, month, 5), amount=amount, category=cls.food)
+                Income.objects.create(date=datetime.date(year, month, 25), amount=3000, category=cls.salary)
+                Asset.objects.create(date=datetime.date(year, month, 10), amount=10000 * (year - 2018) + month,
+                                     category=cls.bank)
+
+    def test_select_range(self):
+        labels = ['2020-11', '2020-12', '2021-01', '2021-03']
+        self.assertEqual(select_range(labels, [[1, 2, 3, 4], None], start='2020-12', end='2021-02'),
+                         (['2020-12', '2021-01'], [[2, 3], None]))
+        # 直近の月数は暦の月で数える
+        self.assertEqual(select_range(labels, [[1, 2, 3, 4]], last=3), (['2021-01', '2021-03'], [[3, 4]]))
+        self.assertEqual(select_range(labels, [[1, 2, 3, 4]], end='2020-12', last=2),
+                         (['2020-11', '2020-12'], [[1, 2]]))
+
+    def test_group_by_period(self):
+        labels = ['2020-11', '2020-12', '2021-01', '2021-02']
+        self.assertEqual(group_by_period(labels, [[1, 2, 3, 4]], 'quarter'),
+                         (['2020-Q4', '2021-Q1'], [[3, 7]]))
+        self.assertEqual(group_by_period(labels, [[1, 2, 3, 4]], 'year', how='last'),
+                         (['2020', '2021'], [[2, 4]]))
+
+    def test_lttb_keeps_ends_and_peaks(self):
+        values = [0] * 100
+        values[37] = 10
+        values[80] = -10
+        indices = lttb_indices([values], 10)
+        self.assertEqual(len(indices), 10)
+        self.assertEqual((indices[0], indices[-1]), (0, 99))
+        self.assertIn(37, indices)
+        self.assertIn(80, indices)
+        self.assertEqual(indices, sorted(indices))
+        # 点数が上限以下ならそのまま
+        self.assertEqual(lttb_indices([values[:5]], 10), [0, 1, 2, 3, 4])
+
+    def test_reduce_series(self):
+        labels = [f'{2000 + i // 12}-{i % 12 + 1:02d}' for i in range(240)]
+        values = list(range(240))
+        reduced_labels, (reduced, hidden) = reduce_series(labels, [values, None], ChartRange(max_points=50))
+        self.assertEqual(len(reduced_labels), 50)
+        self.assertEqual(len(reduced), 50)
+        self.assertIsNone(hidden)
+        self.assertEqual(reduce_series(labels, [values], ChartRange(period='year', max_points=50))[0],
+                         [str(year) for year in range(2000, 2020)])
+
+    def test_balance_transition_chart(self):
+        url = reverse('kakeibo:balance_transition_chart')
+        self.assertEqual(len(self.client.get(url).json()['labels']), 36)
+
+        data = self.client.get(url, {'last': 3}).json()
+        self.assertEqual(data['labels'], ['2021-10', '2021-11', '2021-12'])
+        self.assertEqual(data['payments'], [1010, 1011, 1012])
+
+        data = self.client.get(url, {'start': '2020-01', 'end': '2020-12', 'period': 'quarter'}).json()
+        self.assertEqual(data['labels'], ['2020-Q1', '2020-Q2', '2020-Q3', '2020-Q4'])
+        self.assertEqual(data['payments'], [3006, 3015, 50000 + 1008 + 1009, 3033])
+        self.assertEqual(data['incomes'], [9000] * 4)
+
+        # 間引いても突出した月は残る
+        data = self.client.get(url, {'points': 8}).json()
+        self.assertEqual(len(data['labels']), 8)
+        self.assertIn('2020-07', data['labels'])
+        self.assertIn(50000, data['payments'])
+
+        # 開始月が終了月より後なら全期間
+        self.assertEqual(len(self.client.get(url, {'start': '2021-01', 'end': '2020-01'}).json()['labels']), 36)
+
+    @override_settings(KAKEIBO_CHART_MAX_POINTS=12)
+    def test_max_points_setting(self):
+        url = reverse('kakeibo:balance_transition_chart')
+        self.assertEqual(len(self.client.get(url).json()['labels']), 12)
+        # pointsで上限を超えることはできない
+        self.assertEqual(len(self.client.get(url, {'points': 100}).json()['labels']), 12)
+
+    def test_asset_transition_chart(self):
+        url = reverse('kakeibo:asset_transition_chart')
+        data = self.client.get(url, {'start': '2020-11', 'end': '2021-02'}).json()
+        self.assertEqual(data['labels'], ['2020-11', '2020-12', '2021-01', '2021-02'])
+        # 月ごとなら保存されている前月比をそのまま使う
+        self.assertEqual(data['totals'], [20011, 20012, 30001, 30002])
+        self.assertAlmostEqual(data['changes'][0], 20011 / 20010 - 1)
+
+        # 年ごとは期末の値で、前年比になる。最初の点は0
+        data = self.client.get(url, {'period': 'year'}).json()
+        self.assertEqual(data['labels'], ['2019', '2020', '2021'])
+        self.assertEqual(data['totals'], [10012, 20012, 30012])
+        self.assertEqual(data['changes'][0], 0)
+        self.assertAlmostEqual(data['changes'][1], 20012 / 10012 - 1)
+
+        # ダッシュボードはGETパラメータをAPIに渡す
+        response = self.client.get(reverse('kakeibo:asset_dashboard', args=[2021, 5]), {'last': 12})
+        self.assertEqual(response.context['line_chart_url'], url + '?last=12')
+
+    def test_backends_agree(self):
+        from .forms import TransitionGraphSearchForm
+        from .views import AssetDashboard, TransitionView
+        params = {'last': 24, 'period': 'quarter', 'points': 5}
+        results = []
+        for backend in ('database', 'pandas'):
+            with override_settings(KAKEIBO_AGGREGATION_BACKEND=backend):
+                view = self.make_view(TransitionView)
+                transition = view.get_balance_transition_data(TransitionGraphSearchForm(params, owner_id=self.user.pk))
+                labels, totals, changes = self.make_view(AssetDashboard, params, year=2021, month=5) \
+                    .get_transition_graph_data()
+                results.append((transition['labels'], [int(v) for v in transition['payments']],
+                                labels, [int(v) for v in totals], [round(float(v), 6) for v in changes]))
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(len(results[0][0]), 5)
+
+
+class FragmentCacheTests(LedgerTestMixin, TestCase):
+    """一覧とダッシュボードのテーブルの描画結果のキャッシュ"""
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        for i in range(15):
+            Payment.objects.create(date=datetime.date(2021, 5, 1 + i), amount=100 + i, category=cls.food,
+                                   description=f'買い物{i}')
+
+    def get_stats(self, name):
+        return get_cache_stats(f'fragment:{name}')[f'fragment:{name}']
+
+    def test_list_table(self):
+        url = reverse('kakeibo:payment_list')
+        self.client.get(url)
+        # キャッシュされたテーブルでは明細のクエリを実行しない(件数だけ数える)
+        with self.assertNumQueries(self.auth_queries + 1):
+            second = self.client.get(url)
+        self.assertContains(second, '買い物14')
+        self.assertNotContains(second, '買い物4')
+        self.assertEqual(self.get_stats('payment_table'), {'hits': 1, 'misses': 1})
+
+        # ページと検索条件は別のキャッシュになる
+        self.assertContains(self.client.get(url, {'page': 2}), '買い物4')
+        self.assertNotContains(self.client.get(url, {'key_word': '買い物1'}), '買い物2')
+        self.assertEqual(self.get_stats('payment_table'), {'hits': 1, 'misses': 3})
+
+        # 明細の登録でキャッシュが無効になる
+        self.client.post(reverse('kakeibo:payment_create'),
+                         {'date': '2021-06-01', 'amount': 500, 'category': self.food.pk, 'description': '新しい明細'})
+        self.assertContains(self.client.get(url), '新しい明細')
+
+        # カテゴリ名の変更でも無効になる
+        self.food.name = '食料品'
+        self.food.save()
+        self.assertContains(self.client.get(url), '食料品')
+
+    def test_keyset_pages_are_separate(self):
+        url = reverse('kakeibo:payment_list')
+        offset = self.client.get(url)
+        with override_settings(KAKEIBO_KEYSET_PAGINATION=True):
+            keyset = self.client.get(url)
+        self.assertNotEqual(offset.context['fragment_digest'], keyset.context['fragment_digest'])
+
+    def test_other_owner(self):
+        url = reverse('kakeibo:payment_list')
+        self.client.get(url)
+        bob = get_user_model().objects.create_user('bob')
+        self.client.force_login(bob)
+        self.assertNotContains(self.client.get(url), '買い物')
+
+    def test_dashboard_table(self):
+        url = reverse('kakeibo:monthly_balance', args=[2021, 5])
+        self.client.get(url)
+        self.assertContains(self.client.get(url), '1,605')
+        self.assertEqual(self.get_stats('monthly_balance_table'), {'hits': 1, 'misses': 1})
+
+    @override_settings(KAKEIBO_CACHE_ENABLED=False)
+    def test_disabled(self):
+        url = reverse('kakeibo:payment_list')
+        self.client.get(url)
+        response = self.client.get(url)
+        self.assertIsNone(response.context['fragment_digest'])
+        self.assertEqual(self.get_stats('payment_table'), {'hits': 0, 'misses': 0})
+
+
+class ChartApiTests(LedgerTestMixin, TestCase):
+    """グラフデータのJSON API"""
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        Payment.objects.create(date=datetime.date(2021, 5, 1), amount=1000, category=cls.food)
+        Payment.objects.create(date=datetime.date(2021, 5, 2), amount=2000, category=cls.house)
+        Income.objects.create(date=datetime.date(2021, 5, 25), amount=5000, category=cls.salary)
+        Asset.objects.create(date=datetime.date(2021, 4, 30), amount=0, category=cls.bank)
+        Asset.objects.create(date=datetime.date(2021, 5, 31), amount=1000, category=cls.bank)
+        Asset.objects.create(date=datetime.date(2021, 5, 31), amount=500, category=cls.stock)
+
+    def test_payloads(self):
+        data = self.client.get(reverse('kakeibo:monthly_balance_chart', args=[2021, 5])).json()
+        self.assertEqual(data['labels'], ['住宅', '食費'])
+        self.assertEqual(data['values'], [2000, 1000])
+        self.assertEqual(len(data['colors']), 2)
+
+        data = self.client.get(reverse('kakeibo:balance_transition_chart'), {'graph_visible': 'Payment'}).json()
+        self.assertEqual(data, {'labels': ['2021-05'], 'payments': [3000], 'incomes': None})
+
+        data = self.client.get(reverse('kakeibo:asset_allocation_chart', args=[2021, 5])).json()
+        self.assertEqual((data['labels'], data['values']), (['株式', '銀行'], [500, 1000]))
+
+        # 0からの増加率は無限大になるので、JSONではnullにする
+        data = self.client.get(reverse('kakeibo:asset_transition_chart')).json()
+        self.assertEqual(data, {'labels': ['2021-04', '2021-05'], 'totals': [0, 1500], 'changes': [0, None]})
+
+    def test_empty_month(self):
+        data = self.client.get(reverse('kakeibo:monthly_balance_chart', args=[2020, 1])).json()
+        self.assertEqual(data, {'labels': [], 'values': [], 'colors': []})
+
+    def test_not_modified(self):
+        url = reverse('kakeibo:monthly_balance_chart', args=[2021, 5])
+        response = self.client.get(url)
+        etag = response['ETag']
+        self.assertIn('private', response['Cache-Control'])
+        self.assertIn('no-cache', response['Cache-Control'])
+        self.assertTrue(response.has_header('Last-Modified'))
+
+        # 何も更新されていなければ集計もキャッシュの読み込みもせずに304を返す
+        with self.assertNumQueries(self.auth_queries):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+
+        # 関係のない表の更新ではETagは変わらない
+        Asset.objects.create(date=datetime.date(2021, 6, 30), amount=100, category=self.bank)
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        # 明細が更新されるとETagが変わり、新しいデータを返す
+        Payment.objects.create(date=datetime.date(2021, 5, 3), amount=500, category=self.food)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(response.json()['values'], [2000, 1500])
+
+    def test_get_params_change_etag(self):
+        url = reverse('kakeibo:balance_transition_chart')
+        all_etag = self.client.get(url, {'graph_visible': 'All'})['ETag']
+        payment_etag = self.client.get(url, {'graph_visible': 'Payment'})['ETag']
+        self.assertNotEqual(all_etag, payment_etag)
+
+    def test_shares_cache_with_page(self):
+        self.client.get(reverse('kakeibo:monthly_balance', args=[2021, 5]))
+        with self.assertNumQueries(self.auth_queries):
+            self.client.get(reverse('kakeibo:monthly_balance_chart', args=[2021, 5]))
+        self.assertEqual(get_cache_stats('MonthlyBalance')['MonthlyBalance'], {'hits': 1, 'misses': 1})
+
+    def test_pages_link_chart_urls(self):
+        response = self.client.get(reverse('kakeibo:balance_transition'), {'graph_visible': 'Payment'})
+        self.assertEqual(response.context['line_chart_url'],
+                         reverse('kakeibo:balance_transition_chart') + '?graph_visible=Payment')
+        response = self.client.get(reverse('kakeibo:asset_dashboard', args=[2021, 5]))
+        self.assertEqual(response.context['donut_chart_url'], reverse('kakeibo:asset_allocation_chart',
+                                                                      args=[2021, 5]))
+        self.assertEqual(response.context['total']['current'], 1500)
+
+
+class CategoryRegistryTests(LedgerTestMixin, TestCase):
+    """カテゴリのレジストリ"""
+
+    def test_colors_are_stable(self):
+        from .seaborn_colorpalette import sns_paired
+        registry = get_registry(PaymentCategory, self.user.pk)
+        food_color = registry.color('食費')
+
+        self.food.name = '食料品'
+        self.food.save()
+        self.assertEqual(registry.color('食料品'), food_color)
+        self.assertIsNone(registry.color('食費'))
+
+        # パレットより多くカテゴリがあっても色が決まる
+        palette = sns_paired()
+        for i in range(len(palette) + 2):
+            PaymentCategory.objects.create(name=f'カテゴリ{i}', owner=self.user)
+        self.assertEqual(registry.color('食料品'), food_color)
+        self.assertTrue(all(registry.color_map([name for _, name in registry.choices()])))
+
+    def test_colors_by_owner_position(self):
+        """pkは所有者をまたいで通し番号なので、パレットより少ないカテゴリの色は重ならない"""
+        from .seaborn_colorpalette import sns_paired
+        palette = sns_paired()
+        other = get_user_model().objects.create_user('bob')
+        for i in range(len(palette) - 1):
+            PaymentCategory.objects.create(name=f'ほかの所有者{i}', owner=other)
+        later = PaymentCategory.objects.create(name='後から追加', owner=self.user)
+        # 以前はpkから色を決めていたので、住宅と同じ色になっていた
+        self.assertEqual((later.pk - self.house.pk) % len(palette), 0)
+
+        registry = get_registry(PaymentCategory, self.user.pk)
+        colors = registry.color_map(['食費', '住宅', '後から追加'])
+        self.assertEqual(colors, palette[:3])
+
+    def test_invalidated_on_delete(self):
+        category = PaymentCategory.objects.create(name='削除するカテゴリ', owner=self.user)
+        self.assertIn((category.pk, '削除するカテゴリ'), get_registry(PaymentCategory, self.user.pk).choices())
+        category.delete()
+        self.assertNotIn((category.pk, '削除するカテゴリ'), get_registry(PaymentCategory, self.user.pk).choices())
+
+    def test_reloads_missing_category(self):
+        """ほかのプロセスで追加され、バージョン番号の更新が届いていないカテゴリもDBから読み直す"""
+        registry = get_registry(PaymentCategory, self.user.pk)
+        registry.choices()
+        # bulk_createはシグナルが飛ばないので、バージョン番号が上がらない
+        PaymentCategory.objects.bulk_create([PaymentCategory(name='新しいカテゴリ', owner=self.user)])
+        category = PaymentCategory.objects.get(name='新しいカテゴリ')
+        Payment.objects.create(date=datetime.date(2021, 5, 1), amount=1000, category=category)
+        Payment.objects.create(date=datetime.date(2021, 5, 2), amount=2000, category=self.food)
+
+        response = self.client.get('/monthly_balance/2021/5/')
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, '新しいカテゴリ')
+        self.assertEqual(registry.name(category.pk), '新しいカテゴリ')
+        self.assertIsNone(registry.name(9999))
+
+    @override_settings(KAKEIBO_CACHE_ALIAS='default', KAKEIBO_CACHE_ENABLED=False)
+    def test_process_local_versions_are_not_trusted(self):
+        """バージョン番号がプロセス内にしかなければ、選択肢を毎回DBから読む"""
+        registry = get_registry(PaymentCategory, self.user.pk)
+        registry.choices()
+        PaymentCategory.objects.bulk_create([PaymentCategory(name='新しいカテゴリ', owner=self.user)])
+        self.assertIn('新しいカテゴリ', [name for _, name in registry.choices()])
+
+    def test_year_choices_follow_ledger(self):
+        from .forms import PaymentSearchForm, IncomeSearchForm, AssetSearchForm
+        get_year_registry(self.user.pk).invalidate()
+
+        def years(form_class):
+            return [value for value, _ in form_class(owner_id=self.user.pk).fields['year'].choices][1:]
+
+        self.assertEqual(years(PaymentSearchForm), [datetime.date.today().year])
+
+        Payment.objects.create(date=datetime.date(2019, 5, 1), amount=1000, category=self.food)
+        Income.objects.create(date=datetime.date(2021, 5, 1), amount=1000, category=self.salary)
+        self.assertEqual(years(PaymentSearchForm), [2021, 2020, 2019])
+
+        # 明細が更新されていなければ、表示も入力チェックもクエリが発生しない
+        with self.assertNumQueries(0):
+            self.assertEqual(years(IncomeSearchForm), [2021, 2020, 2019])
+            self.assertTrue(AssetSearchForm({'year': 2020}, owner_id=self.user.pk).is_valid())
+            self.assertFalse(AssetSearchForm({'year': 2018}, owner_id=self.user.pk).is_valid())
+
+        # 更新されたモデルだけ読み直す
+        Asset.objects.create(date=datetime.date(2023, 1, 1), amount=1000, category=self.bank)
+        with self.assertNumQueries(1):
+            self.assertEqual(years(AssetSearchForm)[0], 2023)
+
+    def test_forms_do_not_query_when_warm(self):
+        from .forms import AssetSearchForm, PaymentCreateForm, PaymentSearchForm, TransitionGraphSearchForm
+        owner_id = self.user.pk
+        for model in (PaymentCategory, IncomeCategory, AssetCategory):
+            get_registry(model, owner_id).choices()
+        get_year_registry(owner_id).years()
+
+        with self.assertNumQueries(0):
+            form = PaymentSearchForm({'search_category': self.food.pk}, owner_id=owner_id)
+            self.assertTrue(form.is_valid())
+            self.assertEqual(form.cleaned_data['search_category'], self.food.pk)
+            self.assertIn('住宅', str(form['search_category']))
+            str(AssetSearchForm(owner_id=owner_id)['search_category'])
+            str(TransitionGraphSearchForm(owner_id=owner_id)['income_category'])
+            str(PaymentCreateForm(owner_id=owner_id)['category'])
+
+        form = PaymentSearchForm({'search_category': 9999}, owner_id=owner_id)
+        self.assertFalse(form.is_valid())
+
+
+class BenchmarkCommandTests(TestCase):
+    """サンプルデータの作成とベンチマーク"""
+
+    def setUp(self):
+        get_cache().clear()
+
+    def test_generate_ledger_is_reproducible(self):
+        call_command('generate_ledger', '--payments', '300', '--years', '1', '--end', '2021-12',
+                     '--seed', '1', '--owner', 'bench', stdout=StringIO())
+        first = list(Payment.objects.order_by('date', 'amount', 'description')
+                     .values_list('date', 'amount', 'description', 'category__name'))
+        self.assertEqual(len(first), 300)
+        self.assertEqual(Asset.objects.count(), 12 * AssetCategory.objects.count())
+        self.assertEqual(find_drift(), [])
+
+        call_command('generate_ledger', '--payments', '300', '--years', '1', '--end', '2021-12',
+                     '--seed', '1', '--owner', 'bench', '--clear', stdout=StringIO())
+        second = list(Payment.objects.order_by('date', 'amount', 'description')
+                      .values_list('date', 'amount', 'description', 'category__name'))
+        self.assertEqual(first, second)
+        self.assertEqual(find_drift(), [])
+
+    def test_bench_report(self):
+        call_command('generate_ledger', '--payments', '100', '--years', '1', '--end', '2021-12',
+                     '--owner', 'bench', stdout=StringIO())
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, 'report.json')
+            call_command('bench_kakeibo', '--repeat', '1', '--only', 'monthly_balance', '--owner', 'bench',
+                         '--output', output, stdout=StringIO())
+            with open(output, encoding='utf-8') as f:
+                report = json.load(f)
+        self.assertEqual(report['meta']['rows']['Payment'], 100)
+        self.assertEqual(list(report['results']), ['monthly_balance'])
+        self.assertEqual(report['results']['monthly_balance']['queries'], 1)
+
+
+    def test_bench_render(self):
+        call_command('generate_ledger', '--payments', '30', '--years', '1', '--end', '2021-12',
+                     '--owner', 'bench', stdout=StringIO())
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, 'report.json')
+            call_command('bench_render', '--repeat', '1', '--rows', '5', '--only', 'payment_table',
+                         '--owner', 'bench', '--output', output, stdout=StringIO())
+            with open(output, encoding='utf-8') as f:
+                report = json.load(f)
+        results = report['results']
+        self.assertEqual(list(results), ['payment_table:load', 'payment_table:5:query',
+                                         'payment_table:5:render', 'payment_table:5:fragment'])
+        # 描画はクエリを含まない
+        self.assertEqual(results['payment_table:5:query']['queries'], 1)
+        self.assertEqual(results['payment_table:5:render']['queries'], 0)
+        self.assertEqual(results['payment_table:5:fragment']['queries'], 0)
+        # 本来のキャッシュには入れない
+        self.assertEqual(get_cache_stats('fragment:payment_table')['fragment:payment_table'],
+                         {'hits': 0, 'misses': 0})
+
+
+class StartupTests(TestCase):
+    """起動時の読み込み"""
+
+    def test_pandas_is_not_imported_at_startup(self):
+        # 新しいプロセスで、WSGIアプリケーションの作成とURL、ビュー、フォーム、管理画面の読み込みを行う
+        script = ('import sys; from django.core.wsgi import get_wsgi_application; get_wsgi_application(); '
+                  'import kakeibo.urls, kakeibo.views, kakeibo.forms, kakeibo.admin; '
+                  'print(",".join(name for name in ("pandas", "django_pandas") if name in sys.modules))')
+        env = dict(os.environ, DJANGO_SETTINGS_MODULE='project.settings')
+        completed = subprocess.run([sys.executable, '-c', script], cwd=settings.BASE_DIR, env=env,
+                                   capture_output=True, text=True, check=True)
+        self.assertEqual(completed.stdout.strip(), '')
+
+
+class LedgerImportTests(LedgerTestMixin, TestCase):
+    """CSVの一括取り込み"""
+
+    csv = ('date,amount,category,description\n'
+           '2021/05/01,"1,200",食費,スーパー\n'
+           '2021-05-02,800,食費,\n'
+           '2021-13-01,abc,食費,bad\n'
+           '2021-06-01,500,不明,unknown\n'
+           '2021-06-02,80000,{house},家賃\n')
+
+    def write_csv(self, directory, encoding='utf-8'):
+        path = os.path.join(directory, 'payments.csv')
+        with open(path, 'w', encoding=encoding) as f:
+            f.write(self.csv.format(house=self.house.pk))
+        return path
+
+    def test_import_command(self):
+        version = get_ledger_versions(Payment, owner_id=self.user.pk)['kakeibo.payment']
+        with tempfile.TemporaryDirectory() as directory:
+            stderr = StringIO()
+            call_command('import_ledger', 'payment', self.write_csv(directory), '--chunk-size', '2',
+                         '--owner', 'alice', stdout=StringIO(), stderr=stderr)
+
+        self.assertEqual(list(Payment.objects.order_by('date').values_list('amount', 'category')),
+                         [(1200, self.food.pk), (800, self.food.pk), (80000, self.house.pk)])
+        self.assertEqual(stderr.getvalue().splitlines(),
+                         ['line 4: invalid date; invalid amount', 'line 5: unknown category'])
+        self.assertEqual(find_drift(), [])
+        self.assertGreater(get_ledger_versions(Payment, owner_id=self.user.pk)['kakeibo.payment'], version)
+
+    def test_dry_run_with_workers(self):
+        with tempfile.TemporaryDirectory() as directory:
+            stdout = StringIO()
+            call_command('import_ledger', 'payment', self.write_csv(directory, 'cp932'),
+                         '--encoding', 'cp932', '--dry-run', '--chunk-size', '2', '--workers', '2', '--owner', 'alice',
+                         stdout=stdout, stderr=StringIO())
+        self.assertIn('Imported 0 of 5 rows (2 errors).', stdout.getvalue())
+        self.assertFalse(Payment.objects.exists())
+
+    def test_missing_columns(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'payments.csv')
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write('date,amount\n2021-05-01,100\n')
+            with self.assertRaisesMessage(CommandError, 'category'):
+                call_command('import_ledger', 'payment', path, '--owner', 'alice', stdout=StringIO())
+
+    def test_admin_import(self):
+        user = get_user_model().objects.create_superuser('admin', 'admin@example.com', 'password')
+        self.client.force_login(user)
+        url = reverse('admin:kakeibo_payment_ledger_import')
+        self.assertEqual(self.client.get(url).status_code, 200)
+
+        upload = SimpleUploadedFile('payments.csv', self.csv.format(house=self.house.pk).encode())
+        response = self.client.post(url, {'file': upload, 'encoding': 'utf-8-sig', 'owner': self.user.pk},
+                                    follow=True)
+        self.assertRedirects(response, reverse('admin:kakeibo_payment_changelist'))
+        self.assertContains(response, 'Imported 3 of 5 rows (2 errors).')
+        self.assertContains(response, 'Line 5: unknown category')
+        self.assertEqual(Payment.objects.filter(owner=self.user).count(), 3)
+        self.assertEqual(find_drift(), [])
+
+
+class LedgerExportTests(LedgerTestMixin, TestCase):
+    """明細のエクスポート"""
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        Payment.objects.create(date='2021-05-01', amount=1200, category=cls.food, description='スーパー "特売"')
+        Payment.objects.create(date='2021-05-20', amount=80000, category=cls.house, description='家賃')
+        Payment.objects.create(date='2021-06-01', amount=300, category=cls.food)
+
+    def export(self, **params):
+        get_registry(PaymentCategory, self.user.pk).choices()
+        get_year_registry(self.user.pk).years()
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(reverse('kakeibo:payment_export'), params)
+            content = b''.join(response.streaming_content).decode()
+        return response, content, len(context.captured_queries)
+
+    def test_csv_uses_list_filters(self):
+        response, content, queries = self.export(year=2021, month=5)
+        self.assertEqual(response['Content-Type'], 'text/csv; charset=utf-8')
+        self.assertIn('attachment; filename="payment_', response['Content-Disposition'])
+        self.assertEqual(content.lstrip('\ufeff').splitlines(), [
+            'date,amount,category,description',
+            '2021-05-20,80000,住宅,家賃',
+            '2021-05-01,1200,食費,"スーパー ""特売"""',
+        ])
+        self.assertEqual(queries, 1 + self.auth_queries)
+
+    def test_json(self):
+        response, content, queries = self.export(format='json', search_category=self.food.pk)
+        self.assertEqual(json.loads(content), [
+            {'date': '2021-06-01', 'amount': 300, 'category': '食費', 'description': ''},
+            {'date': '2021-05-01', 'amount': 1200, 'category': '食費', 'description': 'スーパー "特売"'},
+        ])
+        self.assertEqual(queries, 1 + self.auth_queries)
+
+        response, content, queries = self.export(format='json', year=2021, month=7)
+        self.assertEqual(json.loads(content), [])
+
+    def test_unknown_format(self):
+        response = self.client.get(reverse('kakeibo:payment_export'), {'format': 'xml'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_export_can_be_imported(self):
+        response, content, _ = self.export()
+        Payment.objects.all().delete()
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'payments.csv')
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(content)
+            call_command('import_ledger', 'payment', path, '--owner', 'alice', stdout=StringIO(), stderr=StringIO())
+        self.assertEqual(Payment.objects.count(), 3)
+        self.assertEqual(find_drift(), [])
+
+
+class AssetMonthTests(LedgerTestMixin, TestCase):
+    """資産の月1件の制約と月次スナップショット"""
+
+    def test_unique_month(self):
+        asset = Asset.objects.create(date='2021-05-31', amount=1000, category=self.bank)
+        self.assertEqual(asset.month, datetime.date(2021, 5, 1))
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            Asset.objects.create(date=datetime.date(2021, 5, 1), amount=2000, category=self.bank)
+
+        # 日付を変更するとmonthも変わる
+        asset.date = datetime.date(2021, 6, 30)
+        asset.save(update_fields=['date'])
+        self.assertEqual(Asset.objects.get().month, datetime.date(2021, 6, 1))
+
+    def test_create_view_rejects_duplicate(self):
+        Asset.objects.create(date='2021-05-31', amount=1000, category=self.bank)
+        response = self.client.post(reverse('kakeibo:asset_create'),
+                                    {'date': '2021-05-10', 'amount': 2000, 'category': self.bank.pk}, follow=True)
+        self.assertContains(response, 'is already registered in this month')
+        self.assertEqual(Asset.objects.count(), 1)
+        self.assertEqual(find_drift(), [])
+
+    def test_admin_rejects_duplicate(self):
+        admin_user = get_user_model().objects.create_superuser('admin', password='password')
+        self.client.force_login(admin_user)
+        asset = Asset.objects.create(date='2021-05-31', amount=1000, category=self.bank)
+        other = Asset.objects.create(date='2021-06-10', amount=1000, category=self.bank)
+
+        response = self.client.post(reverse('admin:kakeibo_asset_add'),
+                                    {'date': '2021-05-10', 'amount': 2000, 'category': self.bank.pk})
+        self.assertEqual(response.status_code, 200)
+        self.assertFormError(response, 'adminform', 'date', 'このカテゴリは同じ月に登録済みです')
+
+        # 登録済みの月への変更もエラーになり、同じ資産の日付の変更はできる
+        url = reverse('admin:kakeibo_asset_change', args=[other.pk])
+        response = self.client.post(url, {'date': '2021-05-01', 'amount': 1000, 'category': self.bank.pk})
+        self.assertEqual(response.status_code, 200)
+        self.assertFormError(response, 'adminform', 'date', 'このカテゴリは同じ月に登録済みです')
+        response = self.client.post(reverse('admin:kakeibo_asset_change', args=[asset.pk]),
+                                    {'date': '2021-05-01', 'amount': 1000, 'category': self.bank.pk})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(Asset.objects.get(pk=other.pk).month, datetime.date(2021, 6, 1))
+        self.assertEqual(find_drift(), [])
+
+    def test_resource_import_rejects_duplicate(self):
+        from tablib import Dataset
+        from .admin import AssetResource
+        Asset.objects.create(date='2021-05-31', amount=1000, category=self.bank)
+        dataset = Dataset(headers=['id', 'date', 'amount', 'category', 'description'])
+        dataset.append(['', '2021-05-10', 2000, self.bank.pk, ''])
+        result = AssetResource().import_data(dataset, dry_run=True)
+        self.assertTrue(result.has_validation_errors())
+        self.assertEqual(Asset.objects.count(), 1)
+
+    def test_snapshot(self):
+        Asset.objects.create(date='2021-05-20', amount=1000, category=self.bank)
+        url = reverse('kakeibo:asset_snapshot', args=[2021, 5])
+        response = self.client.get(url)
+        self.assertEqual(response.context['form'].initial['date'], datetime.date(2021, 5, 20))
+        self.assertEqual(response.context['form'].fields[f'category_{self.bank.pk}'].initial, 1000)
+
+        version = get_ledger_versions(Asset, owner_id=self.user.pk)['kakeibo.asset']
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.post(url, {'date': '2021-05-31',
+                                              f'category_{self.bank.pk}': 1500,
+                                              f'category_{self.stock.pk}': 3000})
+        self.assertRedirects(response, reverse('kakeibo:asset_dashboard', args=[2021, 5]),
+                             fetch_redirect_response=False)
+        self.assertEqual(sorted(Asset.objects.values_list('category', 'date', 'amount')), [
+            (self.bank.pk, datetime.date(2021, 5, 31), 1500),
+            (self.stock.pk, datetime.date(2021, 5, 31), 3000),
+        ])
+        inserts = [q for q in context.captured_queries if q['sql'].startswith('INSERT INTO "kakeibo_asset"')]
+        self.assertEqual(len(inserts), 1)
+        self.assertEqual(find_drift(), [])
+        self.assertGreater(get_ledger_versions(Asset, owner_id=self.user.pk)['kakeibo.asset'], version)
+
+    def test_snapshot_validation(self):
+        url = reverse('kakeibo:asset_snapshot', args=[2021, 5])
+        response = self.client.post(url, {'date': '2021-06-01', f'category_{self.bank.pk}': 1500})
+        self.assertFormError(response, 'form', 'date', '2021-05の日付を入力してください')
+        response = self.client.post(url, {'date': '2021-05-31'})
+        self.assertFormError(response, 'form', None, '金額を1つ以上入力してください')
+        self.assertFalse(Asset.objects.exists())
+
+    def test_import_skips_registered_months(self):
+        Asset.objects.create(date='2021-05-20', amount=1000, category=self.bank)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'assets.csv')
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write('date,amount,category\n'
+                        '2021-05-31,2000,銀行\n'
+                        '2021-06-30,3000,銀行\n'
+                        '2021-06-15,3000,銀行\n')
+            stderr = StringIO()
+            call_command('import_ledger', 'asset', path, '--owner', 'alice', stdout=StringIO(), stderr=stderr)
+        self.assertEqual(stderr.getvalue().splitlines(), ['line 2: already registered in this month',
+                                                          'line 4: already registered in this month'])
+        self.assertEqual(Asset.objects.count(), 2)
+        self.assertEqual(find_drift(), [])
+
+
+class AssetSeriesTests(LedgerTestMixin, TestCase):
+    """月ごとの資産合計と前月比"""
+
+    def assert_in_sync(self):
+        self.assertEqual(stored_asset_series(), calc_asset_series())
+
+    def test_incremental_updates(self):
+        january = Asset.objects.create(date='2021-01-31', amount=1000, category=self.bank)
+        march = Asset.objects.create(date='2021-03-31', amount=3000, category=self.bank)
+        self.assert_in_sync()
+
+        # 間の月に追加すると、その月と次の月の前月比が変わる
+        february = Asset.objects.create(date='2021-02-28', amount=2000, category=self.bank)
+        Asset.objects.create(date='2021-02-28', amount=0, category=self.stock)
+        self.assert_in_sync()
+        self.assertEqual(AssetSeries.objects.get(month='2021-03-01').change, 0.5)
+
+        february.amount = 1500
+        february.save()
+        self.assert_in_sync()
+
+        february.date = datetime.date(2021, 4, 30)
+        february.save()
+        march.delete()
+        january.amount = 0
+        january.save()
+        self.assert_in_sync()
+        self.assertEqual(find_drift(), [])
+
+    def test_only_next_month_is_recomputed(self):
+        assets = [Asset.objects.create(date=datetime.date(2020 + i // 12, i % 12 + 1, 1),
+                                       amount=1000 + i, category=self.bank) for i in range(24)]
+        before = stored_asset_series()
+        assets[5].amount = 5000
+        assets[5].save()
+        after = stored_asset_series()
+        changed = sorted(month for owner, month in after if after[owner, month] != before[owner, month])
+        self.assertEqual(changed, [datetime.date(2020, 6, 1), datetime.date(2020, 7, 1)])
+        self.assert_in_sync()
+
+    def test_rebuild(self):
+        Asset.objects.create(date='2021-01-31', amount=1000, category=self.bank)
+        AssetSeries.objects.update(total=1)
+        self.assertEqual(len(find_drift()), 1)
+        call_command('rebuild_monthly_totals', stdout=StringIO())
+        self.assertEqual(find_drift(), [])
+
+
+class OwnerTests(LedgerTestMixin, TestCase):
+    """ユーザーごとの家計簿"""
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        cls.other = get_user_model().objects.create_user('bob', password='password')
+        cls.other_food = PaymentCategory.objects.create(name='食費', owner=cls.other)
+        cls.other_bank = AssetCategory.objects.create(name='銀行', owner=cls.other)
+        Payment.objects.create(date=datetime.date(2021, 5, 1), amount=1000, category=cls.food)
+        cls.other_payment = Payment.objects.create(date=datetime.date(2021, 5, 1), amount=7000,
+                                                   category=cls.other_food)
+        Asset.objects.create(date=datetime.date(2021, 5, 31), amount=100, category=cls.bank)
+        Asset.objects.create(date=datetime.date(2021, 5, 31), amount=900, category=cls.other_bank)
+
+    def test_owner_follows_category(self):
+        self.assertEqual(self.other_payment.owner, self.other)
+        self.other_payment.category = self.food
+        self.other_payment.save(update_fields=['category'])
+        self.assertEqual(Payment.objects.get(pk=self.other_payment.pk).owner, self.user)
+        self.assertEqual(find_drift(), [])
+
+    def test_lists_and_forms(self):
+        response = self.client.get(reverse('kakeibo:payment_list'))
+        self.assertEqual([payment.amount for payment in response.context['payment_list']], [1000])
+        self.assertNotIn(self.other_food.pk, dict(response.context['search_form'].fields['search_category'].choices))
+
+        # ほかのユーザーのカテゴリでは登録できない
+        from .forms import PaymentCreateForm
+        form = PaymentCreateForm({'date': '2021-05-02', 'amount': 500, 'category': self.other_food.pk},
+                                 owner_id=self.user.pk)
+        self.assertFalse(form.is_valid())
+        self.assertIn('category', form.errors)
+
+    def test_cannot_delete_others(self):
+        response = self.client.post(reverse('kakeibo:payment_delete', args=[self.other_payment.pk]))
+        self.assertEqual(response.status_code, 404)
+        self.assertTrue(Payment.objects.filter(pk=self.other_payment.pk).exists())
+
+    def test_dashboards(self):
+        response = self.client.get(reverse('kakeibo:monthly_balance', args=[2021, 5]))
+        self.assertEqual(response.context['total_payment'], 1000)
+        data = self.client.get(reverse('kakeibo:asset_transition_chart')).json()
+        self.assertEqual(data['totals'], [100])
+
+        self.client.force_login(self.other)
+        response = self.client.get(reverse('kakeibo:monthly_balance', args=[2021, 5]))
+        self.assertEqual(response.context['total_payment'], 7000)
+        data = self.client.get(reverse('kakeibo:asset_transition_chart')).json()
+        self.assertEqual(data['totals'], [900])
+
+    def test_other_owner_does_not_invalidate(self):
+        url = reverse('kakeibo:monthly_balance', args=[2021, 5])
+        self.client.get(url)
+        versions = get_ledger_versions(Payment, owner_id=self.user.pk)
+        Payment.objects.create(date=datetime.date(2021, 5, 2), amount=1, category=self.other_food)
+        self.assertEqual(get_ledger_versions(Payment, owner_id=self.user.pk), versions)
+        with self.assertNumQueries(self.auth_queries):
+            self.client.get(url)
+
+    def test_category_owner_is_fixed(self):
+        """明細と集計は所有者を持つので、登録済みのカテゴリの所有者は管理画面やインポートで変わらない"""
+        admin_user = get_user_model().objects.create_superuser('admin', password='password')
+        self.client.force_login(admin_user)
+        url = reverse('admin:kakeibo_paymentcategory_change', args=[self.food.pk])
+        response = self.client.post(url, {'name': '食料品', 'owner': self.other.pk})
+        self.assertEqual(response.status_code, 302)
+        self.food.refresh_from_db()
+        self.assertEqual((self.food.name, self.food.owner_id), ('食料品', self.user.pk))
+
+        # 新しいカテゴリは所有者を選べる
+        response = self.client.post(reverse('admin:kakeibo_paymentcategory_add'),
+                                    {'name': '交際費', 'owner': self.other.pk})
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(PaymentCategory.objects.get(name='交際費').owner_id, self.other.pk)
+
+        from tablib import Dataset
+        from .admin import PaymentCategoryResource
+        dataset = Dataset(headers=['id', 'owner', 'name'])
+        dataset.append([self.food.pk, self.other.pk, '食費'])
+        result = PaymentCategoryResource().import_data(dataset)
+        self.assertFalse(result.has_errors() or result.has_validation_errors())
+        self.food.refresh_from_db()
+        self.assertEqual((self.food.name, self.food.owner_id), ('食費', self.user.pk))
+
+        self.client.force_login(self.user)
+        response = self.client.get(reverse('kakeibo:monthly_balance', args=[2021, 5]))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(find_drift(), [])
+
+    def test_login_required(self):
+        self.client.logout()
+        response = self.client.get(reverse('kakeibo:payment_list'))
+        self.assertRedirects(response, reverse('login') + '?next=' + reverse('kakeibo:payment_list'))
+        # グラフのAPIはリダイレクトせずに403を返す
+        response = self.client.get(reverse('kakeibo:asset_transition_chart'))
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(self.client.get(reverse('login')).status_code, 200)
+
+
+class InstrumentationTests(LedgerTestMixin, TestCase):
+    """Server-Timingヘッダーとメトリクス"""
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        Payment.objects.create(date=datetime.date(2021, 5, 1), amount=1000, category=cls.food)
+        Asset.objects.create(date=datetime.date(2021, 5, 31), amount=1000, category=cls.bank)
+
+    def setUp(self):
+        super().setUp()
+        from .instrumentation import request_metrics
+        request_metrics.reset()
+        self.addCleanup(request_metrics.reset)
+
+    def get_timings(self, response):
+        """Server-Timingヘッダーを{名前:(ms, desc)}にする"""
+        timings = {}
+        for entry in response['Server-Timing'].split(', '):
+            name, *params = entry.split(';')
+            params = dict(param.split('=', 1) for param in params)
+            timings[name] = (float(params['dur']), params.get('desc'))
+        return timings
+
+    @override_settings(KAKEIBO_AGGREGATION_BACKEND='pandas')
+    def test_server_timing(self):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(reverse('kakeibo:asset_dashboard', args=[2021, 5]))
+        timings = self.get_timings(response)
+        self.assertEqual(timings['sql'][1], f'"{len(context)} queries"')
+        self.assertTrue({'pandas', 'table', 'render', 'total'} <= set(timings))
+        self.assertLessEqual(timings['render'][0], timings['total'][0])
+
+        response = self.client.get(reverse('kakeibo:monthly_balance', args=[2021, 5]))
+        self.assertIn('colors', self.get_timings(response))
+
+    @override_settings(KAKEIBO_SERVER_TIMING=False)
+    def test_header_can_be_disabled(self):
+        response = self.client.get(reverse('kakeibo:payment_list'))
+        self.assertFalse(response.has_header('Server-Timing'))
+
+    def test_metrics(self):
+        self.client.get(reverse('kakeibo:monthly_balance', args=[2021, 5]))
+        self.client.get(reverse('kakeibo:monthly_balance', args=[2021, 6]))
+        self.client.get('/no-such-page/')
+        self.assertEqual(self.client.get(reverse('kakeibo:metrics')).status_code, 403)
+
+        self.user.is_staff = True
+        self.user.save()
+        response = self.client.get(reverse('kakeibo:metrics'))
+        self.assertEqual(response['Content-Type'], 'text/plain; version=0.0.4; charset=utf-8')
+        lines = response.content.decode().splitlines()
+        self.assertIn('# TYPE kakeibo_request_duration_seconds histogram', lines)
+        self.assertIn('kakeibo_request_duration_seconds_bucket{view="kakeibo:monthly_balance",le="+Inf"} 2', lines)
+        self.assertIn('kakeibo_request_duration_seconds_count{view="unresolved"} 1', lines)
+        self.assertTrue(any(line.startswith('kakeibo_request_phase_seconds_total{view="kakeibo:monthly_balance",'
+                                            'phase="render"}') for line in lines))
+
+
+class ProfilerTests(LedgerTestMixin, TestCase):
+    """スタッフ向けのプロファイラ"""
+
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        settings = override_settings(KAKEIBO_PROFILER_ENABLED=True, KAKEIBO_PROFILER_DIR=self.directory,
+                                     KAKEIBO_PROFILER_KEEP=2)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        Payment.objects.create(date=datetime.date(2021, 5, 1), amount=1000, category=self.food)
+
+    def get(self, url):
+        return self.client.get(url, {'_profile': 1})
+
+    def test_disabled(self):
+        from django.core.exceptions import MiddlewareNotUsed
+        from .profiling import ProfilerMiddleware
+        with override_settings(KAKEIBO_PROFILER_ENABLED=False), self.assertRaises(MiddlewareNotUsed):
+            ProfilerMiddleware(lambda request: None)
+
+    def test_staff_only(self):
+        response = self.get(reverse('kakeibo:monthly_balance', args=[2021, 5]))
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(response.has_header('X-Kakeibo-Profile'))
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_capture_and_admin(self):
+        self.user.is_staff = True
+        self.user.is_superuser = True
+        self.user.save()
+        self.assertFalse(self.client.get(reverse('kakeibo:payment_list')).has_header('X-Kakeibo-Profile'))
+        # 管理画面は家計簿のURLではないので対象外
+        self.assertFalse(self.get(reverse('admin:index')).has_header('X-Kakeibo-Profile'))
+
+        response = self.get(reverse('kakeibo:monthly_balance', args=[2021, 5]))
+        name = response['X-Kakeibo-Profile']
+        self.assertEqual(response.context['total_payment'], 1000)
+
+        response = self.client.get(reverse('kakeibo_profile_list'))
+        self.assertEqual([profile['name'] for profile in response.context['profiles']], [name])
+        self.assertContains(response, '/monthly_balance/2021/5/?_profile=1')
+
+        response = self.client.get(reverse('kakeibo_profile_detail', args=[name]))
+        functions = response.context['functions']
+        self.assertEqual(len(functions), 30)
+        # 集計は上位30件に入らないこともあるので、ファイルから全件を見る
+        self.assertTrue(any('get_monthly_balance_data' in function['function']
+                            for function in top_functions(get_profile_path(name), limit=None)))
+        cumulative = [function['cumtime_ms'] for function in functions]
+        self.assertEqual(cumulative, sorted(cumulative, reverse=True))
+
+        response = self.client.get(reverse('kakeibo_profile_download', args=[name]))
+        self.assertTrue(b''.join(response.streaming_content))
+        self.assertEqual(self.client.get(reverse('kakeibo_profile_detail', args=['..'])).status_code, 404)
+
+    def test_retention(self):
+        self.user.is_staff = True
+        self.user.save()
+        names = [self.get(reverse('kakeibo:payment_list'))['X-Kakeibo-Profile'] for _ in range(3)]
+        self.assertEqual(sorted(os.listdir(self.directory)),
+                         sorted(f'{name}{suffix}' for name in names[1:] for suffix in ('.json', '.prof')))
+
+
+class SqliteProfileTests(TestCase):
+    """SQLiteの接続ごとのPRAGMA"""
+
+    def connect(self, directory):
+        """一時ファイルのデータベースに新しく接続する"""
+        default = connections['default']
+        wrapper = default.__class__({**default.settings_dict, 'NAME': os.path.join(directory, 'db.sqlite3')},
+                                    alias='sqlite_profile')
+        wrapper.ensure_connection()
+        self.addCleanup(wrapper.close)
+        return wrapper
+
+    def test_pragmas_are_applied(self):
+        from .sqlite_profile import get_connection_pragmas
+        with tempfile.TemporaryDirectory() as directory:
+            pragmas = get_connection_pragmas(self.connect(directory))
+            self.assertEqual(pragmas['journal_mode'], 'wal')
+            # NORMALは1、MEMORYは2
+            self.assertEqual((pragmas['synchronous'], pragmas['temp_store']), (1, 2))
+            self.assertEqual(pragmas['busy_timeout'], settings.KAKEIBO_SQLITE_PRAGMAS['busy_timeout'])
+            self.assertEqual(pragmas['cache_size'], settings.KAKEIBO_SQLITE_PRAGMAS['cache_size'])
+
+            with override_settings(KAKEIBO_SQLITE_PRAGMAS={'busy_timeout': 1234, 'journal_mode': None}):
+                pragmas = get_connection_pragmas(self.connect(directory), ['busy_timeout', 'synchronous'])
+            self.assertEqual(pragmas, {'busy_timeout': 1234, 'synchronous': 2})
+
+    def test_invalid_pragma(self):
+        from django.core.exceptions import ImproperlyConfigured
+        with tempfile.TemporaryDirectory() as directory:
+            with override_settings(KAKEIBO_SQLITE_PRAGMAS={'journal_mode': 'wal; DROP TABLE x'}), \
+                    self.assertRaises(ImproperlyConfigured):
+                self.connect(directory)
+
+
+class AsyncDashboardTests(TransactionTestCase):
+    """
+    ダッシュボードの非同期ビュー
+    集計は別スレッドの接続で行うので、コミットされたデータで確かめる
+    """
+
+    def setUp(self):
+        get_cache().clear()
+        self.user = get_user_model().objects.create_user('alice', password='password')
+        self.client.force_login(self.user)
+        self.food = PaymentCategory.objects.create(name='食費', owner=self.user)
+        self.salary = IncomeCategory.objects.create(name='給与', owner=self.user)
+        self.bank = AssetCategory.objects.create(name='銀行', owner=self.user)
+        for month in (4, 5):
+            Payment.objects.create(date=datetime.date(2021, month, 1), amount=1000 * month, category=self.food)
+            Income.objects.create(date=datetime.date(2021, month, 25), amount=5000, category=self.salary)
+            Asset.objects.create(date=datetime.date(2021, month, 30), amount=10000 * month, category=self.bank)
+
+    def test_as_view_is_coroutine(self):
+        from . import views
+        self.assertTrue(asyncio.iscoroutinefunction(views.AsyncAssetDashboard.as_view()))
+        self.assertFalse(asyncio.iscoroutinefunction(views.AssetDashboard.as_view()))
+
+    def test_same_context(self):
+        from . import views
+        cases = [
+            (views.MonthlyBalance, views.AsyncMonthlyBalance, {'year': 2021, 'month': 5},
+             ('table_items', 'donut_chart_labels', 'balance', 'donut_chart_url')),
+            (views.TransitionView, views.AsyncTransitionView, {}, ('line_chart_url',)),
+            (views.AssetDashboard, views.AsyncAssetDashboard, {'year': 2021, 'month': 5},
+             ('table_items', 'total', 'donut_chart_url', 'line_chart_url')),
+        ]
+        for sync_view, async_view, kwargs, keys in cases:
+            request = RequestFactory().get('/', {'graph_visible': 'All'})
+            request.user = self.user
+            expected = sync_view.as_view()(request, **kwargs).context_data
+            context = async_to_sync(async_view.as_view())(request, **kwargs).context_data
+            for key in keys:
+                self.assertEqual(context[key], expected[key], f'{async_view.__name__} {key}')
+
+    def test_aggregates_match(self):
+        from .forms import TransitionGraphSearchForm
+        from .views import TransitionView, AssetDashboard
+        request = RequestFactory().get('/')
+        request.user = self.user
+        view = TransitionView()
+        view.setup(request)
+        for params in (None, {'graph_visible': 'Income'}):
+            form = TransitionGraphSearchForm(params, owner_id=self.user.pk)
+            self.assertEqual(async_to_sync(view.aget_balance_transition_data)(form),
+                             view.get_balance_transition_data(form))
+        view = AssetDashboard()
+        view.setup(request, year=2021, month=5)
+        for name in ('asset_table_data', 'asset_allocation_data', 'transition_graph_data'):
+            self.assertEqual(async_to_sync(getattr(view, f'aget_{name}'))(), getattr(view, f'get_{name}')(), name)
+
+    def test_chart_api_under_asgi(self):
+        url = reverse('kakeibo:balance_transition_chart')
+        expected = self.client.get(url).json()
+        client = AsyncClient()
+        client.force_login(self.user)
+
+        async def request(method, **extra):
+            return await getattr(client, method)(url, **extra)
+
+        with override_settings(ROOT_URLCONF=DashboardURLConf(True)):
+            response = async_to_sync(request)('get')
+            self.assertEqual(response.json(), expected)
+            # Django 3.2のAsyncClientはヘッダー名をそのまま渡す
+            response = async_to_sync(request)('get', **{'if-none-match': response['ETag']})
+            self.assertEqual(response.status_code, 304)
+            self.assertEqual(async_to_sync(request)('post').status_code, 405)
+
+            # 集計用のスレッドプールで実行されたクエリもServer-Timingに数えられる
+            get_cache().clear()
+            response = async_to_sync(request)('get')
+            self.assertRegex(response['Server-Timing'], r'sql;dur=[\d.]+;desc="[1-9]\d* queries"')
+
+    def test_gather_runs_concurrently(self):
+        # 順番に実行されると、1つ目がもう1つを待ち続けてタイムアウトする
+        barrier = threading.Barrier(2, timeout=5)
+        results = async_to_sync(gather_aggregates)((barrier.wait,), (barrier.wait,))
+        self.assertEqual(sorted(results), [0, 1])
@@ -1,19 +1,48 @@
+from django.conf import settings
 from django.urls import path
 from . import views
 
 app_name = 'kakeibo'
 
+
+def dashboard_patterns(async_views=False):
+    """
+    ダッシュボードとグラフデータのURL
+    async_viewsをTrueにすると非同期のビューになる。ASGIで動かす場合に使う
+    """
+    prefix = 'Async' if async_views else ''
+
+    def view(name):
+        return getattr(views, prefix + name).as_view()
+
+    return [
+        path('monthly_balance/<int:year>/<int:month>/', view('MonthlyBalance'), name='monthly_balance'),
+        path('balance_transition/', view('TransitionView'), name='balance_transition'),
+        path('asset_dashboard/<int:year>/<int:month>/', view('AssetDashboard'), name='asset_dashboard'),
+        path('chart/monthly_balance/<int:year>/<int:month>/', view('MonthlyBalanceChart'),
+             name='monthly_balance_chart'),
+        path('chart/balance_transition/', view('TransitionChart'), name='balance_transition_chart'),
+        path('chart/asset_allocation/<int:year>/<int:month>/', view('AssetAllocationChart'),
+             name='asset_allocation_chart'),
+        path('chart/asset_transition/', view('AssetTransitionChart'), name='asset_transition_chart'),
+    ]
+
+
 urlpatterns = [
     path('', views.PaymentList.as_view(), name='payment_list'),
     path('income_list/', views.IncomeList.as_view(), name='income_list'),
     path('asset_list/',views.AssetList.as_view(),name='asset_list'),
+    path('payment_export/', views.PaymentExport.as_view(), name='payment_export'),
+    path('income_export/', views.IncomeExport.as_view(), name='income_export'),
+    path('asset_export/', views.AssetExport.as_view(), name='asset_export'),
     path('payment_create/', views.PaymentCreate.as_view(), name='payment_create'),
     path('income_create/', views.IncomeCreate.as_view(), name='income_create'),
     path('asset_create/', views.AssetCreate.as_view(), name='asset_create'),
+    path('asset_snapshot/<int:year>/<int:month>/', views.AssetSnapshot.as_view(), name='asset_snapshot'),
     path('payment_delete/<int:pk>/', views.PaymentDelete.as_view(), name='payment_delete'),
     path('income_delete/<int:pk>/', views.IncomeDelete.as_view(), name='income_delete'),
     path('asset_delete/<int:pk>/', views.AssetDelete.as_view(), name='asset_delete'),
-    path('monthly_balance/<int:year>/<int:month>/', views.MonthlyBalance.as_view(), name='monthly_balance'),
-    path('balance_transition/', views.TransitionView.as_view(), name='balance_transition'),
-    path('asset_dashboard/<int:year>/<int:month>/', views.AssetDashboard.as_view(), name='asset_dashboard'),
+    path('metrics/', views.Metrics.as_view(), name='metrics'),
 ]
+
+urlpatterns += dashboard_patterns(getattr(settings, 'KAKEIBO_ASYNC_DASHBOARDS', False))
@@ -1,36 +1,45 @@
 import datetime
+from django.contrib.auth.mixins import UserPassesTestMixin
+from django.db import IntegrityError, transaction
+from django.http import HttpResponse
 from django.views import generic
-from .models import Payment, Income, Asset, AssetCategory
+from .models import Payment, Income, Asset, PaymentCategory, IncomeCategory, AssetCategory
 from .forms import PaymentSearchForm, IncomeSearchForm, \
     PaymentCreateForm, IncomeCreateForm, AssetCreateForm, \
-    TransitionGraphSearchForm, AssetSearchForm
-from django.urls import reverse_lazy
+    TransitionGraphSearchForm, AssetSearchForm, AssetSnapshotForm
+from django.urls import reverse, reverse_lazy
 from django.contrib import messages
 from django.shortcuts import redirect
 from kakeibo import plugins
+from .cache import LedgerCacheMixin, LedgerFragmentMixin
+from .chart_api import ChartDataMixin, AsyncChartDataMixin, to_json_list
+from .concurrency import AsyncDashboardMixin
+from .export import LedgerExportMixin
+from .fulltext import filter_by_keywords
+from .instrumentation import request_metrics
+from .pagination import KeysetPaginationMixin
 
 
-class PaymentList(generic.ListView):
+class PaymentList(plugins.OwnerMixin, LedgerFragmentMixin, KeysetPaginationMixin, generic.ListView):
     """支出一覧ページ"""
     template_name = 'kakeibo/payment_list.html'
     model = Payment
-    ordering = '-date'
+    ordering = ('-date', '-id')
     paginate_by = 10
+    fragment_models = (Payment, PaymentCategory)
+    list_fields = ('date', 'amount', 'description', 'category__name')
 
     def get_queryset(self):
-        queryset = super().get_queryset()
-        self.form = form = PaymentSearchForm(self.request.GET or None)
+        # テーブルでカテゴリ名を表示するため、joinして取得する
+        queryset = super().get_queryset().select_related('category').only(*self.list_fields)
+        self.form = form = PaymentSearchForm(self.request.GET or None, owner_id=self.get_owner_id())
 
         if form.is_valid():
-            year = form.cleaned_data.get('year')
             # yearとmonthにつき何も選択されていないときは0の文字列が入るため、除外
             # forms.pyを参照
-            if year and year != '0':
-                queryset = queryset.filter(date__year=year)
-
-            month = form.cleaned_data.get('month')
-            if month and month != '0':
-                queryset = queryset.filter(date__month=month)
+            queryset = plugins.filter_by_month(queryset,
+                                               form.cleaned_data.get('year'),
+                                               form.cleaned_data.get('month'))
 
             greater_than = form.cleaned_data.get('greater_than')
             if greater_than:
@@ -43,8 +52,7 @@ class PaymentList(generic.ListView):
             key_word = form.cleaned_data.get('key_word')
             if key_word:
                 # 空白で区切られていた場合は分割して繰り返す、and検索
-                for word in key_word.split():
-                    queryset = queryset.filter(description__icontains=word)
+                queryset = filter_by_keywords(queryset, key_word)
 
             category = form.cleaned_data.get('search_category')
             if category:
@@ -55,62 +63,62 @@ class PaymentList(generic.ListView):
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         context['search_form'] = self.form
-        context['create_form'] = PaymentCreateForm
+        context['create_form'] = PaymentCreateForm(owner_id=self.get_owner_id())
         context['action_url'] = '/payment_create/'
+        context['export_url'] = reverse('kakeibo:payment_export')
 
         return context
 
 
-class IncomeList(generic.ListView):
+class IncomeList(plugins.OwnerMixin, LedgerFragmentMixin, KeysetPaginationMixin, generic.ListView):
     """収入一覧ページ"""
     template_name = 'kakeibo/income_list.html'
     model = Income
-    ordering = '-date'
+    ordering = ('-date', '-id')
     paginate_by = 10
+    fragment_models = (Income, IncomeCategory)
+    list_fields = ('date', 'amount', 'description', 'category__name')
 
     def get_queryset(self):
-        queryset = super().get_queryset()
-        self.form = form = IncomeSearchForm(self.request.GET or None)
+        # テーブルでカテゴリ名を表示するため、joinして取得する
+        queryset = super().get_queryset().select_related('category').only(*self.list_fields)
+        self.form = form = IncomeSearchForm(self.request.GET or None, owner_id=self.get_owner_id())
 
         if form.is_valid():
-            year = form.cleaned_data.get('year')
-            if year and year != '0':
-                queryset = queryset.filter(date__year=year)
-
-            month = form.cleaned_data.get('month')
-            if month and month != '0':
-                queryset = queryset.filter(date__month=month)
+            queryset = plugins.filter_by_month(queryset,
+                                               form.cleaned_data.get('year'),
+                                               form.cleaned_data.get('month'))
 
         return queryset
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         context['search_form'] = self.form
-        context['create_form'] = IncomeCreateForm
+        context['create_form'] = IncomeCreateForm(owner_id=self.get_owner_id())
         context['action_url'] = '/income_create/'
+        context['export_url'] = reverse('kakeibo:income_export')
 
         return context
 
 
-class AssetList(generic.ListView):
+class AssetList(plugins.OwnerMixin, LedgerFragmentMixin, KeysetPaginationMixin, generic.ListView):
     """資産一覧ページ"""
     template_name = 'kakeibo/asset_list.html'
     model = Asset
-    ordering = '-date'
+    ordering = ('-date', '-id')
     paginate_by = 10
+    fragment_models = (Asset, AssetCategory)
+    list_fields = ('date', 'amount', 'description', 'category__name')
 
     def get_queryset(self):
-        queryset = super().get_queryset()
-        self.form = form = AssetSearchForm(self.request.GET or None)
+        # テーブルでカテゴリ名を表示するため、joinして取得する
+        queryset = super().get_queryset().select_related('category').only(*self.list_fields)
+        self.form = form = AssetSearchForm(self.request.GET or None, owner_id=self.get_owner_id())
 
         if form.is_valid():
-            year = form.cleaned_data.get('year')
-            if year and year != '0':
-                queryset = queryset.filter(date__year=year)
-
-            month = form.cleaned_data.get('month')
-            if month and month != '0':
-                queryset = queryset.filter(date__month=month)
+            queryset = plugins.filter_by_month(queryset,
+                                               form.cleaned_data.get('year'),
+                                               form.cleaned_data.get('month'))
 
             category = form.cleaned_data.get('search_category')
             if category:
@@ -121,13 +129,26 @@ class AssetList(generic.ListView):
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
         context['search_form'] = self.form
-        context['create_form'] = AssetCreateForm
+        context['create_form'] = AssetCreateForm(owner_id=self.get_owner_id())
         context['action_url'] = '/asset_create/'
+        context['export_url'] = reverse('kakeibo:asset_export')
 
         return context
 
 
-class PaymentCreate(generic.CreateView):
+class PaymentExport(LedgerExportMixin, PaymentList):
+    """支出のエクスポート"""
+
+
+class IncomeExport(LedgerExportMixin, IncomeList):
+    """収入のエクスポート"""
+
+
+class AssetExport(LedgerExportMixin, AssetList):
+    """資産のエクスポート"""
+
+
+class PaymentCreate(plugins.OwnerMixin, generic.CreateView):
     """支出登録"""
     model = Payment
     form_class = PaymentCreateForm
@@ -140,13 +161,14 @@ class PaymentCreate(generic.CreateView):
         msg = plugins.success_message_for_item('Register',
                                                'Payment',
                                                payment.date,
-                                               payment.category,
-                                               payment.amount)
+                                               payment.category_id,
+                                               payment.amount,
+                                               self.get_owner_id())
         messages.info(self.request, msg)
         return redirect(self.get_success_url())
 
 
-class IncomeCreate(generic.CreateView):
+class IncomeCreate(plugins.OwnerMixin, generic.CreateView):
     """収入登録"""
     model = Income
     form_class = IncomeCreateForm
@@ -159,13 +181,14 @@ class IncomeCreate(generic.CreateView):
         msg = plugins.success_message_for_item('Register',
                                                'Income',
                                                income.date,
-                                               income.category,
-                                               income.amount)
+                                               income.category_id,
+                                               income.amount,
+                                               self.get_owner_id())
         messages.info(self.request, msg)
         return redirect(self.get_success_url())
 
 
-class AssetCreate(generic.CreateView):
+class AssetCreate(plugins.OwnerMixin, generic.CreateView):
     """資産登録"""
     model = Asset
     form_class = AssetCreateForm
@@ -173,37 +196,88 @@ class AssetCreate(generic.CreateView):
     def get_success_url(self):
         return reverse_lazy('kakeibo:asset_list')
 
-    def post(self, request, *args, **kwargs):
+    def duplicate_month(self, category):
+        msg = f"""
+            Failed to register Asset
+            Category:{category.name} is already registered in this month
+            """
+        messages.info(self.request, msg)
+        return redirect(self.get_success_url())
+
+    def form_invalid(self, form):
         """同月、同カテゴリが登録されていたらエラーにする"""
-        date = request.POST.get('date')
-        date = datetime.datetime.strptime(date, "%Y-%m-%d")
-        year = date.year
-        month = date.month
-        pk = request.POST.get('category')
-        qs_asset = Asset.objects.filter(date__year=year, date__month=month, category=pk)
-        if qs_asset.exists():
-            category_name = AssetCategory.objects.values().get(pk=pk).get('name')
-            msg = f"""
-                Failed to register Asset
-                Category:{category_name} is already registered in this month
-                """
-            messages.info(self.request, msg)
-            return redirect(self.get_success_url())
-
-        return super().post(request, *args, **kwargs)
+        if form.has_error('date', code='duplicate_month'):
+            return self.duplicate_month(form.cleaned_data['category'])
+        return super().form_invalid(form)
 
     def form_valid(self, form):
-        self.object = asset = form.save()
+        """入力チェックの後に同時に登録された重複は、データベースの制約で検知する"""
+        try:
+            with transaction.atomic():
+                self.object = asset = form.save()
+        except IntegrityError:
+            return self.duplicate_month(form.cleaned_data['category'])
+
         msg = plugins.success_message_for_item('Register',
                                                'Asset',
                                                asset.date,
-                                               asset.category,
-                                               asset.amount)
+                                               asset.category_id,
+                                               asset.amount,
+                                               self.get_owner_id())
         messages.info(self.request, msg)
         return redirect(self.get_success_url())
 
 
-class PaymentDelete(generic.DeleteView):
+class AssetSnapshot(plugins.OwnerMixin, plugins.MonthPagerMixin, generic.FormView):
+    """資産の月次スナップショット。その月の資産をカテゴリごとにまとめて登録、更新する"""
+    template_name = 'kakeibo/asset_snapshot.html'
+    form_class = AssetSnapshotForm
+
+    def setup(self, request, *args, **kwargs):
+        super().setup(request, *args, **kwargs)
+        self.month = self.get_current_month().date()
+        # その月に登録済みの資産を{category_pk:(amount, date)}で持っておく
+        self.registered = {category_pk: (amount, date) for category_pk, amount, date in
+                           Asset.objects.filter(owner_id=self.get_owner_id(), month=self.month).values_list(
+                               'category_id', 'amount', 'date')}
+
+    def get_initial(self):
+        # 日付の初期値は登録済みの日付、なければ月末
+        dates = [date for _, date in self.registered.values()]
+        month_end = self.get_next_month(self.month) - datetime.timedelta(days=1)
+        return {'date': max(dates) if dates else month_end}
+
+    def get_form_kwargs(self):
+        kwargs = super().get_form_kwargs()
+        kwargs.update(month=self.month,
+                      amounts={category_pk: amount for category_pk, (amount, _) in self.registered.items()})
+        return kwargs
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context.update(self.get_month_pager_data())
+        return context
+
+    def form_valid(self, form):
+        current_month = self.month
+        try:
+            created, updated = plugins.save_asset_snapshot(self.get_owner_id(), form.cleaned_data['date'],
+                                                           form.get_amounts())
+        except IntegrityError:
+            # 同じ月の資産が同時に登録された場合
+            messages.info(self.request, 'Failed to register Asset snapshot. Please try again.')
+            return redirect('kakeibo:asset_snapshot', current_month.year, current_month.month)
+
+        msg = f"""
+            Successfully Register Asset snapshot\n
+            Month:{current_month:%Y-%m}\n
+            Registered:{created} Updated:{updated}
+            """
+        messages.info(self.request, msg)
+        return redirect('kakeibo:asset_dashboard', current_month.year, current_month.month)
+
+
+class PaymentDelete(plugins.OwnerMixin, generic.DeleteView):
     """支出削除"""
     model = Payment
 
@@ -217,13 +291,14 @@ class PaymentDelete(generic.DeleteView):
         msg = plugins.success_message_for_item('Delete',
                                                'Payment',
                                                payment.date,
-                                               payment.category,
-                                               payment.amount)
+                                               payment.category_id,
+                                               payment.amount,
+                                               self.get_owner_id())
         messages.info(self.request, msg)
         return redirect(self.get_success_url())
 
 
-class IncomeDelete(generic.DeleteView):
+class IncomeDelete(plugins.OwnerMixin, generic.DeleteView):
     """収入削除"""
     model = Income
 
@@ -236,13 +311,14 @@ class IncomeDelete(generic.DeleteView):
         msg = plugins.success_message_for_item('Delete',
                                                'Income',
                                                income.date,
-                                               income.category,
-                                               income.amount)
+                                               income.category_id,
+                                               income.amount,
+                                               self.get_owner_id())
         messages.info(self.request, msg)
         return redirect(self.get_success_url())
 
 
-class AssetDelete(generic.DeleteView):
+class AssetDelete(plugins.OwnerMixin, generic.DeleteView):
     """資産削除"""
     model = Asset
 
@@ -255,47 +331,192 @@ class AssetDelete(generic.DeleteView):
         msg = plugins.success_message_for_item('Delete',
                                                'Asset',
                                                asset.date,
-                                               asset.category,
-                                               asset.amount)
+                                               asset.category_id,
+                                               asset.amount,
+                                               self.get_owner_id())
         messages.info(self.request, msg)
 
         return redirect(self.get_success_url())
 
 
-class MonthlyBalance(plugins.MonthlyBalanceMixin, generic.TemplateView):
+class MonthlyBalance(plugins.OwnerMixin, LedgerCacheMixin, plugins.MonthlyBalanceMixin, generic.TemplateView):
     """月間収支ページ"""
     template_name = 'kakeibo/monthly_balance.html'
+    cache_models = (Payment, Income, PaymentCategory)
+
+    def get_page_data(self):
+        return self.get_cached_data(self.get_monthly_balance_data)
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
 
-        data = self.get_monthly_balance_data()
+        data = self.get_page_data()
         context.update(data)
+        context['donut_chart_url'] = reverse('kakeibo:monthly_balance_chart', kwargs=self.kwargs)
 
         return context
 
 
-class TransitionView(plugins.BalanceTransitionMixin, generic.TemplateView):
-    """月毎の収支推移ページ"""
+class TransitionView(plugins.OwnerMixin, LedgerCacheMixin, plugins.BalanceTransitionMixin, generic.TemplateView):
+    """月毎の収支推移ページ。グラフのデータはTransitionChartから取得する"""
     template_name = 'kakeibo/balance_transition.html'
+    cache_models = (Payment, Income, PaymentCategory, IncomeCategory)
+
+    def get_page_data(self):
+        return {}
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        self.form = form = TransitionGraphSearchForm(self.request.GET or None)
-        context['search_form'] = self.form
-
-        data = self.get_balance_transition_data(form)
-        context.update(data)
+        context.update(self.get_page_data())
+        context['search_form'] = form = TransitionGraphSearchForm(self.request.GET or None,
+                                                                  owner_id=self.get_owner_id())
+        # テンプレートでcleaned_dataを見て、表示するカテゴリの選択肢を切り替える
+        form.is_valid()
+        chart_url = reverse('kakeibo:balance_transition_chart')
+        if self.request.GET:
+            chart_url += '?' + self.request.GET.urlencode()
+        context['line_chart_url'] = chart_url
 
         return context
 
 
-class AssetDashboard(plugins.AssetDashMixin, generic.TemplateView):
-    """資産ダッシュボード"""
+class AssetDashboard(plugins.OwnerMixin, LedgerCacheMixin, plugins.AssetDashMixin, generic.TemplateView):
+    """資産ダッシュボード。グラフのデータはAssetAllocationChartとAssetTransitionChartから取得する"""
     template_name = 'kakeibo/asset_dashboard.html'
+    cache_models = (Asset, AssetCategory)
+
+    def get_page_data(self):
+        return self.get_cached_data(self.get_asset_table_data)
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        data = self.get_asset_dash_data()
+        data = self.get_page_data()
         context.update(data)
+        context['donut_chart_url'] = reverse('kakeibo:asset_allocation_chart', kwargs=self.kwargs)
+        # 表示範囲のGETパラメータはグラフのAPIにそのまま渡す。なければ月に依らない同じURLになる
+        chart_url = reverse('kakeibo:asset_transition_chart')
+        if self.request.GET:
+            chart_url += '?' + self.request.GET.urlencode()
+        context['line_chart_url'] = chart_url
         return context
+
+
+class MonthlyBalanceChart(ChartDataMixin, MonthlyBalance):
+    """月間収支のドーナッツグラフのデータ。集計結果のキャッシュはページと共有する"""
+    cache_name = 'MonthlyBalance'
+
+    def get_chart_data(self):
+        data = self.get_page_data()
+        return {
+            'labels': data.get('donut_chart_labels', []),
+            'values': to_json_list(data.get('donut_chart_values', [])),
+            'colors': data.get('color_map', []),
+        }
+
+
+class TransitionChart(ChartDataMixin, TransitionView):
+    """収支推移グラフのデータ。表示しない系列はnullになる"""
+
+    def get_page_data(self):
+        form = TransitionGraphSearchForm(self.request.GET or None, owner_id=self.get_owner_id())
+        return self.get_cached_data(self.get_balance_transition_data, form)
+
+    def get_chart_data(self):
+        data = self.get_page_data()
+        return {
+            'labels': data['labels'],
+            'payments': to_json_list(data['payments']),
+            'incomes': to_json_list(data['incomes']),
+        }
+
+
+class AssetAllocationChart(ChartDataMixin, AssetDashboard):
+    """アセットアロケーションのドーナッツグラフのデータ"""
+
+    def get_page_data(self):
+        return self.get_cached_data(self.get_asset_allocation_data)
+
+    def get_chart_data(self):
+        data = self.get_page_data()
+        return {
+            'labels': data['donut_chart_labels'],
+            'values': to_json_list(data['donut_chart_values']),
+            'colors': data['color_map'],
+        }
+
+
+class AssetTransitionChart(ChartDataMixin, AssetDashboard):
+    """資産推移グラフのデータ。月に依らないので、どの月のページからも同じURLで取得する"""
+    cache_models = (Asset,)
+
+    def get_page_data(self):
+        return self.get_cached_data(self.get_transition_graph_data)
+
+    def get_chart_data(self):
+        labels, totals, changes = self.get_page_data()
+        return {
+            'labels': labels,
+            'totals': to_json_list(totals),
+            'changes': to_json_list(changes),
+        }
+
+
+class AsyncMonthlyBalance(AsyncDashboardMixin, MonthlyBalance):
+    """月間収支ページの非同期版"""
+
+    async def aget_page_data(self):
+        return await self.aget_cached_data(self.aget_monthly_balance_data)
+
+
+class AsyncTransitionView(AsyncDashboardMixin, TransitionView):
+    """収支推移ページの非同期版。集計はないが、フォームの組み立てを共有のスレッドから外す"""
+
+    async def aget_page_data(self):
+        return {}
+
+
+class AsyncAssetDashboard(AsyncDashboardMixin, AssetDashboard):
+    """資産ダッシュボードの非同期版"""
+
+    async def aget_page_data(self):
+        return await self.aget_cached_data(self.aget_asset_table_data)
+
+
+class AsyncMonthlyBalanceChart(AsyncChartDataMixin, MonthlyBalanceChart):
+    """月間収支のドーナッツグラフのデータの非同期版"""
+
+    async def aget_page_data(self):
+        return await self.aget_cached_data(self.aget_monthly_balance_data)
+
+
+class AsyncTransitionChart(AsyncChartDataMixin, TransitionChart):
+    """収支推移グラフのデータの非同期版。支出と収入を並行して集計する"""
+
+    async def aget_page_data(self):
+        form = TransitionGraphSearchForm(self.request.GET or None, owner_id=self.get_owner_id())
+        return await self.aget_cached_data(self.aget_balance_transition_data, form)
+
+
+class AsyncAssetAllocationChart(AsyncChartDataMixin, AssetAllocationChart):
+    """アセットアロケーションのドーナッツグラフのデータの非同期版"""
+
+    async def aget_page_data(self):
+        return await self.aget_cached_data(self.aget_asset_allocation_data)
+
+
+class AsyncAssetTransitionChart(AsyncChartDataMixin, AssetTransitionChart):
+    """資産推移グラフのデータの非同期版"""
+
+    async def aget_page_data(self):
+        return await self.aget_cached_data(self.aget_transition_graph_data)
+
+
+class Metrics(UserPassesTestMixin, generic.View):
+    """ビューごとのレイテンシのヒストグラムをPrometheusのテキスト形式で返す。スタッフのみ"""
+    raise_exception = True
+
+    def test_func(self):
+        return self.request.user.is_staff
+
+    def get(self, request, *args, **kwargs):
+        return HttpResponse(request_metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -30,11 +30,13 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'kakeibo.instrumentation.ServerTimingMiddleware',  # add
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'kakeibo.profiling.ProfilerMiddleware',  # add
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -45,8 +47,18 @@ TEMPLATES = [
     {
         'BACKEND': 'django.template.backends.django.DjangoTemplates',
         'DIRS': [],
-        'APP_DIRS': True,
         'OPTIONS': {
+            # DEBUGでない場合は、一度読み込んだテンプレートをコンパイルした状態でプロセス内に保持する
+            # DEBUGではテンプレートの変更をすぐに反映するため、毎回読み込む
+            'loaders': [
+                'django.template.loaders.filesystem.Loader',
+                'django.template.loaders.app_directories.Loader',
+            ] if DEBUG else [
+                ('django.template.loaders.cached.Loader', [
+                    'django.template.loaders.filesystem.Loader',
+                    'django.template.loaders.app_directories.Loader',
+                ]),
+            ],
             'context_processors': [
                 'django.template.context_processors.debug',
                 'django.template.context_processors.request',
@@ -67,9 +79,40 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # add 接続をリクエストをまたいで使い回す秒数。0にするとリクエストごとに接続し直します。
+        'CONN_MAX_AGE': 60,
     }
 }
 
+# SQLiteの接続ごとに実行するPRAGMAを定義
+# WALにすると、ダッシュボードの集計中でも明細を登録でき、ロック待ちで「database is locked」になりにくくなります。
+# 値をNoneにしたPRAGMAは実行しません。空の辞書にするとSQLiteの既定値のままになります。
+KAKEIBO_SQLITE_PRAGMAS = {
+    'journal_mode': 'wal',
+    'synchronous': 'normal',
+    'busy_timeout': 5000,  # ミリ秒
+    'mmap_size': 256 * 1024 * 1024,  # バイト
+    'cache_size': -20000,  # 負の値はKiB
+    'temp_store': 'memory',
+}
+
+# Cache
+# https://docs.djangoproject.com/en/3.2/ref/settings/#caches
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # add 家計簿のキャッシュとバージョン番号。複数のワーカープロセス(wfastcgiなど)で共有するためファイルに置きます。
+    'kakeibo': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': BASE_DIR / 'cache',
+        'OPTIONS': {
+            'MAX_ENTRIES': 10000,
+        },
+    },
+}
+
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
 
@@ -115,15 +158,82 @@ STATIC_ROOT = BASE_DIR / 'static'
 # add
 AUTH_USER_MODEL = 'register.User'
 
+# ログインを定義
+# 家計簿はユーザーごとに分かれていて、ログインしたユーザーの明細だけが表示されます。
+LOGIN_URL = 'login'
+LOGIN_REDIRECT_URL = '/'
+LOGOUT_REDIRECT_URL = 'login'
+
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 # add
 NUMBER_GROUPING = 3
 
-# 家計簿のスタート年を定義
-# 年の絞り込み検索のスタートする年として使用されます。
-KAKEIBO_START_YEAR = 2019
-
 # 家計簿の起算月を定義
 # 年初比に使用されます。
 MONTH_OF_BEGIN_TERM = 4
+
+# ダッシュボードの集計方法を定義
+# 'database'はSQLで集計し、'pandas'は明細をDataFrameに読み込んで集計します。
+# pandasは'pandas'で集計するとき(とCSVの取り込み)に初めて読み込まれるので、'database'ではワーカーの起動が速くなります。
+KAKEIBO_AGGREGATION_BACKEND = 'database'
+
+# 一覧ページのページングを定義
+# Trueにすると(-date, -id)順のキーセットページングになり、深いページも1ページ目と同じ速さで表示されます。
+# 件数はKAKEIBO_KEYSET_COUNT_CAPまでしか数えず、超える場合は「1,000+」のように表示されます。
+KAKEIBO_KEYSET_PAGINATION = False
+KAKEIBO_KEYSET_COUNT_CAP = 1000
+
+# 支出のキーワード検索を定義
+# SQLite 3.34以上ではFTS5(trigram)の全文検索索引を使います。Falseにすると常にicontainsで検索します。
+KAKEIBO_FULLTEXT_SEARCH = True
+
+# ダッシュボードのキャッシュを定義
+# 集計結果と、一覧とダッシュボードのテーブルの描画結果をログインユーザー、検索条件、ページごとにキャッシュします。
+# 明細やカテゴリが更新されるとテーブルごとのバージョン番号が上がり、古いキャッシュは使われなくなります。
+# バージョン番号はすべてのワーカープロセスで共有する必要があるので、KAKEIBO_CACHE_ALIASにはプロセス間で共有できる
+# キャッシュ(ファイル、データベース、Memcached、Redisなど)を指定してください。
+# プロセス内のキャッシュ(LocMemCache、DummyCache)を指定したまま有効にすると、起動時のチェックでエラーになります。
+KAKEIBO_CACHE_ENABLED = True
+KAKEIBO_CACHE_ALIAS = 'kakeibo'
+KAKEIBO_CACHE_TIMEOUT = 60 * 60 * 24
+
+# 推移グラフ(収支推移、資産推移)のデータの点数を定義
+# 表示範囲の月数(四半期、年ごとにまとめた場合はその数)がKAKEIBO_CHART_MAX_POINTSを超えると、
+# 山や谷が残るようにLTTBでこの点数まで間引きます。Noneにすると間引きません。
+KAKEIBO_CHART_MAX_POINTS = 120
+
+# カテゴリと年の選択肢のレジストリを定義
+# ユーザーごとにプロセス内に保持し、最近使われたKAKEIBO_REGISTRY_SIZE人分を超えると古いものから捨てます。
+KAKEIBO_REGISTRY_SIZE = 1000
+
+# CSV一括取り込み(import_ledgerコマンド、管理画面のBulk import)を定義
+# KAKEIBO_IMPORT_CHUNK_SIZE行ずつ検証して登録します。
+# KAKEIBO_IMPORT_WORKERSを2以上にすると、その数のプロセスで並列に検証します。
+KAKEIBO_IMPORT_CHUNK_SIZE = 5000
+KAKEIBO_IMPORT_WORKERS = 0
+
+# 明細のエクスポートを定義
+# KAKEIBO_EXPORT_CHUNK_SIZE行ずつデータベースから読み込んで送ります。
+KAKEIBO_EXPORT_CHUNK_SIZE = 2000
+
+# ダッシュボードの非同期ビューを定義
+# ASGI(project.asgi)で動かす場合はKAKEIBO_ASYNC_DASHBOARDSをTrueにすると、ダッシュボードとグラフデータのビューが非同期になり、
+# 集計はKAKEIBO_AGGREGATE_WORKERSスレッドのプールで、独立したものは並行して行います。
+KAKEIBO_ASYNC_DASHBOARDS = False
+KAKEIBO_AGGREGATE_WORKERS = 4
+
+# リクエストごとの処理時間の計測を定義
+# KAKEIBO_SERVER_TIMINGがTrueの場合、SQL、pandas、テーブルの組み立て、テンプレートの描画の時間をServer-Timingヘッダーで返します。
+# ビューごとのレイテンシは/metrics/(スタッフのみ)からPrometheusのテキスト形式で取得できます。区切りは秒です。
+KAKEIBO_SERVER_TIMING = True
+KAKEIBO_METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# スタッフ向けのプロファイラを定義
+# KAKEIBO_PROFILER_ENABLEDをTrueにすると、スタッフユーザーが家計簿のURLに?_profile=1をつけたリクエストをcProfileで実行し、
+# KAKEIBO_PROFILER_DIRに保存します。新しいものからKAKEIBO_PROFILER_KEEP件を残します。
+# 保存したプロファイルは管理画面(/admin/kakeibo/profiles/)で確認できます。Falseの場合は何も処理しません。
+KAKEIBO_PROFILER_ENABLED = False
+KAKEIBO_PROFILER_PARAM = '_profile'
+KAKEIBO_PROFILER_DIR = BASE_DIR / 'profiles'
+KAKEIBO_PROFILER_KEEP = 50
@@ -1,7 +1,10 @@
 from django.contrib import admin
 from django.urls import path, include
+from kakeibo.admin import profile_urls
 
 urlpatterns = [
+    path('admin/kakeibo/profiles/', include(profile_urls)),
     path('admin/', admin.site.urls),
+    path('accounts/', include('django.contrib.auth.urls')),
     path('', include('kakeibo.urls')),
 ]